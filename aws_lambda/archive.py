@@ -0,0 +1,274 @@
+"""XPI archives, opened and indexed once per record.
+
+Finding the extension ID, computing the signature manifests and
+writing the signed XPI all need to look inside the same archive. An
+XPIArchive parses the archive's central directory once and shares
+that index between all of them.
+"""
+
+import concurrent.futures
+import copy
+import hashlib
+import io
+import re
+import struct
+import time
+import zipfile
+import zlib
+
+# Small entries that get read more than once (for example, to find
+# the extension ID), and so are worth keeping around
+CACHED_FILENAMES = ('install.rdf', 'manifest.json')
+# The digests listed for each file in manifest.mf, as in sign_xpi_lib
+DIGEST_ALGORITHMS = ('md5', 'sha1', 'sha256')
+COPY_CHUNK_SIZE = 512 * 1024
+
+# Bits of the ZIP format (see APPNOTE.TXT) that zipfile doesn't expose
+DATA_DESCRIPTOR_FLAG = 0x08
+ZIP64_EXTRA_ID = 0x0001
+LOCAL_HEADER_FILENAME_LENGTH = 10
+LOCAL_HEADER_EXTRA_LENGTH = 11
+
+directory_re = re.compile(r"[\\/]$")
+
+
+def strip_zip64_extra(extra):
+    """Remove any ZIP64 field from an entry's extra data."""
+    fields = []
+    while len(extra) >= 4:
+        (field_id, size) = struct.unpack('<HH', extra[:4])
+        if field_id != ZIP64_EXTRA_ID:
+            fields.append(extra[:4 + size])
+        extra = extra[4 + size:]
+    return b''.join(fields)
+
+
+def digest(data):
+    return {
+        algorithm: hashlib.new(algorithm, data).digest()
+        for algorithm in DIGEST_ALGORITHMS
+    }
+
+
+def signature_for(manifest):
+    """The contents of META-INF/mozilla.sf for a manifest.mf."""
+    from sign_xpi_lib.sign_xpi_lib import Signature
+
+    signature = Signature(digest_manifests=digest(manifest.encode('utf-8')))
+    return signature.header + "\n"
+
+
+class XPIArchive(object):
+    """An XPI whose central directory has been read once.
+
+    This can stand in for the ZipFile that get_extension_id expects,
+    and produces the same manifests as sign_xpi_lib's XPIFile.
+
+    Entries are decompressed and hashed for the manifest on up to
+    digest_workers threads at once. (zlib and hashlib both release
+    the GIL while they work.)
+
+    Closing the archive closes the file it was read from.
+    """
+
+    def __init__(self, fileobj, digest_workers=1, ignored_filenames=()):
+        self.fileobj = fileobj
+        self.digest_workers = digest_workers
+        # Files that signing replaces, besides the ones that
+        # sign_xpi_lib knows about, which aren't listed in the manifest
+        self.ignored_filenames = frozenset(ignored_filenames)
+        self.zipfile = zipfile.ZipFile(fileobj)
+        # Every entry, in the order they appear in the archive. Each
+        # ZipInfo knows its entry's offset, sizes and CRC.
+        self.entries = self.zipfile.infolist()
+        self.index = {entry.filename: entry for entry in self.entries}
+        self._cache = {}
+        self._sections = None
+        self._manifest = None
+        self._signature = None
+
+    def namelist(self):
+        return [entry.filename for entry in self.entries]
+
+    def read(self, name):
+        if name in self._cache:
+            return self._cache[name]
+        contents = self.zipfile.read(self.index[name])
+        if name in CACHED_FILENAMES:
+            self._cache[name] = contents
+        return contents
+
+    def open(self, name):
+        return io.BytesIO(self.read(name))
+
+    def signed_entries(self):
+        """The entries that are listed in manifest.mf, in order."""
+        from sign_xpi_lib.sign_xpi_lib import (
+            ignore_certain_metainf_files, zinfo_key)
+
+        return [
+            entry for entry in sorted(self.entries, key=zinfo_key)
+            # Skip directories and specific files found in META-INF/
+            # that are not permitted in the manifest
+            if not (directory_re.search(entry.filename) or
+                    ignore_certain_metainf_files(entry.filename) or
+                    entry.filename in self.ignored_filenames)
+        ]
+
+    def sections(self):
+        """The manifest.mf sections for the entries, in order."""
+        if self._sections is None:
+            from sign_xpi_lib.sign_xpi_lib import Section
+
+            entries = self.signed_entries()
+            self._sections = [
+                Section(entry.filename, digests=digests)
+                for (entry, digests) in zip(entries,
+                                            self.digest_entries(entries))
+            ]
+        return self._sections
+
+    @property
+    def manifest(self):
+        """The contents of META-INF/manifest.mf, as a str."""
+        if self._manifest is None:
+            from sign_xpi_lib.sign_xpi_lib import Manifest
+
+            self._manifest = str(Manifest(self.sections()))
+        return self._manifest
+
+    def manifest_with(self, files):
+        """manifest.mf, with sections for some more files at the end.
+
+        This is how Autograph adds COSE signatures: the files that go
+        alongside the archive's own entries are listed in manifest.mf,
+        and so are covered by mozilla.sf too.
+
+        :param files: (filename, contents) pairs
+        """
+        from sign_xpi_lib.sign_xpi_lib import Manifest, Section
+
+        if not files:
+            return self.manifest
+        return str(Manifest(self.sections() + [
+            Section(filename, digests=digest(contents))
+            for (filename, contents) in files
+        ]))
+
+    def digest_entries(self, entries):
+        """Compute the digests of some entries, in the same order."""
+        def digest_entry(entry):
+            return digest(self.read(entry.filename))
+
+        if self.digest_workers <= 1:
+            return [digest_entry(entry) for entry in entries]
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.digest_workers) as executor:
+            return list(executor.map(digest_entry, entries))
+
+    @property
+    def signature(self):
+        """The contents of META-INF/mozilla.sf, which is what gets signed.
+
+        Like XPIFile.signature, this only has the digests of the
+        whole manifest, not of its individual sections.
+        """
+        if self._signature is None:
+            self._signature = signature_for(self.manifest)
+        return self._signature
+
+    def signature_with(self, files):
+        """mozilla.sf for manifest_with(files)."""
+        if not files:
+            return self.signature
+        return signature_for(self.manifest_with(files))
+
+    def data_offset(self, entry):
+        """Find where an entry's compressed data starts.
+
+        The local header before it may not have the same extra data as
+        the central directory, so this has to be read from the file.
+        """
+        self.fileobj.seek(entry.header_offset)
+        header = struct.unpack(zipfile.structFileHeader,
+                               self.fileobj.read(zipfile.sizeFileHeader))
+        if header[0] != zipfile.stringFileHeader:
+            raise zipfile.BadZipFile(
+                "Bad magic number for file header of {}".format(
+                    entry.filename))
+        return (entry.header_offset + zipfile.sizeFileHeader +
+                header[LOCAL_HEADER_FILENAME_LENGTH] +
+                header[LOCAL_HEADER_EXTRA_LENGTH])
+
+    def copy_entry(self, zout, entry):
+        """Copy an entry, still compressed, into a ZipFile being written.
+
+        Its compressed bytes, CRC and sizes are reused as they are, so
+        nothing is decompressed or recompressed. zout writes the
+        central directory for the entry when it's closed, as it does
+        for its own entries.
+
+        This moves the position of the archive's file, so it shouldn't
+        be used while other threads are reading from the archive.
+        """
+        info = copy.copy(entry)
+        # The CRC and sizes are known, and go in the local header
+        # rather than a data descriptor after the data
+        info.flag_bits &= ~DATA_DESCRIPTOR_FLAG
+        # FileHeader adds its own ZIP64 field if the entry needs one
+        info.extra = strip_zip64_extra(info.extra)
+        info.header_offset = zout.fp.tell()
+        zout.fp.write(info.FileHeader())
+
+        self.fileobj.seek(self.data_offset(entry))
+        remaining = entry.compress_size
+        while remaining:
+            chunk = self.fileobj.read(min(COPY_CHUNK_SIZE, remaining))
+            if not chunk:
+                raise zipfile.BadZipFile(
+                    "Truncated data for {}".format(entry.filename))
+            zout.fp.write(chunk)
+            remaining -= len(chunk)
+
+        add_entry(zout, info)
+
+    def close(self):
+        self.zipfile.close()
+        self.fileobj.close()
+
+
+def write_entry(zout, filename, data, level=zlib.Z_DEFAULT_COMPRESSION,
+                date_time=None):
+    """Write a small entry into a ZipFile, deflated in memory first.
+
+    Unlike ZipFile.writestr, this knows the CRC and sizes before it
+    writes the local header, so it never seeks back to fill them in,
+    and works the same on files that can't seek. It also takes a
+    compression level on every Python, where writestr only does from
+    3.7.
+
+    :param date_time: the entry's timestamp, as a ZipInfo date_time
+        tuple; defaults to now
+    """
+    info = zipfile.ZipInfo(filename,
+                           date_time=date_time or time.localtime()[:6])
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = 0o600 << 16
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    info.file_size = len(data)
+    info.compress_size = len(compressed)
+    info.CRC = zlib.crc32(data)
+    info.header_offset = zout.fp.tell()
+    zout.fp.write(info.FileHeader())
+    zout.fp.write(compressed)
+    add_entry(zout, info)
+
+
+def add_entry(zout, info):
+    """Have zout list an entry we wrote, in its central directory."""
+    zout.filelist.append(info)
+    zout.NameToInfo[info.filename] = info
+    zout.start_dir = zout.fp.tell()
+    zout._didModify = True
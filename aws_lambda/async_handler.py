@@ -0,0 +1,255 @@
+"""An asyncio version of the sign-xpi lambda's handler.
+
+Records go through the same stages as in sign_xpi.process_records,
+but each stage is a coroutine, so that many records can be in
+progress at once on one event loop rather than holding a thread each:
+
+- S3 transfers and Autograph requests, which are blocking calls in
+  boto3 and requests, are bridged onto an I/O thread pool;
+- zip work (reading the archive and its digests) is handed to a small
+  thread pool of its own, sized to the CPUs, so that it never waits
+  behind network calls;
+- Autograph requests are batched as records become ready for them,
+  up to ``AUTOGRAPH_BATCH_SIZE`` XPIs per request;
+- the signed copy is written straight into S3, on the I/O pool, since
+  it mostly waits for parts to upload (see
+  sign_xpi.upload_signed_xpi).
+
+To use it, point the lambda at ``aws_lambda.async_handler.handle``.
+It takes the same events, and gives the same results, as
+``aws_lambda.sign_xpi.handle``.
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import os
+import time
+
+from aws_lambda import metrics, sign_xpi
+
+
+def handle(event, context, env=os.environ):
+    """Handle a sign-xpi event on an asyncio event loop."""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(handle_async(event, context, env))
+    finally:
+        loop.close()
+
+
+async def handle_async(event, context, env=os.environ):
+    env = sign_xpi.Environment(strict=True).load(env).data
+    deadline = sign_xpi.Deadline(context, env)
+    if 'Records' in event:
+        event = sign_xpi.S3Event(strict=True).load(event).data
+        results = await process_records(env, event['records'],
+                                        deadline=deadline)
+        sign_xpi.raise_for_failures(results)
+        return results
+
+    event = sign_xpi.SignEvent(strict=True).load(event).data
+    [result] = await process_records(
+        env, [sign_xpi.sign_event_record(event)], raise_errors=True,
+        deadline=deadline)
+    return result
+
+
+class Pipeline(object):
+    """The executors and Autograph batcher shared by an event's records."""
+
+    def __init__(self, env):
+        self.env = env
+        self.loop = asyncio.get_event_loop()
+        self.io_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=env['async_concurrency'])
+        self.cpu_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=env['digest_workers'])
+        self.batcher = SignatureBatcher(self)
+
+    def io(self, function, *args, **kwargs):
+        return self.loop.run_in_executor(
+            self.io_executor, functools.partial(function, *args, **kwargs))
+
+    def cpu(self, function, *args, **kwargs):
+        return self.loop.run_in_executor(
+            self.cpu_executor, functools.partial(function, *args, **kwargs))
+
+    def close(self):
+        self.batcher.close()
+        self.io_executor.shutdown(wait=True)
+        self.cpu_executor.shutdown(wait=True)
+
+
+class SignatureBatcher(object):
+    """Collect signature inputs into batched /sign/data requests.
+
+    Whatever XPIs are waiting when a request goes out are sent
+    together, up to the batch size, so batches form by themselves
+    while Autograph is busy. The inputs an XPI sends at once (one per
+    key, for each round of signing) always go in the same request.
+    """
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.batch_size = pipeline.env['autograph_batch_size']
+        self.queue = asyncio.Queue()
+        self.task = asyncio.ensure_future(self.run())
+        self.requests = set()
+
+    async def sign(self, sign_inputs):
+        """Get the signatures for one XPI's inputs, in the same order."""
+        future = self.pipeline.loop.create_future()
+        self.queue.put_nowait((sign_inputs, future))
+        return await future
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            request = asyncio.ensure_future(self.request(batch))
+            self.requests.add(request)
+            request.add_done_callback(self.requests.discard)
+
+    async def request(self, batch):
+        try:
+            signatures = await self.pipeline.io(
+                sign_xpi.request_signatures, self.pipeline.env,
+                [sign_input for (sign_inputs, _) in batch
+                 for sign_input in sign_inputs])
+        except Exception as e:
+            for (_, future) in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        start = 0
+        for (sign_inputs, future) in batch:
+            if not future.done():
+                future.set_result(
+                    signatures[start:start + len(sign_inputs)])
+            start += len(sign_inputs)
+
+    def close(self):
+        self.task.cancel()
+
+
+async def process_records(env, records, raise_errors=False, deadline=None):
+    """Sign and upload the XPIs referenced by some event records.
+
+    Up to ``ASYNC_CONCURRENCY`` records are in progress at once. As in
+    sign_xpi.process_records, failures are reported in each record's
+    entry of the result, unless raise_errors is set, and records are
+    started biggest first, and only if there's time to finish them
+    before the deadline.
+    """
+    pipeline = Pipeline(env)
+    semaphore = asyncio.Semaphore(env['async_concurrency'])
+    record_metrics = [metrics.RecordMetrics() for _ in records]
+
+    async def process(record, xpi_metrics):
+        async with semaphore:
+            try:
+                if deadline is not None:
+                    deadline.check(record)
+                return await process_record(pipeline, record, xpi_metrics)
+            except Exception as e:
+                sign_xpi.logger.error(
+                    "Failed to sign %s", sign_xpi.describe_record(record),
+                    exc_info=e)
+                return e
+
+    # Tasks start, and get through the semaphore, in the order they
+    # were made. (They're made here, because gather only keeps to the
+    # order of coroutines from Python 3.7.)
+    order = sign_xpi.start_order(records)
+    try:
+        started = await asyncio.gather(*[
+            asyncio.ensure_future(process(records[i], record_metrics[i]))
+            for i in order
+        ])
+    finally:
+        pipeline.close()
+    outcomes = [None] * len(records)
+    for (i, outcome) in zip(order, started):
+        outcomes[i] = outcome
+
+    errors = [outcome for outcome in outcomes
+              if isinstance(outcome, Exception)]
+    results = [
+        sign_xpi.error_result(outcome)
+        if isinstance(outcome, Exception) else outcome
+        for outcome in outcomes
+    ]
+    for (record, result, xpi_metrics) in zip(records, results,
+                                             record_metrics):
+        sign_xpi.report_metrics(env, record, result, xpi_metrics)
+
+    if raise_errors and errors:
+        raise errors[0]
+    return results
+
+
+async def process_record(pipeline, record, record_metrics):
+    env = pipeline.env
+    (localfile, filename, checksum) = await pipeline.io(
+        sign_xpi.retrieve_record, env, record, record_metrics)
+    (archive, guid) = await pipeline.cpu(
+        sign_xpi.open_record, env, record, localfile, record_metrics)
+    cache_key = sign_xpi.signed_xpi_cache_key(env, checksum, guid)
+    try:
+        if env['reuse_signed_xpis']:
+            signed_result = await pipeline.io(
+                sign_xpi.find_signed_xpi, env, filename, cache_key)
+            if signed_result is not None:
+                sign_xpi.logger.info("Reusing signed XPI for %s",
+                                     sign_xpi.describe_record(record))
+                archive.close()
+                return signed_result
+        signatures = await sign_archive(pipeline, archive, guid,
+                                        record_metrics)
+    except BaseException:
+        archive.close()
+        raise
+
+    # This closes the archive
+    prepared = sign_xpi.PreparedXPI(archive, filename, guid, checksum, None)
+    return await pipeline.io(sign_xpi.upload_signed_xpi, env, signatures,
+                             prepared, record_metrics)
+
+
+async def sign_archive(pipeline, archive, guid, record_metrics):
+    """Get the signatures for an XPIArchive, as part of a batch.
+
+    As in sign_xpi.request_xpi_signatures, any keys after the first
+    sign the manifest in a first round, and the first key signs
+    mozilla.sf in a second.
+
+    :returns: (filename, contents) pairs, as from
+        sign_xpi.request_xpi_signatures
+    """
+    env = pipeline.env
+    extra_files = []
+    if len(sign_xpi.signing_keys(env)) > 1:
+        with record_metrics.time('digest'):
+            manifest = await pipeline.cpu(lambda: archive.manifest)
+        signatures = await sign(pipeline, record_metrics,
+                                sign_xpi.make_extra_sign_inputs(
+                                    env, manifest, guid))
+        extra_files = sign_xpi.extra_signature_files(env, manifest,
+                                                     signatures)
+
+    with record_metrics.time('digest'):
+        signature = await pipeline.cpu(archive.signature_with, extra_files)
+    [signature] = await sign(pipeline, record_metrics,
+                             sign_xpi.make_sign_inputs(env, signature, guid))
+    return sign_xpi.signed_files(env, signature, extra_files)
+
+
+async def sign(pipeline, record_metrics, sign_inputs):
+    """Get the signatures for one XPI's inputs, timing the wait."""
+    start = time.perf_counter()
+    signatures = await pipeline.batcher.sign(sign_inputs)
+    record_metrics.add_time('autograph', time.perf_counter() - start)
+    sign_xpi.record_limiter_state(pipeline.env, record_metrics)
+    return signatures
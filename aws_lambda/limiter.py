@@ -0,0 +1,130 @@
+"""Client-side backpressure for requests to Autograph.
+
+Autograph is shared by every instance of the lambda, so when it slows
+down or starts turning requests away, sending it more requests (and
+retrying them) only makes things worse. An AdaptiveLimiter bounds how
+many requests are in flight at once, and adapts that bound to how
+Autograph is coping, in the manner of TCP congestion control:
+
+- a request that succeeds quickly adds 1/limit to the limit, so the
+  limit grows by about one per round of requests ("additive
+  increase");
+- a slow request, or one that Autograph turns away (429, 5xx or a
+  connection error), multiplies it by a factor less than one
+  ("multiplicative decrease").
+
+After enough consecutive failures, the limiter's circuit breaker
+opens, and requests fail straight away rather than waiting for
+Autograph to time out. After a cooldown, one request is let through
+to see if Autograph is back.
+"""
+
+import threading
+import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+# How much to shrink the limit by, for a slow request and for a
+# request that Autograph turned away
+SLOW_DECREASE = 0.9
+OVERLOAD_DECREASE = 0.5
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, retry_after):
+        message = ("Autograph is failing; not sending it requests for "
+                   "another {:.1f}s".format(retry_after))
+        super(CircuitOpenError, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class AdaptiveLimiter(object):
+    """An AIMD concurrency limit with a circuit breaker.
+
+    :param max_limit: the most requests to have in flight at once
+    :param latency_target: requests slower than this many seconds
+        count as a sign of overload
+    :param failure_threshold: consecutive failures that open the circuit
+    :param cooldown: seconds to keep the circuit open for
+    """
+
+    def __init__(self, max_limit, latency_target, failure_threshold,
+                 cooldown, clock=time.monotonic):
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        # Start halfway, and find the right limit from there
+        self.limit = max(1.0, max_limit / 2)
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self.circuit = CLOSED
+        self.opened_at = None
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Wait for a slot to send a request in.
+
+        :raises CircuitOpenError: if the circuit is open
+        """
+        with self.condition:
+            while True:
+                self.check_circuit()
+                if self.circuit == HALF_OPEN:
+                    # Only the one trial request, until we know more
+                    if self.in_flight == 0:
+                        break
+                elif self.in_flight < int(self.limit):
+                    break
+                self.condition.wait(self.time_until_half_open())
+            self.in_flight += 1
+
+    def release(self, latency, overloaded):
+        """Give back a slot, and adapt the limit to how the request went.
+
+        :param latency: how long the request took, in seconds
+        :param overloaded: whether Autograph turned the request away
+        """
+        with self.condition:
+            self.in_flight -= 1
+            if overloaded:
+                self.limit = max(1.0, self.limit * OVERLOAD_DECREASE)
+                self.consecutive_failures += 1
+                if (self.circuit == HALF_OPEN or
+                        self.consecutive_failures >= self.failure_threshold):
+                    self.circuit = OPEN
+                    self.opened_at = self.clock()
+            else:
+                if latency > self.latency_target:
+                    self.limit = max(1.0, self.limit * SLOW_DECREASE)
+                else:
+                    self.limit = min(self.max_limit,
+                                     self.limit + 1 / self.limit)
+                self.consecutive_failures = 0
+                self.circuit = CLOSED
+            self.condition.notify_all()
+
+    def check_circuit(self):
+        """Half-open the circuit once it's cooled down, or else fail."""
+        if self.circuit != OPEN:
+            return
+        retry_after = self.time_until_half_open()
+        if retry_after > 0:
+            raise CircuitOpenError(retry_after)
+        self.circuit = HALF_OPEN
+
+    def time_until_half_open(self):
+        if self.circuit != OPEN:
+            return None
+        return self.opened_at + self.cooldown - self.clock()
+
+    def state(self):
+        with self.condition:
+            return {
+                "limit": self.limit,
+                "in_flight": self.in_flight,
+                "circuit": self.circuit,
+            }
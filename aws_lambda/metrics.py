@@ -0,0 +1,120 @@
+"""Timings and sizes measured while signing each record.
+
+These are emitted as one JSON line per record, in CloudWatch's
+embedded metric format (EMF), which CloudWatch Logs turns into
+metrics without any extra API calls.
+"""
+
+import collections
+import contextlib
+import json
+import sys
+import time
+
+NAMESPACE = 'sign-xpi'
+
+# The stages of signing a record, in order, and their EMF metric
+# names. Checksum time is the part of the download spent hashing.
+STAGES = collections.OrderedDict([
+    ('download', 'DownloadTime'),
+    ('checksum', 'ChecksumTime'),
+    ('guid', 'GuidTime'),
+    ('digest', 'DigestTime'),
+    ('autograph', 'AutographTime'),
+    ('write', 'WriteTime'),
+    ('upload', 'UploadTime'),
+])
+
+# Sizes measured for each record, with their EMF metric names and units
+SIZES = collections.OrderedDict([
+    ('input_bytes', ('InputBytes', 'Bytes')),
+    ('output_bytes', ('OutputBytes', 'Bytes')),
+    ('entries', ('Entries', 'Count')),
+])
+
+# Other things observed while signing each record, such as the state
+# of the Autograph limiter, with their EMF metric names and units
+GAUGES = collections.OrderedDict([
+    ('autograph_limit', ('AutographConcurrencyLimit', 'Count')),
+    ('autograph_in_flight', ('AutographInFlight', 'Count')),
+])
+
+
+class RecordMetrics(object):
+    """Timings and sizes for one record.
+
+    Only the stages a record actually went through get a timing.
+    Timings are kept in milliseconds.
+    """
+
+    def __init__(self):
+        self.timings = {}
+        self.sizes = {}
+        self.gauges = {}
+        # Extra information to log with the metrics
+        self.properties = {}
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def add_time(self, stage, seconds):
+        self.timings[stage] = self.timings.get(stage, 0) + seconds * 1000
+
+    def set_size(self, name, value):
+        self.sizes[name] = value
+
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+
+    def as_dict(self):
+        return {
+            "timings_ms": {
+                stage: self.timings[stage]
+                for stage in STAGES if stage in self.timings
+            },
+            "sizes": dict(self.sizes),
+            "gauges": dict(self.gauges),
+        }
+
+    def to_emf(self, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        definitions = []
+        line = dict(self.properties)
+        for (stage, name) in STAGES.items():
+            if stage in self.timings:
+                definitions.append({"Name": name, "Unit": "Milliseconds"})
+                line[name] = self.timings[stage]
+        for (size, (name, unit)) in SIZES.items():
+            if size in self.sizes:
+                definitions.append({"Name": name, "Unit": unit})
+                line[name] = self.sizes[size]
+        for (gauge, (name, unit)) in GAUGES.items():
+            if gauge in self.gauges:
+                definitions.append({"Name": name, "Unit": unit})
+                line[name] = self.gauges[gauge]
+        line["_aws"] = {
+            "Timestamp": int(timestamp * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": NAMESPACE,
+                "Dimensions": [[]],
+                "Metrics": definitions,
+            }],
+        }
+        return line
+
+
+def emit(metrics):
+    """Write a record's metrics to the log as an EMF line.
+
+    This goes straight to stdout, rather than through logging, because
+    the Lambda runtime prefixes log messages with things that would
+    stop CloudWatch from parsing the line.
+    """
+    print(json.dumps(metrics.to_emf(), sort_keys=True), file=sys.stdout,
+          flush=True)
@@ -0,0 +1,180 @@
+"""Write a file straight into S3, as a multipart upload.
+
+Writing a signed XPI to a file and only then uploading it means the
+network sits idle while the archive is written, and the other way
+round. A MultipartUploadWriter is a write-only file that sends each
+part to S3 as soon as it's full, while later parts are still being
+written, and hashes what's written as it goes.
+
+Outputs no bigger than the multipart threshold are sent with a single
+PutObject, as boto3's transfers do.
+"""
+
+import concurrent.futures
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# S3 metadata on uploaded objects, which is only known once they're
+# written
+SHA256_METADATA = 'sha256'
+SIZE_METADATA = 'size'
+
+
+class MultipartUploadWriter(object):
+    """A write-only file whose contents are uploaded to S3 as they come.
+
+    Up to max_concurrency parts are uploaded at once. Writes wait for
+    a part to finish beyond that, so at most about max_concurrency + 1
+    parts are held in memory, however big the file gets.
+
+    Once everything is written, call complete, or abort to give up.
+
+    :param client: an S3 client
+    :param metadata: S3 metadata for the object. The sha256 and size of
+        the object are added to it. For multipart uploads, that's only
+        done after the object is in place (see complete), so anything
+        that needs to be on the object from the start should go here.
+    """
+
+    def __init__(self, client, bucket, key, part_size, threshold=None,
+                 max_concurrency=1, metadata=None):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.threshold = max(threshold or 0, part_size)
+        self.metadata = dict(metadata or {})
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.executor = None
+        self.max_concurrency = max_concurrency
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        self.buffer += data
+        if self.upload_id is None and len(self.buffer) < self.threshold:
+            return len(data)
+        while len(self.buffer) >= self.part_size:
+            self.send_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def tell(self):
+        # Enough for zipfile, which needs the offsets of its entries
+        return self.size
+
+    def seekable(self):
+        return False
+
+    def writable(self):
+        return True
+
+    def flush(self):
+        pass
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+    def send_part(self, data):
+        if self.upload_id is None:
+            response = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, Metadata=self.metadata)
+            self.upload_id = response['UploadId']
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_concurrency)
+        # Don't keep writing if a part has already failed
+        for future in self.parts:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+        part_number = len(self.parts) + 1
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(self.upload_part, part_number,
+                                          data)
+        except Exception:
+            self.slots.release()
+            raise
+        self.parts.append(future)
+
+    def upload_part(self, part_number, data):
+        try:
+            response = self.client.upload_part(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                PartNumber=part_number, Body=data)
+        finally:
+            self.slots.release()
+        return {"PartNumber": part_number, "ETag": response['ETag']}
+
+    def complete(self):
+        """Send whatever's left and finish the upload.
+
+        Metadata can only be given when a multipart upload starts,
+        before the sha256 and size are known, so they're added
+        afterwards by copying the object onto itself. Until that copy
+        lands, the object is there with only the metadata it was
+        started with. If the copy fails, or the object has been
+        replaced in the meantime, the object is left like that: it's
+        whole, so that's only logged.
+        """
+        metadata = dict(self.metadata)
+        metadata[SHA256_METADATA] = self.hexdigest()
+        metadata[SIZE_METADATA] = str(self.size)
+        if self.upload_id is None:
+            self.client.put_object(Bucket=self.bucket, Key=self.key,
+                                   Body=bytes(self.buffer),
+                                   Metadata=metadata)
+            self.buffer = bytearray()
+            return
+
+        try:
+            # The last part is allowed to be smaller than the others
+            if self.buffer:
+                self.send_part(bytes(self.buffer))
+                self.buffer = bytearray()
+            parts = [future.result() for future in self.parts]
+            response = self.client.complete_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                MultipartUpload={"Parts": parts})
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self.executor.shutdown(wait=True)
+        # There's nothing left to abort
+        self.upload_id = None
+        self.add_metadata(metadata, response['ETag'])
+
+    def add_metadata(self, metadata, etag):
+        """Replace the uploaded object's metadata, if it's still ours."""
+        import botocore.exceptions
+
+        try:
+            # Only if the object is still the one we uploaded, so that
+            # another upload to the same key never gets our sha256
+            self.client.copy_object(
+                Bucket=self.bucket, Key=self.key,
+                CopySource={"Bucket": self.bucket, "Key": self.key},
+                CopySourceIfMatch=etag,
+                Metadata=metadata, MetadataDirective='REPLACE')
+        except (botocore.exceptions.BotoCoreError,
+                botocore.exceptions.ClientError) as e:
+            logger.warning("Couldn't add the sha256 and size to bucket=%s "
+                           "key=%s: %s", self.bucket, self.key, e)
+
+    def abort(self):
+        """Give up on the upload, so that S3 doesn't keep its parts."""
+        self.buffer = bytearray()
+        if self.upload_id is None:
+            return
+        self.executor.shutdown(wait=True)
+        self.client.abort_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        self.upload_id = None
@@ -1,27 +1,102 @@
 import base64
+import collections
+import concurrent.futures
+import functools
 import hashlib
+import io
 import logging
 import os.path
 import email.utils
+import random
 import sys
 import tempfile
+import threading
+import time
 import zipfile
+from xml.etree import ElementTree
 
-import boto3
 import json
 import marshmallow.fields
-import rdflib
-import requests
-from requests_hawk import HawkAuth
-from sign_xpi_lib import XPIFile
-from six.moves.urllib.parse import urljoin, unquote
+import marshmallow.validate
+from aws_lambda import metrics
+from aws_lambda.archive import XPIArchive, signature_for, write_entry
+from aws_lambda.limiter import AdaptiveLimiter, CircuitOpenError
+from aws_lambda.multipart import (
+    MultipartUploadWriter, SHA256_METADATA, SIZE_METADATA)
+from six.moves.urllib.parse import (
+    urljoin, unquote, unquote_to_bytes, urlparse)
 
 CHUNK_SIZE = 512 * 1024
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_ASYNC_CONCURRENCY = 32
+DEFAULT_SPOOL_MAX_SIZE = 8 * 1024 * 1024
+DEFAULT_DOWNLOAD_MAX_SIZE = 512 * 1024 * 1024
+DEFAULT_DOWNLOAD_TIMEOUT = 30.0
+DEFAULT_S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+DEFAULT_S3_MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+DEFAULT_S3_MAX_CONCURRENCY = 10
+# The S3 client's pool size when there's no environment to size it
+# from (see s3_pool_size)
+S3_MAX_POOL_CONNECTIONS = DEFAULT_MAX_WORKERS * DEFAULT_S3_MAX_CONCURRENCY
+DEFAULT_DIGEST_WORKERS = os.cpu_count() or 1
+DEFAULT_AUTOGRAPH_BATCH_SIZE = 20
+# S3 metadata on signed XPIs; see signed_xpi_cache_key
+SIGNED_XPI_CACHE_KEY_METADATA = 'sign-xpi-cache-key'
+# Where the first key's signature goes (see parse_signing_keys), and
+# the suffixes of the files for any others and the manifests they
+# sign. Firefox only accepts one file matching each of META-INF/*.rsa,
+# *.sf and *.dsa.
+PKCS7_SIGNATURE_FILENAME = 'META-INF/mozilla.rsa'
+EXTRA_SIGNATURE_SUFFIX = '.sig'
+EXTRA_MANIFEST_SUFFIX = '.manifest'
+RESERVED_SIGNATURE_SUFFIXES = ('.rsa', '.sf', '.dsa', '.mf',
+                               EXTRA_MANIFEST_SUFFIX)
+DEFAULT_AUTOGRAPH_POOL_SIZE = 10
+DEFAULT_AUTOGRAPH_RETRIES = 3
+DEFAULT_AUTOGRAPH_RETRY_BACKOFF = 0.5
+DEFAULT_AUTOGRAPH_CONNECT_TIMEOUT = 5.0
+DEFAULT_AUTOGRAPH_READ_TIMEOUT = 30.0
+DEFAULT_AUTOGRAPH_LATENCY_TARGET = 2.0
+DEFAULT_AUTOGRAPH_CIRCUIT_THRESHOLD = 5
+DEFAULT_AUTOGRAPH_CIRCUIT_COOLDOWN = 30.0
+# Time to keep in hand at the end of an invocation, and the estimated
+# cost of a record: a fixed part, plus a part that grows with its size
+DEFAULT_DEADLINE_MARGIN_MS = 3000
+DEFAULT_RECORD_BASE_COST_MS = 500
+DEFAULT_RECORD_BYTES_PER_SECOND = 5 * 1024 * 1024
+# Responses that mean Autograph is overloaded or failing, and that
+# are worth retrying
+AUTOGRAPH_RETRY_STATUSES = (429,)
+# The eventSource of records made from SignEvents; S3 event records
+# have "aws:s3"
+SIGN_EVENT_SOURCE = 'sign-xpi:sign-event'
+# The Event of the message S3 sends when notifications are first set
+# up, which has no records
+S3_TEST_EVENT = 's3:TestEvent'
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-s3 = boto3.resource('s3')
+# Heavy dependencies (boto3, requests, sign_xpi_lib...) are imported
+# where they're first used, rather than here, to keep cold starts
+# short. For the same reason, S3 resources are only created the
+# first time they're needed; see get_s3. There's one per pool size.
+s3_resources = {}
+s3_lock = threading.Lock()
+
+# Sessions for talking to Autograph, by (hawk ID, hawk secret, pool
+# size). These live at module level so that connections are kept
+# alive across records and across warm invocations of the lambda.
+autograph_sessions = {}
+autograph_sessions_lock = threading.Lock()
+# Session for fetching XPIs from URLs, by pool size. This one must
+# never carry Autograph credentials.
+download_sessions = {}
+download_sessions_lock = threading.Lock()
+# Concurrency limiters for Autograph, by server URL and settings; see
+# get_autograph_limiter
+autograph_limiters = {}
+autograph_limiters_lock = threading.Lock()
 
 
 class SignXPIError(Exception):
@@ -55,6 +130,121 @@ class S3IdMatchError(SignXPIError):
         self.s3_id = s3_id
 
 
+class XPITooLargeError(SignXPIError):
+    def __init__(self, url, max_size):
+        message = "When fetching {}, got more than {} bytes".format(
+            url, max_size)
+        super(XPITooLargeError, self).__init__(message)
+        self.url = url
+        self.max_size = max_size
+
+
+class FilenameMissingError(SignXPIError):
+    def __init__(self, url):
+        message = "Couldn't determine a filename for {}".format(url)
+        super(FilenameMissingError, self).__init__(message)
+        self.url = url
+
+
+class AutographResponseError(SignXPIError):
+    def __init__(self, expected_count, actual_count):
+        message = "Sent {} inputs to Autograph (got {} signatures)".format(
+            expected_count, actual_count)
+        super(AutographResponseError, self).__init__(message)
+        self.expected_count = expected_count
+        self.actual_count = actual_count
+
+
+class DeadlineExceededError(SignXPIError):
+    def __init__(self, estimated_ms, remaining_ms):
+        message = ("Not enough time left to sign this XPI (estimated {}ms, "
+                   "{}ms left)".format(int(estimated_ms), int(remaining_ms)))
+        super(DeadlineExceededError, self).__init__(message)
+        self.estimated_ms = estimated_ms
+        self.remaining_ms = remaining_ms
+
+
+class RecordsFailedError(SignXPIError):
+    def __init__(self, results):
+        failures = [result['error']['type'] for result in results
+                    if is_retryable_failure(result)]
+        message = "{} of {} records can be retried ({})".format(
+            len(failures), len(results), ", ".join(sorted(set(failures))))
+        super(RecordsFailedError, self).__init__(message)
+        self.results = results
+
+    def __reduce__(self):
+        # So that it can be sent back from the worker's processes
+        return (RecordsFailedError, (self.results,))
+
+
+SigningKey = collections.namedtuple(
+    'SigningKey', ['key_id', 'filename', 'manifest_filename'])
+
+
+def parse_signing_keys(value):
+    """Parse ``AUTOGRAPH_KEY_ID`` into a list of SigningKeys.
+
+    It's a comma-separated list of Autograph key IDs. The first key
+    signs the XPI's mozilla.sf, and its signature goes in
+    META-INF/mozilla.rsa. Any others are added the way Autograph adds
+    COSE signatures: each signs the XPI's manifest.mf, as it is
+    without them, and its signature goes in the META-INF file named
+    after a colon (as in ``extensions-new:new.sig``), or else in
+    META-INF/<key ID>.sig. The manifest it signed goes next to it, in
+    a file ending in ``.manifest`` instead (the manifest_filename).
+    Both files are then listed in manifest.mf, so that mozilla.rsa
+    covers them.
+
+    :raises ValueError: if the list is empty, or the files clash
+    """
+    keys = []
+    for (n, part) in enumerate(value.split(',')):
+        (key_id, _, filename) = part.strip().partition(':')
+        if not key_id:
+            raise ValueError("Empty key ID in {!r}".format(value))
+        if n == 0:
+            if filename:
+                raise ValueError("The first key's signature always goes "
+                                 "in " + PKCS7_SIGNATURE_FILENAME)
+            keys.append(SigningKey(key_id, PKCS7_SIGNATURE_FILENAME, None))
+            continue
+        filename = 'META-INF/' + (filename or key_id + EXTRA_SIGNATURE_SUFFIX)
+        if (filename.lower().endswith(RESERVED_SIGNATURE_SUFFIXES) or
+                '/' in filename[len('META-INF/'):]):
+            raise ValueError("Can't write a signature to " + filename)
+        manifest_filename = (os.path.splitext(filename)[0] +
+                             EXTRA_MANIFEST_SUFFIX)
+        keys.append(SigningKey(key_id, filename, manifest_filename))
+    filenames = [filename.lower()
+                 for filename in all_signature_filenames(keys)]
+    if len(set(filenames)) != len(filenames):
+        raise ValueError("Signatures would overwrite each other in "
+                         "{!r}".format(value))
+    return keys
+
+
+def validate_signing_keys(value):
+    try:
+        parse_signing_keys(value)
+    except ValueError as e:
+        raise marshmallow.exceptions.ValidationError(str(e))
+
+
+def signing_keys(env):
+    return parse_signing_keys(env['autograph_key_id'])
+
+
+def all_signature_filenames(keys):
+    """Every file in META-INF that signing with some keys writes."""
+    filenames = []
+    for key in keys:
+        filenames.append(key.filename)
+        if key.manifest_filename is not None:
+            filenames.append(key.manifest_filename)
+    return filenames
+
+
 class Environment(marshmallow.Schema):
     autograph_hawk_id = marshmallow.fields.String(
         required=True, load_from="AUTOGRAPH_HAWK_ID")
@@ -62,10 +252,97 @@ class Environment(marshmallow.Schema):
         required=True, load_from="AUTOGRAPH_HAWK_SECRET")
     autograph_server_url = marshmallow.fields.String(
         required=True, load_from="AUTOGRAPH_SERVER_URL")
+    # One or more key IDs; see parse_signing_keys
     autograph_key_id = marshmallow.fields.String(
-        required=True, load_from="AUTOGRAPH_KEY_ID")
+        required=True, load_from="AUTOGRAPH_KEY_ID",
+        validate=validate_signing_keys)
     output_bucket = marshmallow.fields.String(
         required=True, load_from="OUTPUT_BUCKET")
+    max_workers = marshmallow.fields.Integer(
+        missing=DEFAULT_MAX_WORKERS, load_from="MAX_WORKERS",
+        validate=marshmallow.validate.Range(min=1))
+    # Records in progress at once in aws_lambda.async_handler
+    async_concurrency = marshmallow.fields.Integer(
+        missing=DEFAULT_ASYNC_CONCURRENCY, load_from="ASYNC_CONCURRENCY",
+        validate=marshmallow.validate.Range(min=1))
+    spool_max_size = marshmallow.fields.Integer(
+        missing=DEFAULT_SPOOL_MAX_SIZE, load_from="SPOOL_MAX_SIZE",
+        validate=marshmallow.validate.Range(min=0))
+    s3_multipart_threshold = marshmallow.fields.Integer(
+        missing=DEFAULT_S3_MULTIPART_THRESHOLD,
+        load_from="S3_MULTIPART_THRESHOLD",
+        validate=marshmallow.validate.Range(min=1))
+    s3_multipart_chunksize = marshmallow.fields.Integer(
+        missing=DEFAULT_S3_MULTIPART_CHUNKSIZE,
+        load_from="S3_MULTIPART_CHUNKSIZE",
+        # S3's minimum part size
+        validate=marshmallow.validate.Range(min=5 * 1024 * 1024))
+    s3_max_concurrency = marshmallow.fields.Integer(
+        missing=DEFAULT_S3_MAX_CONCURRENCY, load_from="S3_MAX_CONCURRENCY",
+        validate=marshmallow.validate.Range(min=1))
+    download_max_size = marshmallow.fields.Integer(
+        missing=DEFAULT_DOWNLOAD_MAX_SIZE, load_from="DOWNLOAD_MAX_SIZE",
+        validate=marshmallow.validate.Range(min=1))
+    download_timeout = marshmallow.fields.Float(
+        missing=DEFAULT_DOWNLOAD_TIMEOUT, load_from="DOWNLOAD_TIMEOUT",
+        validate=marshmallow.validate.Range(min=0))
+    digest_workers = marshmallow.fields.Integer(
+        missing=DEFAULT_DIGEST_WORKERS, load_from="DIGEST_WORKERS",
+        validate=marshmallow.validate.Range(min=1))
+    reuse_signed_xpis = marshmallow.fields.Boolean(
+        missing=True, load_from="REUSE_SIGNED_XPIS")
+    autograph_batch_size = marshmallow.fields.Integer(
+        missing=DEFAULT_AUTOGRAPH_BATCH_SIZE, load_from="AUTOGRAPH_BATCH_SIZE",
+        validate=marshmallow.validate.Range(min=1))
+    autograph_pool_size = marshmallow.fields.Integer(
+        missing=DEFAULT_AUTOGRAPH_POOL_SIZE, load_from="AUTOGRAPH_POOL_SIZE",
+        validate=marshmallow.validate.Range(min=1))
+    autograph_retries = marshmallow.fields.Integer(
+        missing=DEFAULT_AUTOGRAPH_RETRIES, load_from="AUTOGRAPH_RETRIES",
+        validate=marshmallow.validate.Range(min=0))
+    autograph_retry_backoff = marshmallow.fields.Float(
+        missing=DEFAULT_AUTOGRAPH_RETRY_BACKOFF,
+        load_from="AUTOGRAPH_RETRY_BACKOFF",
+        validate=marshmallow.validate.Range(min=0))
+    autograph_connect_timeout = marshmallow.fields.Float(
+        missing=DEFAULT_AUTOGRAPH_CONNECT_TIMEOUT,
+        load_from="AUTOGRAPH_CONNECT_TIMEOUT",
+        validate=marshmallow.validate.Range(min=0))
+    autograph_read_timeout = marshmallow.fields.Float(
+        missing=DEFAULT_AUTOGRAPH_READ_TIMEOUT,
+        load_from="AUTOGRAPH_READ_TIMEOUT",
+        validate=marshmallow.validate.Range(min=0))
+    # The most requests to have in flight to Autograph at once; fewer
+    # are sent while it's slow or failing
+    autograph_max_concurrency = marshmallow.fields.Integer(
+        missing=DEFAULT_AUTOGRAPH_POOL_SIZE,
+        load_from="AUTOGRAPH_MAX_CONCURRENCY",
+        validate=marshmallow.validate.Range(min=1))
+    autograph_latency_target = marshmallow.fields.Float(
+        missing=DEFAULT_AUTOGRAPH_LATENCY_TARGET,
+        load_from="AUTOGRAPH_LATENCY_TARGET",
+        validate=marshmallow.validate.Range(min=0))
+    autograph_circuit_threshold = marshmallow.fields.Integer(
+        missing=DEFAULT_AUTOGRAPH_CIRCUIT_THRESHOLD,
+        load_from="AUTOGRAPH_CIRCUIT_THRESHOLD",
+        validate=marshmallow.validate.Range(min=1))
+    autograph_circuit_cooldown = marshmallow.fields.Float(
+        missing=DEFAULT_AUTOGRAPH_CIRCUIT_COOLDOWN,
+        load_from="AUTOGRAPH_CIRCUIT_COOLDOWN",
+        validate=marshmallow.validate.Range(min=0))
+    deadline_margin_ms = marshmallow.fields.Integer(
+        missing=DEFAULT_DEADLINE_MARGIN_MS, load_from="DEADLINE_MARGIN_MS",
+        validate=marshmallow.validate.Range(min=0))
+    record_base_cost_ms = marshmallow.fields.Integer(
+        missing=DEFAULT_RECORD_BASE_COST_MS, load_from="RECORD_BASE_COST_MS",
+        validate=marshmallow.validate.Range(min=0))
+    record_bytes_per_second = marshmallow.fields.Integer(
+        missing=DEFAULT_RECORD_BYTES_PER_SECOND,
+        load_from="RECORD_BYTES_PER_SECOND",
+        validate=marshmallow.validate.Range(min=1))
+    # Include each record's timings and sizes in the result
+    debug_metrics = marshmallow.fields.Boolean(
+        missing=False, load_from="DEBUG_METRICS")
 
 
 class SourceInfo(marshmallow.Schema):
@@ -97,6 +374,7 @@ class BucketData(marshmallow.Schema):
 
 class ObjectData(marshmallow.Schema):
     key = marshmallow.fields.String(required=True)
+    size = marshmallow.fields.Integer()
 
     @marshmallow.pre_load
     def unencode_key(self, in_data):
@@ -135,72 +413,798 @@ class SignEvent(marshmallow.Schema):
     checksum = marshmallow.fields.String()
 
 
+class SQSMessage(marshmallow.Schema):
+    message_id = marshmallow.fields.String(
+        required=True, load_from='messageId')
+    # An S3 event notification, as JSON
+    body = marshmallow.fields.String(required=True)
+
+
+class SQSEvent(marshmallow.Schema):
+    messages = marshmallow.fields.List(
+        marshmallow.fields.Nested(SQSMessage),
+        load_from='Records',
+        required=True)
+
+
 def handle(event, context, env=os.environ):
     """
     Handle a sign-xpi event.
+
+    This is either an S3 event, or a SignEvent when the lambda is
+    invoked directly (for example, by the CLI).
+
+    For S3 events, the result has one entry per record, in the order
+    the records appeared in the event. If any of them failed in a way
+    that retrying might fix, including those that there wasn't time to
+    start before the invocation's deadline (see Deadline),
+    RecordsFailedError is raised once they're all done (see
+    raise_for_failures). For a SignEvent, the result is the only such
+    entry, and errors are raised.
     """
 
-    event = S3Event(strict=True).load(event).data
     env = Environment(strict=True).load(env).data
+    deadline = Deadline(context, env)
+    if 'Records' in event:
+        event = S3Event(strict=True).load(event).data
+        results = process_records(env, event['records'], deadline=deadline)
+        raise_for_failures(results)
+        return results
+
+    event = SignEvent(strict=True).load(event).data
+    [result] = process_records(env, [sign_event_record(event)],
+                               raise_errors=True, deadline=deadline)
+    return result
+
+
+def handle_sqs(event, context, env=os.environ):
+    """
+    Handle a batch of S3 event notifications delivered through SQS.
+
+    The records of every message in the batch are processed together,
+    as for a multi-record S3 event. Only the messages that had a
+    failing record are reported in ``batchItemFailures``, so that SQS
+    redelivers just those, and not the rest of the batch. (The event
+    source mapping needs ``ReportBatchItemFailures`` turned on for
+    this.) That includes messages with records that there wasn't time
+    to start, and messages that aren't S3 notifications at all (such
+    as ones wrapped by SNS), so that they end up in a dead-letter
+    queue rather than being dropped. Only S3's test events are skipped.
+    """
+    env = Environment(strict=True).load(env).data
+    event = SQSEvent(strict=True).load(event).data
+    failed = set()
+    records = []
+    # The message each record came from, by the record's index
+    record_messages = []
+    for message in event['messages']:
+        try:
+            s3_event = json.loads(message['body'])
+            if (isinstance(s3_event, dict) and
+                    s3_event.get('Event') == S3_TEST_EVENT):
+                logger.info("Ignoring test event message_id=%s",
+                            message['message_id'])
+                continue
+            if not isinstance(s3_event, dict) or 'Records' not in s3_event:
+                raise ValueError("Not an S3 event notification")
+            s3_event = S3Event(strict=True).load(s3_event).data
+        except (TypeError, ValueError,
+                marshmallow.exceptions.ValidationError) as e:
+            logger.error("Couldn't read message_id=%s",
+                         message['message_id'], exc_info=e)
+            failed.add(message['message_id'])
+            continue
+        records.extend(s3_event['records'])
+        record_messages.extend(
+            [message['message_id']] * len(s3_event['records']))
+
+    results = process_records(env, records, deadline=Deadline(context, env))
+    for (message_id, result) in zip(record_messages, results):
+        if is_failure(result):
+            failed.add(message_id)
+
+    return {
+        "batchItemFailures": [
+            {"itemIdentifier": message['message_id']}
+            for message in event['messages']
+            if message['message_id'] in failed
+        ]
+    }
+
+
+def is_failure(result):
+    """Whether a record's entry in process_records' result is an error."""
+    return isinstance(result, dict) and 'error' in result
 
-    ret = []
-
-    for record in event['records']:
-        bucket = record['s3']['bucket']['name']
-        key = record['s3']['object']['key']
-        logger.info("Retrieving from S3 bucket=%s key=%s",
-                    bucket, key)
-        (localfile, filename) = retrieve_xpi(record)
-        logger.info("Retrieved S3 bucket=%s key=%s => localfile=%s",
-                    bucket, key, localfile.name)
-        guid = get_guid(localfile)
-        logger.info("Retrieved extension ID for localfile=%s => guid=%s",
-                    localfile.name, guid)
-        verify_extension_id(record, guid)
-        logger.info("Signing localfile=%s guid=%s", localfile.name, guid)
-        signed_xpi = sign_xpi(env, localfile, guid)
-        logger.info("Uploading signed XPI as filename=%s guid=%s",
-                    filename, guid)
-        ret.append(upload(env, open(signed_xpi, 'rb'), filename))
-
-    return ret
-
-
-def upload(env, signed_xpi, filename):
-    bucket = s3.Bucket(env['output_bucket'])
-    bucket.put_object(Body=signed_xpi, Key=filename)
+
+def is_retryable_failure(result):
+    """Whether a record failed in a way that retrying might fix."""
+    return is_failure(result) and result['error'].get('retryable', False)
+
+
+def error_result(e):
+    """A failed record's entry in process_records' result."""
+    return {
+        "error": {
+            "type": type(e).__name__,
+            "message": str(e),
+            "retryable": is_retryable_error(e),
+        }
+    }
+
+
+def is_retryable_error(e):
+    """Whether an error might go away if its record is tried again.
+
+    That's running out of time, and trouble reaching Autograph, S3 or
+    a URL, as opposed to something wrong with the event or the XPI.
+    """
+    if isinstance(e, (DeadlineExceededError, CircuitOpenError,
+                      AutographResponseError)):
+        return True
+    # Errors from these can only have been raised if they've been
+    # imported, which is only done once they're needed
+    requests = sys.modules.get('requests')
+    if requests is not None:
+        if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+            return True
+        if isinstance(e, requests.HTTPError) and e.response is not None:
+            return is_overloaded_status(e.response.status_code)
+    botocore_exceptions = sys.modules.get('botocore.exceptions')
+    if botocore_exceptions is not None:
+        if isinstance(e, (botocore_exceptions.ConnectionError,
+                          botocore_exceptions.HTTPClientError)):
+            return True
+        if isinstance(e, botocore_exceptions.ClientError):
+            return is_overloaded_status(e.response.get(
+                'ResponseMetadata', {}).get('HTTPStatusCode', 0))
+    return False
+
+
+def is_overloaded_status(status_code):
+    """Whether an HTTP status means the server is overloaded or failing."""
+    return status_code >= 500 or status_code in AUTOGRAPH_RETRY_STATUSES
+
+
+def raise_for_failures(results):
+    """Raise RecordsFailedError if any of an event's records can be retried.
+
+    Lambda only retries an S3-triggered invocation when it raises, so
+    this is what gives records that were left for lack of time, or
+    that couldn't reach Autograph or S3, another go. Records that
+    failed for good (say, because their extension ID doesn't match
+    their key) would only fail again, so if those are all there is,
+    the per-record results are returned as usual.
+
+    The whole event is retried, records that were signed included.
+    With ``REUSE_SIGNED_XPIS`` (the default), those are found in the
+    output bucket (see find_signed_xpi) rather than signed again.
+    """
+    if any(is_retryable_failure(result) for result in results):
+        raise RecordsFailedError(results)
+
+
+def sign_event_record(event):
+    """Convert a SignEvent to the record format process_records takes.
+
+    S3 sources become S3 event records; URL sources become records
+    like {"url": ...}. Either way, the checksum is kept, and the
+    record's eventSource is SIGN_EVENT_SOURCE.
+    """
+    source = event['source']
+    if source.get('url'):
+        record = {'url': source['url']}
+    else:
+        record = {
+            's3': {
+                'bucket': {'name': source['bucket']},
+                'object': {'key': source['key']},
+            }
+        }
+    record['eventSource'] = SIGN_EVENT_SOURCE
+    if event.get('checksum'):
+        record['checksum'] = event['checksum']
+    return record
+
+
+class Deadline(object):
+    """How much time an invocation has left, and what records cost.
+
+    The time left comes from the lambda's context, less
+    ``DEADLINE_MARGIN_MS`` to report back in. A record is estimated to
+    take ``RECORD_BASE_COST_MS``, plus the time to process its S3
+    object's size at ``RECORD_BYTES_PER_SECOND``. (Records from URLs
+    don't have a known size.)
+
+    Without a context, as when run outside of Lambda, there's no
+    deadline.
+    """
+
+    def __init__(self, context, env):
+        self.context = context
+        self.margin_ms = env.get('deadline_margin_ms',
+                                 DEFAULT_DEADLINE_MARGIN_MS)
+        self.base_cost_ms = env.get('record_base_cost_ms',
+                                    DEFAULT_RECORD_BASE_COST_MS)
+        self.bytes_per_second = env.get('record_bytes_per_second',
+                                        DEFAULT_RECORD_BYTES_PER_SECOND)
+
+    def remaining_ms(self):
+        """The time left to start records in, or None if unlimited."""
+        if not hasattr(self.context, 'get_remaining_time_in_millis'):
+            return None
+        return self.context.get_remaining_time_in_millis() - self.margin_ms
+
+    def estimate_ms(self, record):
+        return (self.base_cost_ms +
+                record_size(record) * 1000 / self.bytes_per_second)
+
+    def check(self, record):
+        """Make sure there's time to process a record.
+
+        :raises DeadlineExceededError: if there isn't
+        """
+        remaining_ms = self.remaining_ms()
+        if remaining_ms is None:
+            return
+        estimated_ms = self.estimate_ms(record)
+        if estimated_ms > remaining_ms:
+            raise DeadlineExceededError(estimated_ms, remaining_ms)
+
+
+def record_size(record):
+    """The size of a record's S3 object, if the event gave it, or 0."""
+    return record.get('s3', {}).get('object', {}).get('size') or 0
+
+
+def start_order(records):
+    """The indexes of some records, in the order to start them in.
+
+    That's biggest first: big records take the longest, so starting
+    them last would risk leaving them without time to finish.
+    """
+    return sorted(range(len(records)), key=lambda i: record_size(records[i]),
+                  reverse=True)
+
+
+def describe_record(record):
+    if 'url' in record:
+        return "url={}".format(record['url'])
+    return "S3 bucket={} key={}".format(record['s3']['bucket']['name'],
+                                        record['s3']['object']['key'])
+
+
+def process_records(env, records, raise_errors=False, deadline=None):
+    """Sign and upload the XPIs referenced by some event records.
+
+    Records are downloaded and checked concurrently, up to
+    ``MAX_WORKERS`` at a time. As they become ready, they are signed
+    in batches of up to ``AUTOGRAPH_BATCH_SIZE`` XPIs per Autograph
+    request, and then each signed XPI is written straight into S3 (see
+    upload_signed_xpi).
+
+    A failing record shouldn't keep the rest of its batch from being
+    signed, so errors are logged and reported in that record's entry
+    of the result rather than raised.
+
+    Records whose XPI has already been signed and uploaded (see
+    find_signed_xpi) aren't signed again.
+
+    Every record is timed by stage, and its metrics are logged once
+    it's done (see aws_lambda.metrics). With ``DEBUG_METRICS`` set,
+    they're also added to the record's entry in the result.
+
+    The biggest records are started first, so that they aren't the
+    ones left without enough time. Once the deadline is too close to
+    finish a record, it isn't started, and fails with
+    DeadlineExceededError so that it can be retried.
+
+    :param raise_errors: raise the first failure (once every record
+        has been processed) instead of reporting it
+    :param deadline: a Deadline for the invocation, if it has one
+    """
+    results = [None] * len(records)
+    record_metrics = [metrics.RecordMetrics() for _ in records]
+    errors = []
+    batch_size = env['autograph_batch_size']
+
+    def fail(i, e):
+        logger.error("Failed to sign %s", describe_record(records[i]),
+                     exc_info=e)
+        errors.append(e)
+        results[i] = error_result(e)
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=env['max_workers']) as executor:
+        # Executors start tasks in the order they're submitted
+        prepare_futures = {
+            executor.submit(start_record, env, records[i],
+                            record_metrics[i], deadline): i
+            for i in start_order(records)
+        }
+        sign_futures = {}
+        batch = []
+        for future in concurrent.futures.as_completed(prepare_futures):
+            i = prepare_futures[future]
+            try:
+                prepared = future.result()
+            except Exception as e:
+                fail(i, e)
+                continue
+            if prepared.signed_result is not None:
+                results[i] = prepared.signed_result
+                continue
+            batch.append((i, prepared))
+            if len(batch) == batch_size:
+                sign_futures[executor.submit(
+                    sign_batch, env, batch, record_metrics)] = batch
+                batch = []
+        if batch:
+            sign_futures[executor.submit(
+                sign_batch, env, batch, record_metrics)] = batch
+
+        upload_futures = {}
+        for future in concurrent.futures.as_completed(sign_futures):
+            batch = sign_futures[future]
+            try:
+                signatures = future.result()
+            except Exception as e:
+                for (i, _) in batch:
+                    fail(i, e)
+                continue
+            for ((i, prepared), signature) in zip(batch, signatures):
+                upload_futures[executor.submit(
+                    upload_signed_xpi, env, signature, prepared,
+                    record_metrics[i])] = i
+
+        for future in concurrent.futures.as_completed(upload_futures):
+            i = upload_futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                fail(i, e)
+
+    for (i, record) in enumerate(records):
+        report_metrics(env, record, results[i], record_metrics[i])
+
+    if raise_errors and errors:
+        raise errors[0]
+    return results
+
+
+def report_metrics(env, record, result, record_metrics):
+    """Log a record's metrics, and add them to its result if asked to."""
+    record_metrics.properties['record'] = describe_record(record)
+    if is_failure(result):
+        record_metrics.properties['error'] = result['error']['type']
+    metrics.emit(record_metrics)
+    if env['debug_metrics'] and isinstance(result, dict):
+        result['metrics'] = record_metrics.as_dict()
+
+
+def start_record(env, record, record_metrics, deadline=None):
+    """Prepare a record, if there's still time to process it."""
+    if deadline is not None:
+        deadline.check(record)
+    return prepare_record(env, record, record_metrics)
+
+
+PreparedXPI = collections.namedtuple('PreparedXPI', [
+    'archive',
+    'filename',
+    'guid',
+    'checksum',
+    # If this XPI was already signed, the result of that upload
+    'signed_result',
+])
+
+
+def prepare_record(env, record, record_metrics=None):
+    """Retrieve the XPI for an event record and verify its extension ID.
+
+    The XPI is opened as an XPIArchive, which is then shared by every
+    later stage. If the XPI has already been signed, the archive is
+    closed and the earlier upload is returned as signed_result.
+
+    :param record_metrics: a RecordMetrics to time this record with
+    :return: a PreparedXPI
+    """
+    if record_metrics is None:
+        record_metrics = metrics.RecordMetrics()
+    (localfile, filename, checksum) = retrieve_record(env, record,
+                                                      record_metrics)
+    (archive, guid) = open_record(env, record, localfile, record_metrics)
+    try:
+        signed_result = None
+        if env['reuse_signed_xpis']:
+            signed_result = find_signed_xpi(
+                env, filename, signed_xpi_cache_key(env, checksum, guid))
+    except Exception:
+        archive.close()
+        raise
+    if signed_result is not None:
+        logger.info("Reusing signed XPI for %s", describe_record(record))
+        archive.close()
+    return PreparedXPI(archive, filename, guid, checksum, signed_result)
+
+
+def retrieve_record(env, record, record_metrics):
+    """Download the XPI for an event record, from S3 or a URL.
+
+    :return: (localfile, filename, checksum)
+    """
+    logger.info("Retrieving from %s", describe_record(record))
+    with record_metrics.time('download'):
+        if 'url' in record:
+            return retrieve_url_xpi(
+                env, record['url'], record.get('checksum'),
+                record_metrics=record_metrics)
+        return retrieve_xpi(
+            record, record.get('checksum'),
+            spool_max_size=env['spool_max_size'],
+            config=transfer_config(env), record_metrics=record_metrics,
+            pool_size=s3_pool_size(env))
+
+
+def open_record(env, record, localfile, record_metrics):
+    """Open a retrieved XPI as an XPIArchive and verify its extension ID.
+
+    The file is closed if anything goes wrong.
+
+    :return: (archive, guid)
+    """
+    try:
+        archive = XPIArchive(localfile,
+                             digest_workers=env['digest_workers'],
+                             ignored_filenames=signature_filenames(env))
+    except Exception:
+        localfile.close()
+        raise
+    record_metrics.set_size('entries', len(archive.entries))
+    try:
+        with record_metrics.time('guid'):
+            guid = get_guid(archive)
+        logger.info("Retrieved extension ID for %s => guid=%s",
+                    describe_record(record), guid)
+        if needs_extension_id_check(record):
+            verify_extension_id(record, guid)
+    except Exception:
+        archive.close()
+        raise
+    return (archive, guid)
+
+
+def sign_batch(env, batch, record_metrics=None):
+    """Get signatures for a batch of prepared records.
+
+    The batch is a list of (i, PreparedXPI) pairs. The records'
+    archives are still needed to write the signed XPIs, so they're
+    only closed here if signing fails.
+
+    :param record_metrics: RecordMetrics for every record, by index
+    :returns: each record's signature files, in the same order (see
+        request_xpi_signatures)
+    """
+    batch_metrics = None
+    if record_metrics is not None:
+        batch_metrics = [record_metrics[i] for (i, _) in batch]
+    try:
+        for (_, prepared) in batch:
+            logger.info("Signing filename=%s guid=%s",
+                        prepared.filename, prepared.guid)
+        return request_xpi_signatures(
+            env, [(prepared.archive, prepared.guid)
+                  for (_, prepared) in batch],
+            record_metrics=batch_metrics)
+    except Exception:
+        for (_, prepared) in batch:
+            prepared.archive.close()
+        raise
+
+
+def upload_signed_xpi(env, signatures, prepared, record_metrics=None):
+    """Write a signed copy of a prepared XPI straight into S3.
+
+    The signed XPI is never kept whole, on disk or in memory: parts of
+    it are uploaded while the rest is still being written (see
+    MultipartUploadWriter). Its sha256 and size are worked out along
+    the way, and returned. They're also stored as metadata on the
+    object, though for big XPIs that's only done once the object is in
+    place, and may not happen at all (see
+    MultipartUploadWriter.complete). The cache key is there from the
+    start.
+
+    The prepared XPI's archive is closed once this is done.
+    """
+    if record_metrics is None:
+        record_metrics = metrics.RecordMetrics()
+    logger.info("Uploading signed XPI as filename=%s", prepared.filename)
+    cache_key = signed_xpi_cache_key(env, prepared.checksum, prepared.guid)
+    writer = MultipartUploadWriter(
+        get_s3(s3_pool_size(env)).meta.client, env['output_bucket'],
+        prepared.filename,
+        part_size=env['s3_multipart_chunksize'],
+        threshold=env['s3_multipart_threshold'],
+        max_concurrency=env['s3_max_concurrency'],
+        metadata={SIGNED_XPI_CACHE_KEY_METADATA: cache_key})
+    try:
+        # Time spent waiting for parts to upload counts as writing
+        with record_metrics.time('write'):
+            write_signed_archive(prepared.archive, signatures, writer)
+        with record_metrics.time('upload'):
+            writer.complete()
+    except Exception:
+        writer.abort()
+        raise
+    finally:
+        prepared.archive.close()
+    record_metrics.set_size('output_bytes', writer.size)
 
     return {
         "uploaded": {
-            "bucket": bucket.name,
-            "key": filename,
+            "bucket": env['output_bucket'],
+            "key": prepared.filename,
+            "sha256": writer.hexdigest(),
+            "size": writer.size,
         }
     }
 
 
-def retrieve_xpi(event):
+def signed_xpi_cache_key(env, checksum, guid):
+    """Identify a signed XPI by what went into signing it.
+
+    Signing the same bytes, for the same extension ID, with the same
+    Autograph key produces an equivalent XPI, so there's no need to do
+    it twice.
+    """
+    h = hashlib.sha256()
+    for part in (checksum, env['autograph_key_id'], guid):
+        h.update(part.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def find_signed_xpi(env, filename, cache_key):
+    """Look for a signed XPI uploaded with the given cache key.
+
+    The cache key is stored as metadata on each signed XPI in the
+    output bucket, so this only costs a HEAD request.
+
+    :returns: the result of the earlier upload, or None
+    """
+    import botocore.exceptions
+
+    try:
+        head = get_s3(s3_pool_size(env)).meta.client.head_object(
+            Bucket=env['output_bucket'], Key=filename)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return None
+        raise
+
+    metadata = head['Metadata']
+    if metadata.get(SIGNED_XPI_CACHE_KEY_METADATA) != cache_key:
+        return None
+    uploaded = {
+        "bucket": env['output_bucket'],
+        "key": filename,
+    }
+    # Signed XPIs uploaded before these were recorded don't have them
+    if SHA256_METADATA in metadata:
+        uploaded["sha256"] = metadata[SHA256_METADATA]
+    if SIZE_METADATA in metadata:
+        uploaded["size"] = int(metadata[SIZE_METADATA])
+    return {"uploaded": uploaded}
+
+
+def get_s3(pool_size=S3_MAX_POOL_CONNECTIONS):
+    """Get an S3 resource, creating it on first use.
+
+    All records share this resource's client, and so its connection
+    pool, which keeps up to pool_size connections alive (see
+    s3_pool_size). (Clients, unlike resources, are safe to share
+    between threads.)
+    """
+    with s3_lock:
+        s3 = s3_resources.get(pool_size)
+        if s3 is None:
+            import boto3
+            import botocore.config
+            s3 = boto3.resource('s3', config=botocore.config.Config(
+                max_pool_connections=pool_size))
+            s3_resources[pool_size] = s3
+    return s3
+
+
+def s3_pool_size(env):
+    """How many connections to S3 might be open at once.
+
+    That's up to S3_MAX_CONCURRENCY parts being transferred for each
+    record in progress: up to MAX_WORKERS of them in handle, or
+    ASYNC_CONCURRENCY in the async handler. Fewer, and urllib3 would
+    throw connections away, rather than keep them alive.
+    """
+    return (max(env['max_workers'], env['async_concurrency']) *
+            env['s3_max_concurrency'])
+
+
+def transfer_config(env):
+    """Configure S3 transfers, which are multipart for large XPIs."""
+    import boto3.s3.transfer
+
+    return boto3.s3.transfer.TransferConfig(
+        multipart_threshold=env['s3_multipart_threshold'],
+        multipart_chunksize=env['s3_multipart_chunksize'],
+        max_concurrency=env['s3_max_concurrency'],
+        io_chunksize=CHUNK_SIZE)
+
+
+def retrieve_xpi(event, checksum=None,
+                 spool_max_size=DEFAULT_SPOOL_MAX_SIZE, config=None,
+                 record_metrics=None, pool_size=S3_MAX_POOL_CONNECTIONS):
     """Download the XPI to some local file, verifying its checksum is correct.
 
+    The checksum is computed as the file is being downloaded, so the
+    XPI is never read back in just to hash it. If no checksum is
+    given, none is verified.
+
     Returns a local "temporary" file containing the XPI as well as its
-    "filename" as best as we could deduce.
+    "filename" as best as we could deduce. The file is kept in memory
+    unless it grows past spool_max_size bytes, in which case it is
+    moved to disk. Closing it deletes it either way.
 
-    :return: (localfile, filename)
+    Large XPIs are downloaded in parts, as determined by config (a
+    TransferConfig). Parts are fetched concurrently but written, and
+    so hashed, in order.
+
+    If record_metrics is given, the time spent hashing and the size of
+    the XPI are recorded in it. pool_size picks the S3 client (see
+    get_s3).
+
+    :return: (localfile, filename, checksum)
 
     """
-    localfile = tempfile.NamedTemporaryFile()
+    localfile = SpooledFile(max_size=spool_max_size)
     s3_data = event['s3']
+    bucket = s3_data['bucket']['name']
     key = s3_data['object']['key']
-    obj = s3.Object(s3_data['bucket']['name'], key)
-    obj.download_fileobj(localfile)
+    hashing_file = HashingWriter(localfile)
+    if config is None:
+        import boto3.s3.transfer
+        config = boto3.s3.transfer.TransferConfig(io_chunksize=CHUNK_SIZE)
+    try:
+        get_s3(pool_size).meta.client.download_fileobj(
+            bucket, key, hashing_file, Config=config)
+    except Exception:
+        localfile.close()
+        raise
+    hashing_file.record(record_metrics)
+    if checksum is not None and hashing_file.hexdigest() != checksum:
+        localfile.close()
+        raise ChecksumMatchError('s3://{}/{}'.format(bucket, key),
+                                 checksum, hashing_file.hexdigest())
     filename = key
     if '/' in filename:
         (_, filename) = key.rsplit('/', 1)
 
-    return localfile, filename
+    return localfile, filename, hashing_file.hexdigest()
+
+
+def retrieve_url_xpi(env, url, checksum=None, record_metrics=None):
+    """Download the XPI at a URL, like retrieve_xpi does for S3.
+
+    The response is streamed in CHUNK_SIZE chunks, hashed as it
+    arrives, and abandoned as soon as it grows past
+    ``DOWNLOAD_MAX_SIZE``. The filename comes from the
+    Content-Disposition header if there is one, or else from the URL.
+
+    :return: (localfile, filename, checksum)
+    """
+    max_size = env['download_max_size']
+    localfile = SpooledFile(max_size=env['spool_max_size'])
+    hashing_file = HashingWriter(localfile)
+    try:
+        with get_download_session(env).get(
+                url, stream=True, timeout=env['download_timeout']) as resp:
+            resp.raise_for_status()
+            if int(resp.headers.get('Content-Length', 0)) > max_size:
+                raise XPITooLargeError(url, max_size)
+            size = 0
+            for chunk in resp.iter_content(CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_size:
+                    raise XPITooLargeError(url, max_size)
+                hashing_file.write(chunk)
+        hashing_file.record(record_metrics)
+        if checksum is not None and hashing_file.hexdigest() != checksum:
+            raise ChecksumMatchError(url, checksum, hashing_file.hexdigest())
+        filename = extract_response_filename(resp)
+        if not filename:
+            filename = unquote(urlparse(url).path)
+        # Never let the source choose a directory in the output bucket
+        (_, _, filename) = filename.rpartition('/')
+        if not filename:
+            raise FilenameMissingError(url)
+    except Exception:
+        localfile.close()
+        raise
+
+    return localfile, filename, hashing_file.hexdigest()
+
+
+def get_download_session(env):
+    """Get a pooled, keep-alive session for downloading XPIs."""
+    import requests
+    import requests.adapters
+
+    pool_size = env['max_workers']
+    with download_sessions_lock:
+        session = download_sessions.get(pool_size)
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            download_sessions[pool_size] = session
+    return session
+
+
+class SpooledFile(tempfile.SpooledTemporaryFile):
+    """A SpooledTemporaryFile that zipfile can read.
+
+    Since Python 3.7, zipfile asks the files it reads whether they're
+    seekable, which SpooledTemporaryFile can only answer from Python
+    3.11 on.
+    """
+    def readable(self):
+        return self._file.readable()
+
+    def seekable(self):
+        return self._file.seekable()
+
+    def writable(self):
+        return self._file.writable()
+
+
+class HashingWriter(object):
+    """A write-only file wrapper that hashes whatever is written to it.
+
+    It is deliberately not seekable, so that boto3 writes the parts of
+    a download in order rather than wherever they belong.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        # Always use sha256 for now
+        self.hash = hashlib.sha256()
+        self.size = 0
+        # Seconds spent hashing, as opposed to writing
+        self.hash_time = 0
+
+    def write(self, data):
+        start = time.perf_counter()
+        self.hash.update(data)
+        self.hash_time += time.perf_counter() - start
+        self.size += len(data)
+        return self.fileobj.write(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+    def record(self, record_metrics):
+        """Add the hashing time and size to a RecordMetrics, if any."""
+        if record_metrics is None:
+            return
+        record_metrics.add_time('checksum', self.hash_time)
+        record_metrics.set_size('input_bytes', self.size)
 
 
 def extract_response_filename(response):
-    """Extract the content-disposition filename, or None if we can't."""
+    """Extract the content-disposition filename, or None if we can't.
+
+    As RFC 6266 says, an encoded ``filename*`` parameter (see RFC
+    5987) is preferred to a plain ``filename`` if it can be decoded.
+    Parameters without a value are skipped.
+    """
     content_disposition = response.headers.get('Content-Disposition')
     if not content_disposition:
         return None
@@ -209,26 +1213,49 @@ def extract_response_filename(response):
     if parameters[0].strip() != 'attachment':
         return None
 
+    values = {}
     for parameter in parameters[1:]:
-        name, value = parameter.strip().split('=', 1)
-        if name == 'filename':
-            return email.utils.unquote(value)
-
+        (name, equals, value) = parameter.strip().partition('=')
+        if equals:
+            values.setdefault(name.strip().lower(), value.strip())
+
+    if 'filename*' in values:
+        (charset, _, value) = email.utils.decode_rfc2231(
+            email.utils.unquote(values['filename*']))
+        try:
+            return unquote_to_bytes(value).decode(charset or 'utf-8')
+        except (LookupError, UnicodeDecodeError):
+            pass
+    if 'filename' in values:
+        return email.utils.unquote(values['filename'])
     return None
 
 
 def compute_checksum(contents):
     # Always use sha256 for now
     h = hashlib.sha256()
-    h.update(contents.read())
+    for chunk in iter(functools.partial(contents.read, CHUNK_SIZE), b''):
+        h.update(chunk)
     return h.hexdigest()
 
 
-def get_guid(xpi_file):
-    ext_id = get_extension_id(zipfile.ZipFile(xpi_file))
+def get_guid(archive):
+    ext_id = get_extension_id(archive)
     if len(ext_id) <= 64:
         return ext_id
-    return hashlib.sha256(ext_id).hexdigest()
+    return hashlib.sha256(ext_id.encode('utf-8')).hexdigest()
+
+
+def needs_extension_id_check(record):
+    """Whether a record's XPI must be under a directory named after its ID.
+
+    That's only for XPIs dropped into S3 to trigger the lambda. Sign
+    events come from callers that may invoke the lambda, and so may
+    sign any XPI; the CLI uploads XPIs without the ID in their path.
+    URL sources don't have a path to check at all.
+    """
+    return ('url' not in record and
+            record.get('eventSource') != SIGN_EVENT_SOURCE)
 
 
 def verify_extension_id(event, xpi_id):
@@ -263,23 +1290,77 @@ def get_extension_id_json(manifest_json):
     return ext_id
 
 
-INSTALL_RDF_MANIFEST = rdflib.term.URIRef(u'urn:mozilla:install-manifest')
+RDF_NAMESPACE = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'
+INSTALL_RDF_MANIFEST = 'urn:mozilla:install-manifest'
 INSTALL_RDF_NAMESPACE = 'http://www.mozilla.org/2004/em-rdf'
-INSTALL_RDF_ID_PREDICATE = rdflib.term.URIRef(
-    '{}#{}'.format(INSTALL_RDF_NAMESPACE, "id"))
+INSTALL_RDF_ID_PREDICATE = '{}#{}'.format(INSTALL_RDF_NAMESPACE, "id")
 
 
 def get_extension_id_rdf(install_rdf):
+    """Get the extension ID from an install.rdf file.
+
+    Almost every install.rdf gives the ID directly on the Description
+    of the install manifest, which we can find just by scanning the
+    XML. Anything more unusual is handed over to rdflib, which is
+    slow to import and so only loaded when it's needed.
+    """
+    contents = install_rdf.read()
+    if isinstance(contents, str):
+        contents = contents.encode('utf-8')
+    ext_id = get_extension_id_rdf_fast(contents)
+    if ext_id is None:
+        logger.info("Falling back to rdflib to find extension ID")
+        ext_id = get_extension_id_rdf_graph(contents)
+    return ext_id
+
+
+def get_extension_id_rdf_fast(contents):
+    """Scan install.rdf for the extension ID without building a graph.
+
+    This understands em:id given as either a child element or an
+    attribute of any node whose about is the install manifest.
+
+    :returns: the ID, or None if it couldn't be found this way
+    """
+    about_attributes = ('about', '{{{}}}about'.format(RDF_NAMESPACE))
+    id_tag = '{{{}#}}id'.format(INSTALL_RDF_NAMESPACE)
+    ids = set()
+    try:
+        for (_, element) in ElementTree.iterparse(io.BytesIO(contents)):
+            about = [element.get(name) for name in about_attributes]
+            if INSTALL_RDF_MANIFEST not in about:
+                continue
+            if id_tag in element.attrib:
+                ids.add(element.get(id_tag))
+            for child in element.findall(id_tag):
+                if child.attrib or len(child):
+                    # A resource or some nested structure: not the
+                    # simple literal we're looking for
+                    return None
+                ids.add(child.text or '')
+    except ElementTree.ParseError:
+        return None
+
+    if len(ids) != 1:
+        return None
+    return ids.pop()
+
+
+def get_extension_id_rdf_graph(contents):
     # This is based off of code in AMO's utils.py. See:
     # https://github.com/mozilla/addons-server/blob/f554850626c2940d66f71b8f72ce86544e58bbd3/src/olympia/files/utils.py
+    import rdflib
+
+    manifest = rdflib.term.URIRef(INSTALL_RDF_MANIFEST)
     graph = rdflib.Graph()
-    graph.load(install_rdf)
-    if list(graph.triples((INSTALL_RDF_MANIFEST, None, None))):
-        root = INSTALL_RDF_MANIFEST
+    graph.load(io.BytesIO(contents))
+    if list(graph.triples((manifest, None, None))):
+        root = manifest
     else:
-        root = graph.subjects(None, INSTALL_RDF_MANIFEST).next()
+        root = next(graph.subjects(None, manifest))
 
-    id_object = next(graph.objects(root, INSTALL_RDF_ID_PREDICATE))
+    id_object = next(graph.objects(
+        root, rdflib.term.URIRef(INSTALL_RDF_ID_PREDICATE)))
     # This is an rdflib.term.Literal, which is a subclass of Unicode
     return str(id_object)
 
@@ -288,36 +1369,364 @@ def sign_xpi(env, localfile, guid):
     """
     Use the Autograph service to sign the XPI.
 
-    :returns: filename of the signed XPI
+    :returns: a temporary file containing the signed XPI
     """
-    xpi_file = XPIFile(localfile)
-    auth = HawkAuth(id=env['autograph_hawk_id'],
-                    key=env['autograph_hawk_secret'])
-    b64_payload = base64.b64encode(xpi_file.signature.encode('utf-8'))
-    url = urljoin(env['autograph_server_url'], '/sign/data')
-    key_id = env['autograph_key_id']
-    resp = requests.post(url, auth=auth, json=[{
-        "input": b64_payload.decode('utf-8'),
-        "keyid": key_id,
+    archive = XPIArchive(localfile,
+                         ignored_filenames=signature_filenames(env))
+    return sign_xpis(env, [(archive, guid)])[0]
+
+
+def sign_xpis(env, xpis, record_metrics=None):
+    """
+    Use the Autograph service to sign several XPIs.
+
+    Signature inputs are sent to Autograph in batches of up to
+    ``autograph_batch_size`` XPIs per request, rather than one
+    request per XPI.
+
+    :param xpis: a list of (XPIArchive, guid) pairs
+    :param record_metrics: a RecordMetrics for each XPI, in the same order.
+        Every XPI in an Autograph request is charged the time of the
+        whole request.
+    :returns: temporary files containing the signed XPIs, in the same
+        order. These are spooled like the files from retrieve_xpi;
+        it's up to the caller to close them.
+    """
+    if record_metrics is None:
+        record_metrics = [metrics.RecordMetrics() for _ in xpis]
+    signatures = request_xpi_signatures(env, xpis, record_metrics)
+
+    spool_max_size = env.get('spool_max_size', DEFAULT_SPOOL_MAX_SIZE)
+    signed_xpis = []
+    try:
+        for ((archive, _), xpi_signatures, xpi_metrics) in zip(
+                xpis, signatures, record_metrics):
+            with xpi_metrics.time('write'):
+                signed_xpi = write_signed_xpi(archive, xpi_signatures,
+                                              spool_max_size)
+            signed_xpis.append(signed_xpi)
+            xpi_metrics.set_size('output_bytes', file_size(signed_xpi))
+    except Exception:
+        for signed_xpi in signed_xpis:
+            signed_xpi.close()
+        raise
+    return signed_xpis
+
+
+def request_xpi_signatures(env, xpis, record_metrics=None):
+    """Get Autograph's signatures of several XPIs, for every key.
+
+    This is the part of sign_xpis that comes before writing anything:
+    the manifests are computed once per XPI, and sent to Autograph in
+    batches of up to ``autograph_batch_size`` XPIs per request.
+
+    With more than one key (see parse_signing_keys), this takes two
+    rounds of requests: the other keys sign each XPI's manifest.mf
+    first, and then the first key signs a mozilla.sf that covers
+    their files. All of an XPI's inputs for a round go in the same
+    request.
+
+    :param xpis: a list of (XPIArchive, guid) pairs
+    :param record_metrics: a RecordMetrics for each XPI, in the same order
+    :returns: for each XPI, in the same order, a list of (filename,
+        contents) pairs for the files in META-INF that signing adds,
+        with mozilla.rsa first (see signed_files)
+    """
+    if record_metrics is None:
+        record_metrics = [metrics.RecordMetrics() for _ in xpis]
+    keys = signing_keys(env)
+    extra_files = [[] for _ in xpis]
+    if len(keys) > 1:
+        sign_inputs = []
+        for ((archive, guid), xpi_metrics) in zip(xpis, record_metrics):
+            with xpi_metrics.time('digest'):
+                manifest = archive.manifest
+            sign_inputs.append(make_extra_sign_inputs(env, manifest, guid))
+        extra_files = [
+            extra_signature_files(env, archive.manifest, signatures)
+            for ((archive, _), signatures) in zip(
+                xpis, request_batched_signatures(env, sign_inputs,
+                                                 record_metrics))
+        ]
+
+    sign_inputs = []
+    for ((archive, guid), files, xpi_metrics) in zip(
+            xpis, extra_files, record_metrics):
+        with xpi_metrics.time('digest'):
+            signature = archive.signature_with(files)
+        sign_inputs.append(make_sign_inputs(env, signature, guid))
+    return [
+        signed_files(env, signature, files)
+        for ([signature], files) in zip(
+            request_batched_signatures(env, sign_inputs, record_metrics),
+            extra_files)
+    ]
+
+
+def request_batched_signatures(env, sign_inputs, record_metrics):
+    """Send some XPIs' signature inputs to Autograph, a batch at a time.
+
+    :param sign_inputs: a list of each XPI's inputs
+    :param record_metrics: a RecordMetrics for each XPI, in the same order
+    :returns: a list of each XPI's signatures, in the same order
+    """
+    batch_size = env.get('autograph_batch_size', DEFAULT_AUTOGRAPH_BATCH_SIZE)
+    signatures = []
+    for start in range(0, len(sign_inputs), batch_size):
+        request_start = time.perf_counter()
+        batch = sign_inputs[start:start + batch_size]
+        batch_signatures = request_signatures(
+            env, [sign_input for xpi_inputs in batch
+                  for sign_input in xpi_inputs])
+        offset = 0
+        for xpi_inputs in batch:
+            signatures.append(
+                batch_signatures[offset:offset + len(xpi_inputs)])
+            offset += len(xpi_inputs)
+        elapsed = time.perf_counter() - request_start
+        for xpi_metrics in record_metrics[start:start + batch_size]:
+            xpi_metrics.add_time('autograph', elapsed)
+            record_limiter_state(env, xpi_metrics)
+    return signatures
+
+
+def record_limiter_state(env, record_metrics):
+    """Add the Autograph limiter's current state to a RecordMetrics."""
+    limiter_state = get_autograph_limiter(env).state()
+    record_metrics.set_gauge('autograph_limit', limiter_state['limit'])
+    record_metrics.set_gauge('autograph_in_flight',
+                             limiter_state['in_flight'])
+    record_metrics.properties['autograph_circuit'] = limiter_state['circuit']
+
+
+def make_sign_input(key, data, guid):
+    """The /sign/data input for one key to sign some text."""
+    return {
+        "input": base64.b64encode(data.encode('utf-8')).decode('utf-8'),
+        "keyid": key.key_id,
         "options": {
             "id": guid,
         }
-    }])
+    }
+
+
+def make_sign_inputs(env, signature, guid):
+    """The /sign/data inputs for an XPI's mozilla.sf.
+
+    Only the first key signs it; see parse_signing_keys.
+    """
+    return [make_sign_input(signing_keys(env)[0], signature, guid)]
+
+
+def make_extra_sign_inputs(env, manifest, guid):
+    """The /sign/data inputs for the other keys, which sign manifest.mf."""
+    return [make_sign_input(key, manifest, guid)
+            for key in signing_keys(env)[1:]]
+
+
+def extra_signature_files(env, manifest, signatures):
+    """The files for the other keys' signatures of an XPI's manifest.mf.
+
+    :returns: (filename, contents) pairs, as XPIArchive.manifest_with
+        takes: each key's copy of the manifest, and then its signature
+    """
+    files = []
+    for (key, signature) in zip(signing_keys(env)[1:], signatures):
+        files.append((key.manifest_filename, manifest.encode('utf-8')))
+        files.append((key.filename, signature))
+    return files
+
+
+def signed_files(env, signature, extra_files):
+    """All of the files that signing adds to an XPI's META-INF.
+
+    write_signed_archive lists everything but mozilla.rsa in
+    manifest.mf, so these need to be the extra_files that were used to
+    get mozilla.rsa's signature.
+    """
+    return [(signing_keys(env)[0].filename, signature)] + extra_files
+
+
+def signature_filenames(env):
+    """The files in META-INF that signing an XPI writes."""
+    return frozenset(all_signature_filenames(signing_keys(env)))
+
+
+def file_size(fileobj):
+    """The size of a file, leaving its position where it was."""
+    position = fileobj.tell()
+    size = fileobj.seek(0, io.SEEK_END)
+    fileobj.seek(position)
+    return size
+
+
+def request_signatures(env, sign_inputs):
+    """Make one /sign/data request to Autograph.
+
+    :returns: the decoded signatures, in the same order as the inputs
+    """
+    url = urljoin(env['autograph_server_url'], '/sign/data')
+    resp = post_with_retries(env, get_autograph_session(env), url,
+                             sign_inputs)
     resp.raise_for_status()
-    signature = base64.b64decode(resp.json()[0]['signature'])
-
-    # FIXME: make_signed doesn't support NamedTemporaryFile or
-    # anything like that; we have to provide an actual filename.
-    # Try to generate a sensible filename.
-    # FIXME: I guess the caller has to remember to delete this file.
-    # Hopefully there's no other calls to a similarly-named file??
-    (localstem, localext) = os.path.splitext(localfile.name)
-    output_file = localstem + '-signed' + localext
-
-    xpi_file.make_signed(output_file, sigpath="mozilla.rsa",
-                         signed_manifest=xpi_file.signature,
-                         signature=signature)
-    return output_file
+    responses = resp.json()
+    if len(responses) != len(sign_inputs):
+        raise AutographResponseError(len(sign_inputs), len(responses))
+    return [base64.b64decode(response['signature'])
+            for response in responses]
+
+
+def get_autograph_session(env):
+    """Get a pooled, keep-alive session for talking to Autograph."""
+    import requests
+    import requests.adapters
+    from requests_hawk import HawkAuth
+
+    pool_size = env.get('autograph_pool_size', DEFAULT_AUTOGRAPH_POOL_SIZE)
+    session_key = (env['autograph_hawk_id'], env['autograph_hawk_secret'],
+                   pool_size)
+    with autograph_sessions_lock:
+        session = autograph_sessions.get(session_key)
+        if session is None:
+            session = requests.Session()
+            session.auth = HawkAuth(id=env['autograph_hawk_id'],
+                                    key=env['autograph_hawk_secret'])
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                    pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            autograph_sessions[session_key] = session
+    return session
+
+
+def get_autograph_limiter(env):
+    """Get the AdaptiveLimiter for requests to Autograph.
+
+    Like the sessions, limiters live at module level, so that every
+    record, and every warm invocation, shares what's been learned
+    about how much Autograph can take.
+    """
+    settings = (
+        env['autograph_server_url'],
+        env.get('autograph_max_concurrency', DEFAULT_AUTOGRAPH_POOL_SIZE),
+        env.get('autograph_latency_target',
+                DEFAULT_AUTOGRAPH_LATENCY_TARGET),
+        env.get('autograph_circuit_threshold',
+                DEFAULT_AUTOGRAPH_CIRCUIT_THRESHOLD),
+        env.get('autograph_circuit_cooldown',
+                DEFAULT_AUTOGRAPH_CIRCUIT_COOLDOWN),
+    )
+    with autograph_limiters_lock:
+        limiter = autograph_limiters.get(settings)
+        if limiter is None:
+            limiter = AdaptiveLimiter(*settings[1:])
+            autograph_limiters[settings] = limiter
+    return limiter
+
+
+def post_with_retries(env, session, url, json):
+    """POST to Autograph, retrying connection errors, 429s and 5xxs.
+
+    Retries are done here rather than by urllib3, because every
+    attempt needs a fresh Hawk header -- Autograph rejects a replayed
+    nonce. Attempts are spaced out using "full jitter" exponential
+    backoff.
+
+    Every attempt goes through the Autograph limiter (see
+    get_autograph_limiter), which may hold it back, or fail it with
+    CircuitOpenError while Autograph is down.
+    """
+    import requests
+
+    retries = env.get('autograph_retries', DEFAULT_AUTOGRAPH_RETRIES)
+    backoff = env.get('autograph_retry_backoff',
+                      DEFAULT_AUTOGRAPH_RETRY_BACKOFF)
+    timeout = (
+        env.get('autograph_connect_timeout',
+                DEFAULT_AUTOGRAPH_CONNECT_TIMEOUT),
+        env.get('autograph_read_timeout', DEFAULT_AUTOGRAPH_READ_TIMEOUT),
+    )
+    limiter = get_autograph_limiter(env)
+    attempt = 0
+    while True:
+        limiter.acquire()
+        start = time.perf_counter()
+        # Anything short of a response, even an error that isn't worth
+        # retrying, counts against Autograph. Either way, the slot is
+        # always given back.
+        overloaded = True
+        try:
+            resp = session.post(url, json=json, timeout=timeout)
+            overloaded = is_overloaded_status(resp.status_code)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt >= retries:
+                raise
+            logger.warning("Autograph request to url=%s failed: %s",
+                           url, e)
+        else:
+            if not overloaded or attempt >= retries:
+                return resp
+            logger.warning("Autograph request to url=%s failed with "
+                           "status=%s", url, resp.status_code)
+        finally:
+            limiter.release(time.perf_counter() - start, overloaded)
+        time.sleep(random.uniform(0, backoff * 2 ** attempt))
+        attempt += 1
+
+
+def write_signed_xpi(archive, signatures,
+                     spool_max_size=DEFAULT_SPOOL_MAX_SIZE):
+    """Write out a signed copy of an XPIArchive.
+
+    This produces the same archive as XPIFile.make_signed, except
+    that the XPI's entries are copied over without being recompressed
+    (see XPIArchive.copy_entry), and that make_signed can only write
+    to a new file on disk. Instead, we write to a spooled temporary
+    file.
+
+    :returns: a temporary file containing the signed XPI
+    """
+    signed_file = SpooledFile(max_size=spool_max_size)
+    try:
+        write_signed_archive(archive, signatures, signed_file)
+    except Exception:
+        signed_file.close()
+        raise
+    signed_file.seek(0)
+    return signed_file
+
+
+def write_signed_archive(archive, signatures, fileobj):
+    """Write a signed copy of an XPIArchive to a file object.
+
+    Everything is written in order, so fileobj only needs ``write``
+    and ``tell``, and can be a MultipartUploadWriter.
+
+    :param signatures: (filename, contents) pairs, as from
+        request_xpi_signatures, with mozilla.rsa first. The others are
+        listed in manifest.mf.
+    """
+    from sign_xpi_lib.sign_xpi_lib import ignore_certain_metainf_files
+
+    filenames = {filename for (filename, _) in signatures}
+    extra_files = signatures[1:]
+    with zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED) as zout:
+        # The PKCS7 file ("mozilla.rsa") *MUST* be the first file
+        # in the archive to take advantage of Firefox's optimized
+        # downloading of XPIs
+        for (filename, signature) in signatures:
+            write_entry(zout, filename, signature)
+        for entry in archive.entries:
+            # Make sure we exclude any of our signature and
+            # manifest files
+            if (ignore_certain_metainf_files(entry.filename) or
+                    entry.filename in filenames):
+                continue
+            archive.copy_entry(zout, entry)
+        manifest = archive.manifest_with(extra_files)
+        write_entry(zout, "META-INF/manifest.mf", manifest.encode('utf-8'))
+        write_entry(zout, "META-INF/mozilla.sf",
+                    signature_for(manifest).encode('utf-8'))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,450 @@
+"""A long-running worker that signs XPIs, as an alternative to Lambda.
+
+For bulk re-signing, it can be cheaper and faster to run on one big
+machine than to pay for a Lambda invocation per event. The worker
+pulls events from either an SQS queue of S3 notifications, or a local
+spool directory of event files, and handles each one on a pool of
+processes sized to the machine, so that archive work uses every core.
+Each process keeps its S3 and Autograph connections warm between
+events.
+
+It's configured with the same environment as the lambda. To run it::
+
+  python -m aws_lambda.worker --spool-dir /var/spool/sign-xpi
+  python -m aws_lambda.worker --queue-url https://sqs...
+
+SIGTERM or SIGINT stop it from taking new events; it exits once the
+events in progress are done. While it runs, ``/health`` and
+``/metrics`` are served on ``--port`` (8080 by default).
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import http.server
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+from aws_lambda import sign_xpi
+
+DEFAULT_PORT = 8080
+DEFAULT_POLL_INTERVAL = 1.0
+# How long SQS waits for messages before returning none
+SQS_WAIT_TIME = 20
+SQS_MAX_MESSAGES = 10
+# Spooled events are claimed by renaming <name>.json to
+# <name>.json.<pid>@<host>.processing
+EVENT_SUFFIX = '.json'
+CLAIM_SUFFIX = '.processing'
+
+logger = logging.getLogger(__name__)
+
+
+SHUTDOWN_SIGNALS = (signal.SIGINT, signal.SIGTERM)
+
+
+def init_process():
+    """Leave signals to the main process, which shuts down gracefully."""
+    for signum in SHUTDOWN_SIGNALS:
+        signal.signal(signum, signal.SIG_IGN)
+
+
+def make_pool(processes):
+    """Start a pool of processes that run init_process first.
+
+    ProcessPoolExecutor only takes an initializer from Python 3.7. On
+    3.6, the signals are ignored here while the pool starts instead,
+    and the processes inherit that when they're forked. (3.6 starts
+    every process of a pool on its first task.)
+    """
+    if sys.version_info >= (3, 7):
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=processes, initializer=init_process)
+
+    handlers = {signum: signal.signal(signum, signal.SIG_IGN)
+                for signum in SHUTDOWN_SIGNALS}
+    try:
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=processes)
+        pool.submit(os.getpid).result()
+    finally:
+        for (signum, handler) in handlers.items():
+            signal.signal(signum, handler)
+    return pool
+
+
+def handle_event(event, env):
+    """Handle one event, in a pool process."""
+    return sign_xpi.handle(event, None, env)
+
+
+def handle_sqs_event(event, env):
+    """Handle a batch of SQS messages, in a pool process."""
+    return sign_xpi.handle_sqs(event, None, env)
+
+
+class SpoolSource(object):
+    """Events from JSON files dropped into a directory.
+
+    Each file holds one event, in any form the lambda accepts. It's
+    claimed by renaming it, with the claiming process's ID and host in
+    the new name, so that several workers can share a directory. Once
+    handled, the event's result is written to ``done/`` (or
+    ``failed/``, if it raised) under the same name.
+
+    A worker that dies with events in progress leaves their claims
+    behind. When a worker starts, it puts back any claims made on its
+    host by processes that are gone (see requeue_stale_claims).
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.done = os.path.join(directory, 'done')
+        self.failed = os.path.join(directory, 'failed')
+        for path in (self.done, self.failed):
+            os.makedirs(path, exist_ok=True)
+        self.claimant = '{}@{}'.format(os.getpid(), socket.gethostname())
+        self.requeued = self.requeue_stale_claims()
+
+    def requeue_stale_claims(self):
+        """Put back the events claimed by processes that are gone.
+
+        Only claims made on this host can be checked. Those made by an
+        earlier version, which didn't say who made them, are put back
+        too.
+
+        :returns: how many events were put back
+        """
+        requeued = 0
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(CLAIM_SUFFIX):
+                continue
+            (event_name, claimant) = parse_claim(name)
+            if claimant is not None and not self.is_stale(claimant):
+                continue
+            try:
+                os.rename(os.path.join(self.directory, name),
+                          os.path.join(self.directory, event_name))
+            except FileNotFoundError:
+                # Another worker got there first
+                continue
+            logger.warning("Requeued event %s, claimed by %s", event_name,
+                           claimant or "an earlier worker")
+            requeued += 1
+        return requeued
+
+    def is_stale(self, claimant):
+        (pid, _, host) = claimant.partition('@')
+        if host != socket.gethostname() or not pid.isdigit():
+            return False
+        # This process hasn't claimed anything yet, so a claim in its
+        # name is from an earlier one that had the same ID
+        return int(pid) == os.getpid() or not is_running(int(pid))
+
+    def status(self):
+        return {"requeued": self.requeued}
+
+    def receive(self, max_events):
+        """Claim up to max_events events.
+
+        :returns: a list of (event, token) pairs, the token being what
+            to pass to complete
+        """
+        claimed = []
+        for name in sorted(os.listdir(self.directory)):
+            if len(claimed) >= max_events:
+                break
+            path = os.path.join(self.directory, name)
+            if not name.endswith(EVENT_SUFFIX) or not os.path.isfile(path):
+                continue
+            claimed_path = '{}.{}{}'.format(path, self.claimant, CLAIM_SUFFIX)
+            try:
+                os.rename(path, claimed_path)
+            except FileNotFoundError:
+                # Another worker got there first
+                continue
+            try:
+                with open(claimed_path) as f:
+                    event = json.load(f)
+            except ValueError as e:
+                self.finish(claimed_path, self.failed, {"error": str(e)})
+                continue
+            claimed.append((event, claimed_path))
+        return claimed
+
+    def complete(self, token, result, error=None):
+        if error is not None:
+            failure = {
+                "error": {"type": type(error).__name__,
+                          "message": str(error)},
+            }
+            # Keep the results of the records that didn't fail, too
+            if isinstance(error, sign_xpi.RecordsFailedError):
+                failure["results"] = error.results
+            self.finish(token, self.failed, failure)
+        else:
+            self.finish(token, self.done, result)
+
+    def finish(self, claimed_path, directory, result):
+        (name, _) = parse_claim(os.path.basename(claimed_path))
+        with open(os.path.join(directory, name), 'w') as f:
+            json.dump(result, f)
+        os.remove(claimed_path)
+
+    handler = staticmethod(handle_event)
+
+
+def parse_claim(name):
+    """Split a claimed event's filename into (event filename, claimant).
+
+    The claimant is None for claims made before they were recorded.
+    """
+    name = name[:-len(CLAIM_SUFFIX)]
+    if name.endswith(EVENT_SUFFIX):
+        return (name, None)
+    (event_name, _, claimant) = name.rpartition(EVENT_SUFFIX + '.')
+    return (event_name + EVENT_SUFFIX, claimant)
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # It's someone else's
+        return True
+    return True
+
+
+class SQSSource(object):
+    """Batches of S3 notifications from an SQS queue.
+
+    Each batch of messages is handled like the lambda's SQS trigger
+    (see sign_xpi.handle_sqs). Messages that were handled are deleted;
+    failed ones are left for SQS to redeliver.
+    """
+
+    def __init__(self, queue_url, client=None):
+        self.queue_url = queue_url
+        if client is None:
+            import boto3
+            client = boto3.client('sqs')
+        self.client = client
+
+    def receive(self, max_events):
+        # One "event" here is a whole batch of messages
+        response = self.client.receive_message(
+            QueueUrl=self.queue_url, WaitTimeSeconds=SQS_WAIT_TIME,
+            MaxNumberOfMessages=SQS_MAX_MESSAGES)
+        messages = response.get('Messages', [])
+        if not messages:
+            return []
+        event = {
+            "Records": [
+                {"messageId": message['MessageId'],
+                 "body": message['Body']}
+                for message in messages
+            ]
+        }
+        receipts = {message['MessageId']: message['ReceiptHandle']
+                    for message in messages}
+        return [(event, receipts)]
+
+    def complete(self, token, result, error=None):
+        if error is not None:
+            # Leave the whole batch to be redelivered
+            return
+        failed = {failure['itemIdentifier']
+                  for failure in result['batchItemFailures']}
+        entries = [
+            {"Id": str(n), "ReceiptHandle": receipt}
+            for (n, (message_id, receipt)) in enumerate(sorted(
+                token.items()))
+            if message_id not in failed
+        ]
+        if entries:
+            self.client.delete_message_batch(QueueUrl=self.queue_url,
+                                             Entries=entries)
+
+    def status(self):
+        return {}
+
+    handler = staticmethod(handle_sqs_event)
+
+
+class Worker(object):
+    """Take events from a source and handle them on an executor.
+
+    :param source: a SpoolSource or SQSSource
+    :param env: the lambda's environment settings
+    :param executor: where to handle events. This is normally a process
+        pool, with ``max_in_flight`` a small multiple of its size.
+    """
+
+    def __init__(self, source, env, executor, max_in_flight,
+                 poll_interval=DEFAULT_POLL_INTERVAL):
+        self.source = source
+        self.env = env
+        self.executor = executor
+        self.max_in_flight = max_in_flight
+        self.poll_interval = poll_interval
+        self.stopping = threading.Event()
+        # Guards in_flight and counts, and is notified as events finish
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.started = time.time()
+        self.counts = collections.Counter()
+
+    def stop(self):
+        """Stop taking new events. Those in progress are finished."""
+        self.stopping.set()
+
+    def run(self, exit_when_idle=False):
+        """Handle events until stopped, or until the source is empty."""
+        while not self.stopping.is_set():
+            with self.condition:
+                if self.in_flight >= self.max_in_flight:
+                    self.condition.wait(self.poll_interval)
+                    continue
+                free = self.max_in_flight - self.in_flight
+            received = self.source.receive(free)
+            if not received:
+                with self.condition:
+                    idle = self.in_flight == 0
+                if exit_when_idle and idle:
+                    break
+                self.stopping.wait(self.poll_interval)
+                continue
+            for (event, token) in received:
+                self.submit(event, token)
+        self.wait()
+
+    def submit(self, event, token):
+        with self.condition:
+            self.in_flight += 1
+            self.counts['received'] += 1
+        future = self.executor.submit(self.source.handler, event, self.env)
+        future.add_done_callback(
+            lambda future: self.complete(future, token))
+
+    def complete(self, future, token):
+        outcome = 'handled'
+        try:
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error("Failed to handle event", exc_info=e)
+                outcome = 'failed'
+                self.source.complete(token, None, e)
+            else:
+                self.source.complete(token, result)
+        except Exception as e:
+            logger.error("Failed to complete event", exc_info=e)
+            outcome = 'failed'
+        finally:
+            with self.condition:
+                self.in_flight -= 1
+                self.counts[outcome] += 1
+                self.condition.notify_all()
+
+    def wait(self):
+        """Wait for every event in progress to be done."""
+        with self.condition:
+            while self.in_flight:
+                self.condition.wait()
+
+    def status(self):
+        with self.condition:
+            return {
+                "status": "stopping" if self.stopping.is_set() else "ok",
+                "uptime": time.time() - self.started,
+                "in_flight": self.in_flight,
+                "events": dict(self.counts),
+                "source": self.source.status(),
+            }
+
+
+class StatusHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        status = self.server.worker.status()
+        if self.path == '/health':
+            code = 200 if status['status'] == 'ok' else 503
+            body = {"status": status['status']}
+        elif self.path == '/metrics':
+            (code, body) = (200, status)
+        else:
+            (code, body) = (404, {"error": "not found"})
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StatusServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, worker, address):
+        http.server.HTTPServer.__init__(self, address, StatusHandler)
+        self.worker = worker
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Sign XPIs from a queue or spool directory.")
+    source_group = parser.add_mutually_exclusive_group(required=True)
+    source_group.add_argument('--spool-dir',
+                              help="directory of event files to handle")
+    source_group.add_argument('--queue-url',
+                              help="SQS queue of S3 notifications")
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                        help="processes to handle events on")
+    parser.add_argument('--max-in-flight', type=int,
+                        help="events in progress at once (default: twice "
+                             "the number of processes)")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help="port for /health and /metrics")
+    parser.add_argument('--exit-when-idle', action='store_true',
+                        help="exit once the spool directory is empty")
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.INFO)
+    env = dict(os.environ)
+    # Fail now, rather than in every event, if the settings are wrong
+    sign_xpi.Environment(strict=True).load(env)
+    if args.spool_dir:
+        source = SpoolSource(args.spool_dir)
+    else:
+        source = SQSSource(args.queue_url)
+
+    with make_pool(args.processes) as pool:
+        worker = Worker(source, env, pool,
+                        args.max_in_flight or 2 * args.processes)
+        server = StatusServer(worker, (args.host, args.port))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        for signum in SHUTDOWN_SIGNALS:
+            signal.signal(signum, lambda signum, frame: worker.stop())
+        logger.info("Worker started; status on http://%s:%s/",
+                    *server.server_address)
+        try:
+            worker.run(exit_when_idle=args.exit_when_idle)
+        finally:
+            server.shutdown()
+            server.server_close()
+    logger.info("Worker stopped: %s", worker.status()['events'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,4 @@
+"""Benchmarks for the signing pipeline.
+
+These aren't run with the unit tests. See ``make benchmark``.
+"""
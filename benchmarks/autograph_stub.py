@@ -0,0 +1,212 @@
+"""A local stand-in for Autograph's /sign/data endpoint.
+
+It checks Hawk authentication like Autograph does, but its
+"signatures" are just hashes of the inputs, so it needs no keys and
+no Go toolchain. Latency, errors and overload can be injected to see
+how the lambda copes with them.
+
+To run one on its own::
+
+  python -m benchmarks.autograph_stub --port 8000 --latency 0.05
+"""
+
+import argparse
+import base64
+import hashlib
+import http.server
+import json
+import random
+import socketserver
+import threading
+import time
+
+# The same credentials as aws_lambda.sign_xpi's __main__ uses
+DEFAULT_CREDENTIALS = {
+    'alice': 'fs5wgcer9qj819kfptdlp8gm227ewxnzvsuj9ztycsx08hfhzu',
+}
+
+
+class StubSigner(object):
+    """How the stand-in behaves.
+
+    :param credentials: Hawk keys by Hawk ID
+    :param latency: seconds to wait before answering each request
+    :param latency_per_input: additional seconds per signature input
+    :param error_rate: fraction of requests to answer with a 503
+    :param max_concurrency: requests to handle at once. Any more than
+        this are answered with a 429 straight away. None means no limit.
+    """
+
+    def __init__(self, credentials=None, latency=0, latency_per_input=0,
+                 error_rate=0, max_concurrency=None, seed=None):
+        self.credentials = credentials or DEFAULT_CREDENTIALS
+        self.latency = latency
+        self.latency_per_input = latency_per_input
+        self.error_rate = error_rate
+        self.max_concurrency = max_concurrency
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.seen_nonces = set()
+        # Requests answered, by status code
+        self.responses = {}
+
+    def seen_nonce(self, sender_id, nonce, timestamp):
+        with self.lock:
+            key = (sender_id, nonce, timestamp)
+            if key in self.seen_nonces:
+                return True
+            self.seen_nonces.add(key)
+            return False
+
+    def authenticate(self, url, headers, body):
+        """Check a request's Hawk header, as Autograph would.
+
+        :returns: whether the request is authentic
+        """
+        import mohawk
+        import mohawk.exc
+
+        def lookup(sender_id):
+            if sender_id not in self.credentials:
+                raise LookupError(sender_id)
+            return {'id': sender_id, 'key': self.credentials[sender_id],
+                    'algorithm': 'sha256'}
+
+        try:
+            mohawk.Receiver(lookup, headers.get('Authorization', ''), url,
+                            'POST', content=body,
+                            content_type=headers.get('Content-Type', ''),
+                            seen_nonce=self.seen_nonce)
+        except (LookupError, mohawk.exc.HawkFail):
+            return False
+        return True
+
+    def sign(self, sign_inputs):
+        """Make a /sign/data response for some signature inputs."""
+        return [
+            {
+                "ref": str(n),
+                "type": "stub",
+                "signer_id": sign_input.get("keyid", ""),
+                "signature": base64.b64encode(hashlib.sha256(
+                    base64.b64decode(sign_input["input"])).digest()
+                ).decode('utf-8'),
+            }
+            for (n, sign_input) in enumerate(sign_inputs)
+        ]
+
+    def handle(self, url, headers, body):
+        """Answer a request to /sign/data.
+
+        :returns: (status code, response body as JSON-able object)
+        """
+        with self.lock:
+            overloaded = (self.max_concurrency is not None and
+                          self.in_flight >= self.max_concurrency)
+            if not overloaded:
+                self.in_flight += 1
+        if overloaded:
+            return self.respond(429, {"error": "too many requests"})
+        try:
+            if not self.authenticate(url, headers, body):
+                return self.respond(401, {"error": "unauthorized"})
+            try:
+                sign_inputs = json.loads(body.decode('utf-8'))
+            except ValueError:
+                return self.respond(400, {"error": "invalid JSON"})
+            time.sleep(self.latency +
+                       self.latency_per_input * len(sign_inputs))
+            with self.lock:
+                failed = self.random.random() < self.error_rate
+            if failed:
+                return self.respond(503, {"error": "injected failure"})
+            return self.respond(200, self.sign(sign_inputs))
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def respond(self, status, body):
+        with self.lock:
+            self.responses[status] = self.responses.get(status, 0) + 1
+        return (status, body)
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    # Keep-alive, like the real thing, so that connection pooling counts
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path != '/sign/data':
+            (status, response) = (404, {"error": "not found"})
+        else:
+            url = 'http://{}{}'.format(self.headers['Host'], self.path)
+            (status, response) = self.server.signer.handle(
+                url, self.headers, body)
+        payload = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    # Clients keep their connections open, so don't wait for them
+    daemon_threads = True
+    block_on_close = False
+
+    def __init__(self, signer, address=('127.0.0.1', 0)):
+        http.server.HTTPServer.__init__(self, address, RequestHandler)
+        self.signer = signer
+
+    @property
+    def url(self):
+        return 'http://{}:{}/'.format(*self.server_address)
+
+    def start(self):
+        """Serve from a background thread."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0,
+                        help="seconds to wait before each response")
+    parser.add_argument('--latency-per-input', type=float, default=0,
+                        help="extra seconds per signature input")
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help="fraction of requests to fail with a 503")
+    parser.add_argument('--max-concurrency', type=int,
+                        help="requests to serve at once, before sending 429s")
+    args = parser.parse_args(args)
+
+    signer = StubSigner(latency=args.latency,
+                        latency_per_input=args.latency_per_input,
+                        error_rate=args.error_rate,
+                        max_concurrency=args.max_concurrency)
+    server = StubServer(signer, (args.host, args.port))
+    print("Serving /sign/data on {}".format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Benchmarks for each stage of signing, and for whole handle() runs.
+
+Run these with ``make benchmark``, which saves the results under
+.benchmarks/ so that they can be compared between commits, for
+example with ``py.test-benchmark compare``.
+"""
+
+import base64
+import io
+from unittest import mock
+
+import boto3
+import pytest
+from aws_lambda import sign_xpi
+from aws_lambda.archive import XPIArchive
+from benchmarks.xpis import GUID, SPECS, make_synthetic_xpi, spec_id
+from tests import mock_s3
+
+ENV = {
+    "AUTOGRAPH_SERVER_URL": "http://localhost:8000/",
+    "AUTOGRAPH_HAWK_ID": "alice",
+    "AUTOGRAPH_HAWK_SECRET": "secret",
+    "AUTOGRAPH_KEY_ID": "extensions-ecdsa",
+    "OUTPUT_BUCKET": "output-bucket",
+    # Otherwise every round after the first would skip signing
+    "REUSE_SIGNED_XPIS": "false",
+}
+
+
+@pytest.fixture(scope='module', params=SPECS, ids=spec_id)
+def xpi(request):
+    return make_synthetic_xpi(request.param)
+
+
+def stub_signer_response(url, json, timeout):
+    """Answer /sign/data without any network or cryptography."""
+    resp = mock.Mock(status_code=200)
+    resp.json.return_value = [
+        {"ref": str(n), "signature": base64.b64encode(
+            b'signature' * 64).decode('utf-8')}
+        for (n, _) in enumerate(json)
+    ]
+    return resp
+
+
+@pytest.fixture
+def stub_signer():
+    with mock.patch('requests.Session.post',
+                    side_effect=stub_signer_response) as post:
+        yield post
+
+
+@pytest.fixture
+def local_s3():
+    with mock_s3():
+        s3 = boto3.resource('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket='mybucket')
+        s3.create_bucket(Bucket=ENV['OUTPUT_BUCKET'])
+        with mock.patch('aws_lambda.sign_xpi.get_s3', return_value=s3):
+            yield s3
+
+
+def open_archive(xpi):
+    return (XPIArchive(io.BytesIO(xpi)),), {}
+
+
+def test_get_guid(benchmark, xpi):
+    benchmark.pedantic(sign_xpi.get_guid, setup=lambda: open_archive(xpi),
+                       rounds=20)
+
+
+def test_manifest_digests(benchmark, xpi):
+    benchmark.pedantic(lambda archive: archive.signature,
+                       setup=lambda: open_archive(xpi), rounds=5)
+
+
+def test_sign_xpi(benchmark, xpi, stub_signer):
+    env = sign_xpi.Environment(strict=True).load(ENV).data
+
+    def sign():
+        sign_xpi.sign_xpi(env, io.BytesIO(xpi), GUID).close()
+
+    benchmark.pedantic(sign, rounds=5)
+
+
+def test_handle(benchmark, xpi, stub_signer, local_s3):
+    key = '{}/addon.xpi'.format(GUID)
+    local_s3.Object('mybucket', key).put(Body=xpi)
+    event = {"Records": [
+        {"s3": {"bucket": {"name": "mybucket"}, "object": {"key": key}}},
+    ]}
+
+    [result] = benchmark.pedantic(sign_xpi.handle, (event, None, ENV),
+                                  rounds=5)
+    assert 'uploaded' in result
@@ -0,0 +1,231 @@
+"""Replay synthetic S3 events through handle() at a target rate.
+
+By default this runs against moto's S3 and a local Autograph stand-in
+(see benchmarks.autograph_stub), so it needs no network access. Each
+event is handled on its own thread, as concurrent lambda invocations
+would be. The throughput and latency percentiles of each signing
+stage are reported at the end, from the metrics each record reports.
+
+For example, for 20 events a second for 30 seconds, with Autograph
+taking 50ms a request::
+
+  python -m benchmarks.load --rate 20 --duration 30 --latency 0.05
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import os
+import threading
+import time
+from unittest import mock
+
+from aws_lambda import metrics
+from benchmarks.autograph_stub import (
+    DEFAULT_CREDENTIALS, StubServer, StubSigner)
+from benchmarks.xpis import DEFAULT_SPEC, GUID, make_synthetic_xpi
+
+INPUT_BUCKET = 'load-input'
+OUTPUT_BUCKET = 'load-output'
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(values, p):
+    """The nearest-rank percentile of some values."""
+    values = sorted(values)
+    rank = max(1, -(-len(values) * p // 100))
+    return values[int(rank) - 1]
+
+
+@contextlib.contextmanager
+def local_s3():
+    """Point the lambda at moto's S3, with the buckets we need."""
+    import boto3
+    from tests import mock_s3
+
+    with mock_s3():
+        s3 = boto3.resource('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket=INPUT_BUCKET)
+        s3.create_bucket(Bucket=OUTPUT_BUCKET)
+        with mock.patch('aws_lambda.sign_xpi.get_s3', return_value=s3):
+            yield s3
+
+
+def upload_xpis(s3, count, spec):
+    """Put count distinct XPIs in the input bucket.
+
+    :returns: their keys
+    """
+    keys = []
+    for n in range(count):
+        key = '{}/addon-{}.xpi'.format(GUID, n)
+        s3.Object(INPUT_BUCKET, key).put(
+            Body=make_synthetic_xpi(spec, seed=n))
+        keys.append(key)
+    return keys
+
+
+def make_event(keys):
+    return {
+        "Records": [
+            {"s3": {"bucket": {"name": INPUT_BUCKET},
+                    "object": {"key": key}}}
+            for key in keys
+        ]
+    }
+
+
+class LoadReport(object):
+    """What happened to the records that were handled."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Milliseconds, by stage, plus "record" for the whole record
+        self.timings = collections.defaultdict(list)
+        self.records = 0
+        self.errors = collections.Counter()
+
+    def add(self, results, elapsed):
+        with self.lock:
+            for result in results:
+                self.records += 1
+                if 'error' in result:
+                    self.errors[result['error']['type']] += 1
+                    continue
+                self.timings['record'].append(elapsed * 1000)
+                for (stage, ms) in result['metrics']['timings_ms'].items():
+                    self.timings[stage].append(ms)
+
+    def add_failure(self, e, records):
+        with self.lock:
+            self.records += records
+            self.errors[type(e).__name__] += records
+
+    def format(self, duration):
+        lines = [
+            "{} records in {:.1f}s: {:.1f} records/s, {} errors".format(
+                self.records, duration, self.records / duration,
+                sum(self.errors.values())),
+        ]
+        for (name, count) in sorted(self.errors.items()):
+            lines.append("  {}: {}".format(name, count))
+        lines.append("{:<10}".format("ms") + "".join(
+            "{:>10}".format("p{}".format(p)) for p in PERCENTILES))
+        for stage in list(metrics.STAGES) + ['record']:
+            if not self.timings[stage]:
+                continue
+            lines.append("{:<10}".format(stage) + "".join(
+                "{:>10.1f}".format(percentile(self.timings[stage], p))
+                for p in PERCENTILES))
+        return "\n".join(lines)
+
+
+def run_load(env, keys, rate, duration, records_per_event=1,
+             max_in_flight=100):
+    """Invoke handle() rate times a second for duration seconds.
+
+    Events cycle through keys, records_per_event at a time. If more
+    than max_in_flight events are being handled at once, new ones wait.
+
+    :returns: (LoadReport, seconds it took to handle every event)
+    """
+    from aws_lambda import sign_xpi
+
+    env = dict(env, DEBUG_METRICS='true')
+    report = LoadReport()
+
+    def invoke(event):
+        start = time.perf_counter()
+        try:
+            results = sign_xpi.handle(event, None, env)
+        except sign_xpi.RecordsFailedError as e:
+            results = e.results
+        except Exception as e:
+            report.add_failure(e, len(event['Records']))
+            return
+        report.add(results, time.perf_counter() - start)
+
+    events = int(rate * duration)
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_in_flight) as executor:
+        for n in range(events):
+            # Keep to the schedule rather than sleeping a fixed amount,
+            # so that slow submissions don't lower the rate
+            delay = start + n / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            first = n * records_per_event
+            executor.submit(invoke, make_event([
+                keys[(first + i) % len(keys)]
+                for i in range(records_per_event)
+            ]))
+    return report, time.perf_counter() - start
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rate', type=float, default=10,
+                        help="events to handle per second")
+    parser.add_argument('--duration', type=float, default=10,
+                        help="seconds to keep sending events for")
+    parser.add_argument('--records-per-event', type=int, default=1)
+    parser.add_argument('--max-in-flight', type=int, default=100,
+                        help="events to handle at once, at most")
+    parser.add_argument('--xpis', type=int, default=20,
+                        help="distinct XPIs to cycle through")
+    parser.add_argument('--xpi-size', type=int, default=DEFAULT_SPEC.size)
+    parser.add_argument('--xpi-entries', type=int,
+                        default=DEFAULT_SPEC.entries)
+    parser.add_argument('--autograph-url',
+                        help="use this Autograph instead of a local stub")
+    parser.add_argument('--latency', type=float, default=0,
+                        help="stub Autograph's latency per request")
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help="fraction of stub Autograph requests to fail")
+    parser.add_argument('--max-concurrency', type=int,
+                        help="stub Autograph's concurrent request limit")
+    args = parser.parse_args(args)
+
+    [(hawk_id, hawk_secret)] = DEFAULT_CREDENTIALS.items()
+    env = dict(os.environ, **{
+        "AUTOGRAPH_HAWK_ID": hawk_id,
+        "AUTOGRAPH_HAWK_SECRET": hawk_secret,
+        "AUTOGRAPH_KEY_ID": "extensions-ecdsa",
+        "OUTPUT_BUCKET": OUTPUT_BUCKET,
+        # Every event should go all the way through signing
+        "REUSE_SIGNED_XPIS": "false",
+    })
+    server = None
+    if args.autograph_url:
+        env['AUTOGRAPH_SERVER_URL'] = args.autograph_url
+    else:
+        signer = StubSigner(latency=args.latency,
+                            error_rate=args.error_rate,
+                            max_concurrency=args.max_concurrency)
+        server = StubServer(signer).start()
+        env['AUTOGRAPH_SERVER_URL'] = server.url
+
+    spec = DEFAULT_SPEC._replace(size=args.xpi_size,
+                                 entries=args.xpi_entries)
+    try:
+        # The report sums up what the lambda would have logged
+        with local_s3() as s3, mock.patch('aws_lambda.metrics.emit'):
+            keys = upload_xpis(s3, args.xpis, spec)
+            (report, duration) = run_load(
+                env, keys, args.rate, args.duration,
+                records_per_event=args.records_per_event,
+                max_in_flight=args.max_in_flight)
+    finally:
+        if server is not None:
+            server.stop()
+
+    print(report.format(duration))
+    if server is not None:
+        print("Stub Autograph responses: {}".format(
+            dict(sorted(server.signer.responses.items()))))
+
+
+if __name__ == '__main__':
+    main()
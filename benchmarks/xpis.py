@@ -0,0 +1,107 @@
+"""Synthetic XPIs of various shapes to benchmark with."""
+
+import collections
+import io
+import json
+import random
+import zipfile
+
+from aws_lambda.archive import write_entry
+
+INSTALL_RDF = """<?xml version="1.0" encoding="UTF-8"?>
+<RDF xmlns="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+     xmlns:em="http://www.mozilla.org/2004/em-rdf#">
+  <Description about="urn:mozilla:install-manifest">
+    <em:id>{guid}</em:id>
+    <em:version>1.0</em:version>
+    <em:type>2</em:type>
+    <em:targetApplication>
+      <Description>
+        <em:id>{{ec8030f7-c20a-464f-9b0e-13a3a9e97384}}</em:id>
+        <em:minVersion>52.0</em:minVersion>
+        <em:maxVersion>*</em:maxVersion>
+      </Description>
+    </em:targetApplication>
+  </Description>
+</RDF>
+"""
+
+GUID = 'benchmark@mozilla.org'
+
+# Every entry gets this timestamp, so that the bytes don't depend on
+# when the XPI was built
+DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+XPISpec = collections.namedtuple('XPISpec', [
+    # Roughly how many bytes of (uncompressed) files to include
+    'size',
+    'entries',
+    # 0 means the files are stored rather than deflated
+    'compresslevel',
+    # 'install.rdf' or 'manifest.json'
+    'manifest',
+])
+
+DEFAULT_SPEC = XPISpec(size=1024 * 1024, entries=100, compresslevel=6,
+                       manifest='manifest.json')
+
+# Each axis is varied on its own, starting from DEFAULT_SPEC, rather
+# than benchmarking every combination
+SPECS = [DEFAULT_SPEC] + [
+    DEFAULT_SPEC._replace(size=size)
+    for size in (64 * 1024, 16 * 1024 * 1024)
+] + [
+    DEFAULT_SPEC._replace(entries=entries) for entries in (10, 1000)
+] + [
+    DEFAULT_SPEC._replace(compresslevel=level) for level in (0, 1, 9)
+] + [
+    DEFAULT_SPEC._replace(manifest='install.rdf'),
+]
+
+
+def spec_id(spec):
+    return '{}B-{}entries-level{}-{}'.format(
+        spec.size, spec.entries, spec.compresslevel, spec.manifest)
+
+
+def file_contents(rng, size):
+    """Half text-like (compressible), half random (incompressible)."""
+    words = [b'function', b'var', b'return', b'this', b'{', b'}', b'=']
+    text = b' '.join(rng.choice(words) for _ in range(size // 10))
+    noise = size - size // 2
+    return text[:size // 2] + rng.getrandbits(8 * noise).to_bytes(
+        noise, 'little')
+
+
+def make_synthetic_xpi(spec, guid=GUID, seed=0):
+    """Build an XPI as described by an XPISpec.
+
+    The same spec and seed always give the same bytes.
+
+    :returns: the XPI, as bytes
+    """
+    rng = random.Random(seed)
+    xpi = io.BytesIO()
+    with zipfile.ZipFile(xpi, 'w', zipfile.ZIP_STORED) as zout:
+        def add(filename, contents):
+            if spec.compresslevel:
+                write_entry(zout, filename, contents,
+                            level=spec.compresslevel, date_time=DATE_TIME)
+            else:
+                info = zipfile.ZipInfo(filename, date_time=DATE_TIME)
+                info.external_attr = 0o600 << 16
+                zout.writestr(info, contents)
+
+        if spec.manifest == 'install.rdf':
+            add('install.rdf', INSTALL_RDF.format(guid=guid).encode('utf-8'))
+        else:
+            add('manifest.json', json.dumps({
+                "manifest_version": 2,
+                "name": "Benchmark addon",
+                "version": "1.0",
+                "applications": {"gecko": {"id": guid}},
+            }).encode('utf-8'))
+        for n in range(spec.entries):
+            add('content/{}/file{}.js'.format(n % 10, n),
+                file_contents(rng, spec.size // spec.entries))
+    return xpi.getvalue()
@@ -2,8 +2,13 @@
 The CLI command for the sign-xpi lambda.
 """
 
-from argparse import ArgumentParser, FileType
+from argparse import ArgumentParser
 import boto3
+import botocore.config
+import botocore.exceptions
+import concurrent.futures
+import functools
+import glob
 import hashlib
 import json
 import os.path
@@ -12,8 +17,14 @@ import traceback
 import logging
 
 DEFAULT_S3_BUCKET = 'eglassercamp-addon-sign-xpi-input'
+CHUNK_SIZE = 512 * 1024
+DEFAULT_JOBS = 8
+# S3 metadata on uploaded XPIs, so that unchanged ones needn't be sent again
+SHA256_METADATA = 'sha256'
 
-parser = ArgumentParser(description="Upload an XPI and cause it to be signed.")
+logger = logging.getLogger(__name__)
+
+parser = ArgumentParser(description="Upload XPIs and cause them to be signed.")
 parser.add_argument('-v', dest="verbose", action="store_true",
                     help="Enable verbose logging")
 parser.add_argument('-t', '--type',
@@ -25,66 +36,173 @@ parser.add_argument('-e', '--env',
 parser.add_argument('-s', '--s3-source', nargs='?',
                     help='S3 bucket to upload XPI to for signing')
 parser.add_argument('-p', '--profile', help='The name of the AWS profile to use')
-parser.add_argument('xpi_file', type=FileType('rb'), help="Filename of XPI to sign")
+parser.add_argument('-j', '--jobs', type=int, default=DEFAULT_JOBS,
+                    help="Number of XPIs to upload and sign at once")
+parser.add_argument('xpi_files', nargs='+', metavar='xpi_file',
+                    help="XPIs to sign: filenames, directories of XPIs, "
+                         "or glob patterns")
 
 
 def main(args=sys.argv[1:]):
     parameters = parser.parse_args(args)
 
-    session = boto3.Session(profile_name=parameters.profile)
-    s3 = session.resource('s3')
-    aws_lambda = session.client('lambda')
-
     if parameters.verbose:
         logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 
-    xpi_file = parameters.xpi_file
-    xpi_sha256 = sha256(xpi_file)
-    xpi_file.seek(0)
-    bucket_name = parameters.s3_source or DEFAULT_S3_BUCKET
-    bucket = s3.Bucket(bucket_name)
-    key = os.path.basename(xpi_file.name)
-    bucket.put_object(Body=xpi_file, Key=key)
+    filenames = find_xpi_files(parameters.xpi_files)
+    if not filenames:
+        print("No XPIs found")
+        return 1
+    # XPIs are uploaded under their basename, so these would overwrite
+    # each other in the bucket
+    duplicates = duplicate_basenames(filenames)
+    if duplicates:
+        for (basename, same_named) in sorted(duplicates.items()):
+            print("More than one XPI is named {}: {}".format(
+                basename, ', '.join(same_named)))
+        return 1
+
+    session = boto3.Session(profile_name=parameters.profile)
+    # Clients, unlike resources, can be shared between threads
+    config = botocore.config.Config(max_pool_connections=parameters.jobs)
+    s3 = session.client('s3', config=config)
+    aws_lambda = session.client('lambda', config=config)
 
+    bucket_name = parameters.s3_source or DEFAULT_S3_BUCKET
     function_name = 'addons-sign-xpi-{}-{}'.format(parameters.type, parameters.env)
-    lambda_args = {
-        "source": {
-            "bucket": bucket_name,
-            "key": key,
-        },
-        "checksum": xpi_sha256,
-    }
-
-    ret = aws_lambda.invoke(
-        FunctionName=function_name,
-        Payload=json.dumps(lambda_args)
-    )
+    sign = functools.partial(sign_file, s3, aws_lambda, bucket_name,
+                             function_name)
 
-    if ret['StatusCode'] >= 300 or 'FunctionError' in ret:
-        print("Invoking lambda failed")
-        raw_response = ret['Payload'].read()
-        try:
-            response = json.loads(raw_response)
-        except Exception as e:
-            print("Couldn't parse response: {} {}".format(e, raw_response))
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=parameters.jobs) as executor:
+        results = list(executor.map(sign, filenames))
+
+    print_results(zip(filenames, results))
+    return 0 if all(ok for (ok, _) in results) else 1
+
+
+def find_xpi_files(paths):
+    """Expand directories and glob patterns into a list of XPI filenames.
+
+    Directories stand for every .xpi file directly inside them. Each
+    file is only listed once, in the order it was first found.
+    """
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            matches = sorted(glob.glob(os.path.join(path, '*.xpi')))
+        elif any(c in path for c in '*?['):
+            matches = sorted(glob.glob(path))
         else:
-            if 'stackTrace' in response:
-                tb_out = ''.join(traceback.format_list(response['stackTrace']))
-                print(tb_out.rstrip('\n'))
-            error_type = response.get('errorType', "No error type")
-            error_msg = response.get('errorMessage')
-            error_out = error_type
-            if error_msg:
-                error_out = '{}: {}'.format(error_type, error_msg)
-            print(error_out)
+            matches = [path]
+        for filename in matches:
+            if filename not in filenames:
+                filenames.append(filename)
+    return filenames
+
+
+def duplicate_basenames(filenames):
+    """Find the filenames that share a basename.
+
+    :returns: a dict of each shared basename to its filenames
+    """
+    by_basename = {}
+    for filename in filenames:
+        by_basename.setdefault(os.path.basename(filename), []).append(filename)
+    return {basename: same_named
+            for (basename, same_named) in by_basename.items()
+            if len(same_named) > 1}
+
+
+def sign_file(s3, aws_lambda, bucket_name, function_name, filename):
+    """Upload one XPI and invoke the lambda on it.
+
+    The upload is skipped if the same bytes are already in the bucket.
+
+    :returns: (whether it succeeded, what to report about it)
+    """
+    try:
+        with open(filename, 'rb') as xpi_file:
+            xpi_sha256 = sha256(xpi_file)
+            key = os.path.basename(filename)
+            if uploaded_sha256(s3, bucket_name, key) == xpi_sha256:
+                logger.debug("%s is already uploaded; not uploading it",
+                             filename)
+            else:
+                xpi_file.seek(0)
+                s3.upload_fileobj(
+                    xpi_file, bucket_name, key,
+                    ExtraArgs={'Metadata': {SHA256_METADATA: xpi_sha256}})
+
+        lambda_args = {
+            "source": {
+                "bucket": bucket_name,
+                "key": key,
+            },
+            "checksum": xpi_sha256,
+        }
+        ret = aws_lambda.invoke(
+            FunctionName=function_name,
+            Payload=json.dumps(lambda_args)
+        )
+        raw_response = ret['Payload'].read()
+    except Exception as e:
+        logger.debug("Signing %s failed", filename, exc_info=True)
+        return (False, '{}: {}'.format(type(e).__name__, e))
+
+    if ret['StatusCode'] >= 300 or 'FunctionError' in ret:
+        return (False, describe_lambda_error(filename, raw_response))
+
+    return (True, raw_response.decode('utf-8'))
+
+
+def uploaded_sha256(s3, bucket_name, key):
+    """Get the checksum an object was uploaded with, or None.
+
+    None also means we can't tell: a drop bucket may well let us put
+    objects but not read them back, and S3 says 403 then, whether or
+    not the object exists.
+    """
+    try:
+        head = s3.head_object(Bucket=bucket_name, Key=key)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey',
+                                           '403', 'AccessDenied'):
+            return None
+        raise
+    return head['Metadata'].get(SHA256_METADATA)
+
+
+def describe_lambda_error(filename, raw_response):
+    """Summarize a failed invocation, logging its stack trace if any."""
+    try:
+        response = json.loads(raw_response)
+    except Exception as e:
+        return "Couldn't parse response: {} {}".format(e, raw_response)
+
+    if 'stackTrace' in response:
+        tb_out = ''.join(traceback.format_list(response['stackTrace']))
+        logger.debug("Lambda stack trace for %s:\n%s", filename,
+                     tb_out.rstrip('\n'))
+    error_type = response.get('errorType', "No error type")
+    error_msg = response.get('errorMessage')
+    error_out = error_type
+    if error_msg:
+        error_out = '{}: {}'.format(error_type, error_msg)
+    return error_out
 
-        return 1
 
-    print(ret['Payload'].read())
-    return 0
+def print_results(results):
+    """Print a table of (filename, (ok, detail)) results."""
+    results = list(results)
+    width = max(len(filename) for (filename, _) in results)
+    for (filename, (ok, detail)) in results:
+        print('{:<{}}  {:<6}  {}'.format(filename, width,
+                                         'ok' if ok else 'FAILED', detail))
 
 
 def sha256(xpi_file):
     h = hashlib.sha256()
-    h.update(xpi_file.read())
+    for chunk in iter(functools.partial(xpi_file.read, CHUNK_SIZE), b''):
+        h.update(chunk)
     return h.hexdigest()
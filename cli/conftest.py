@@ -0,0 +1,2 @@
+# Lets the CLI's tests import addon_shipping_cli without installing it;
+# pytest puts the directory of a conftest.py like this one on sys.path.
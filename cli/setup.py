@@ -27,6 +27,7 @@ setup(
     package_dir={'addon_shipping_cli': 'addon_shipping_cli'},
     include_package_data=True,
     install_requires=requirements,
+    python_requires='>=3.4',
     license="MIT license",
     zip_safe=False,
     entry_points={
@@ -39,13 +40,12 @@ setup(
         'Intended Audience :: Developers',
         'License :: OSI Approved :: MIT License',
         'Natural Language :: English',
-        "Programming Language :: Python :: 2",
-        'Programming Language :: Python :: 2.6',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.3',
+        'Programming Language :: Python :: 3 :: Only',
         'Programming Language :: Python :: 3.4',
         'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
     ],
     test_suite='tests',
     tests_require=test_requirements
@@ -0,0 +1,118 @@
+import hashlib
+import io
+import json
+from unittest import mock
+
+import botocore.exceptions
+import pytest
+from addon_shipping_cli import sign_xpi
+
+
+def make_files(tmp_path, *names):
+    for name in names:
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(name.encode('utf-8'))
+    return [str(tmp_path / name) for name in names]
+
+
+def test_find_xpi_files_expands_directories_and_globs(tmp_path):
+    (a, b, c) = make_files(tmp_path, 'a.xpi', 'dir/b.xpi', 'dir/c.txt')
+    filenames = sign_xpi.find_xpi_files(
+        [a, str(tmp_path / 'dir'), str(tmp_path / '*.xpi')])
+
+    assert filenames == [a, b]
+
+
+def test_duplicate_basenames(tmp_path):
+    (a1, a2, b) = make_files(tmp_path, 'one/addon.xpi', 'two/addon.xpi',
+                             'one/other.xpi')
+
+    assert sign_xpi.duplicate_basenames([a1, a2, b]) == {
+        'addon.xpi': [a1, a2]}
+
+
+def test_main_rejects_xpis_with_the_same_basename(tmp_path, capsys):
+    (a1, a2) = make_files(tmp_path, 'one/addon.xpi', 'two/addon.xpi')
+    with mock.patch('boto3.Session') as Session:
+        status = sign_xpi.main(['-t', 'system', '-e', 'stage', a1, a2])
+
+    assert status == 1
+    assert 'More than one XPI is named addon.xpi' in capsys.readouterr().out
+    assert not Session.called
+
+
+def fake_session(s3):
+    """A boto3 Session with the given S3 client, and a lambda that echoes."""
+    aws_lambda = mock.Mock()
+    aws_lambda.invoke.side_effect = lambda FunctionName, Payload: {
+        'StatusCode': 200,
+        'Payload': io.BytesIO(Payload.encode('utf-8')),
+    }
+    session = mock.Mock()
+    session.client.side_effect = lambda service, config: {
+        's3': s3, 'lambda': aws_lambda}[service]
+    return session
+
+
+def test_main_signs_every_xpi(tmp_path, capsys):
+    filenames = make_files(tmp_path, 'one/a.xpi', 'two/b.xpi')
+    s3 = mock.Mock()
+    s3.head_object.return_value = {'Metadata': {}}
+    session = fake_session(s3)
+    with mock.patch('boto3.Session', return_value=session):
+        status = sign_xpi.main(['-t', 'system', '-e', 'stage'] + filenames)
+
+    assert status == 0
+    aws_lambda = session.client('lambda', None)
+    payloads = [json.loads(call[1]['Payload'])
+                for call in aws_lambda.invoke.call_args_list]
+    assert sorted((payload['source']['key'], payload['checksum'])
+                  for payload in payloads) == [
+        ('a.xpi', hashlib.sha256(b'one/a.xpi').hexdigest()),
+        ('b.xpi', hashlib.sha256(b'two/b.xpi').hexdigest()),
+    ]
+    assert s3.upload_fileobj.call_count == 2
+    assert capsys.readouterr().out.count(' ok ') == 2
+
+
+def client_error(code):
+    return botocore.exceptions.ClientError(
+        {'Error': {'Code': code, 'Message': 'Nope'}}, 'HeadObject')
+
+
+@pytest.mark.parametrize('head_object, expected', [
+    (mock.Mock(return_value={'Metadata': {'sha256': 'abc'}}), 'abc'),
+    (mock.Mock(return_value={'Metadata': {}}), None),
+    (mock.Mock(side_effect=client_error('404')), None),
+    (mock.Mock(side_effect=client_error('403')), None),
+])
+def test_uploaded_sha256(head_object, expected):
+    s3 = mock.Mock(head_object=head_object)
+
+    assert sign_xpi.uploaded_sha256(s3, 'bucket', 'a.xpi') == expected
+
+
+def test_uploaded_sha256_raises_other_errors():
+    s3 = mock.Mock(head_object=mock.Mock(side_effect=client_error('500')))
+    with pytest.raises(botocore.exceptions.ClientError):
+        sign_xpi.uploaded_sha256(s3, 'bucket', 'a.xpi')
+
+
+@pytest.mark.parametrize('head_object, uploads', [
+    # Already there: not uploaded again
+    (mock.Mock(return_value={
+        'Metadata': {'sha256': hashlib.sha256(b'a.xpi').hexdigest()}}), 0),
+    (mock.Mock(side_effect=client_error('404')), 1),
+    # Not allowed to look: uploaded anyway
+    (mock.Mock(side_effect=client_error('403')), 1),
+])
+def test_main_skips_xpis_that_are_already_uploaded(tmp_path, head_object,
+                                                   uploads):
+    filenames = make_files(tmp_path, 'a.xpi')
+    s3 = mock.Mock(head_object=head_object)
+    with mock.patch('boto3.Session', return_value=fake_session(s3)):
+        status = sign_xpi.main(['-t', 'system', '-e', 'stage'] + filenames)
+
+    assert status == 0
+    assert s3.upload_fileobj.call_count == uploads
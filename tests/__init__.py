@@ -8,3 +8,16 @@ ADDON_FILENAME = 'hypothetical-addon-unsigned.xpi'
 
 def get_test_file(filename):
     return os.path.join(TEST_DIR, filename)
+
+
+def mock_s3():
+    """moto's stand-in for S3.
+
+    moto 5 replaced its per-service mocks with a single mock_aws, but
+    it needs Python 3.8, so older moto is still used on Python 3.6/3.7.
+    """
+    import moto
+
+    if hasattr(moto, 'mock_aws'):
+        return moto.mock_aws()
+    return moto.mock_s3()
@@ -0,0 +1,19 @@
+from unittest import mock
+
+import boto3
+import pytest
+from tests import mock_s3
+
+
+@pytest.fixture
+def fake_s3():
+    """A moto stand-in for S3, with the input and output buckets.
+
+    These are the buckets of test_aws_lambda.make_s3_event and ENV.
+    """
+    with mock_s3():
+        s3 = boto3.resource('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket='mybucket')
+        s3.create_bucket(Bucket='output-bucket')
+        with mock.patch('aws_lambda.sign_xpi.get_s3', return_value=s3):
+            yield s3
@@ -0,0 +1,187 @@
+import io
+import itertools
+import struct
+import threading
+import zipfile
+from unittest import mock
+import pytest
+from sign_xpi_lib import XPIFile
+from aws_lambda.archive import XPIArchive, write_entry
+from tests import get_test_file, ADDON_FILENAME
+
+
+def make_archive(entries):
+    contents = io.BytesIO()
+    with zipfile.ZipFile(contents, 'w', zipfile.ZIP_DEFLATED) as zout:
+        for (name, data) in entries:
+            zout.writestr(name, data)
+    return contents
+
+
+ODDLY_LAID_OUT_XPI = [
+    ('README', b'Read me'),
+    ('install.rdf', b'<RDF/>'),
+    ('content/', b''),
+    ('content/b.js', b'b' * 1000),
+    ('content/A.js', b'a' * 1000),
+    ('LICENSE', b'MPL'),
+    ('icon.png', b'\x89PNG'),
+    # Signatures from some earlier signing, which are left out
+    ('META-INF/manifest.mf', b'Manifest-Version: 1.0'),
+    ('META-INF/mozilla.rsa', b'old signature'),
+    ('META-INF/other.txt', b'kept'),
+]
+
+
+@pytest.mark.parametrize('xpi', [
+    open(get_test_file(ADDON_FILENAME), 'rb').read(),
+    make_archive(ODDLY_LAID_OUT_XPI).getvalue(),
+])
+def test_manifests_match_xpifile(xpi):
+    archive = XPIArchive(io.BytesIO(xpi))
+    xpi_file = XPIFile(io.BytesIO(xpi))
+
+    assert archive.manifest == str(xpi_file.manifest)
+    assert archive.signature == xpi_file.signature
+
+
+def test_signed_entries_are_in_manifest_order():
+    archive = XPIArchive(make_archive(ODDLY_LAID_OUT_XPI))
+
+    assert [entry.filename for entry in archive.signed_entries()] == [
+        'install.rdf', 'icon.png', 'README', 'content/A.js',
+        'content/b.js', 'META-INF/other.txt', 'LICENSE',
+    ]
+
+
+def test_manifest_files_are_read_once():
+    archive = XPIArchive(make_archive(ODDLY_LAID_OUT_XPI))
+    with mock.patch.object(archive.zipfile, 'read',
+                           wraps=archive.zipfile.read) as read:
+        assert archive.open('install.rdf').read() == b'<RDF/>'
+        assert archive.read('install.rdf') == b'<RDF/>'
+        archive.read('README')
+        archive.read('README')
+
+    assert read.call_count == 3
+
+
+def test_close_closes_file():
+    contents = make_archive(ODDLY_LAID_OUT_XPI)
+    XPIArchive(contents).close()
+
+    assert contents.closed
+
+
+def many_entries_xpi():
+    return make_archive(
+        [('install.rdf', b'<RDF/>')] +
+        [('content/{}.js'.format(n), str(n).encode('utf-8') * 5000)
+         for n in range(200)])
+
+
+def test_parallel_manifest_matches_xpifile():
+    xpi = many_entries_xpi().getvalue()
+    archive = XPIArchive(io.BytesIO(xpi), digest_workers=4)
+    xpi_file = XPIFile(io.BytesIO(xpi))
+
+    assert archive.manifest == str(xpi_file.manifest)
+    assert archive.signature == xpi_file.signature
+
+
+def test_digests_are_computed_on_several_threads():
+    threads = set()
+    calls = itertools.count()
+    barrier = threading.Barrier(2, timeout=5)
+
+    def digest(data):
+        threads.add(threading.current_thread())
+        # Only gets past the first two entries if they're in parallel
+        if next(calls) < 2:
+            barrier.wait()
+        return {}
+
+    archive = XPIArchive(many_entries_xpi(), digest_workers=2)
+    with mock.patch('aws_lambda.archive.digest', side_effect=digest):
+        archive.manifest
+
+    assert len(threads) == 2
+
+
+class Unseekable(object):
+    """A write-only stream, which makes ZipFile use data descriptors."""
+    def __init__(self):
+        self.contents = io.BytesIO()
+
+    def write(self, data):
+        return self.contents.write(data)
+
+    def flush(self):
+        pass
+
+
+def copy_all(archive):
+    copied = io.BytesIO()
+    with zipfile.ZipFile(copied, 'w') as zout:
+        for entry in archive.entries:
+            archive.copy_entry(zout, entry)
+    return zipfile.ZipFile(copied)
+
+
+def raw_data(archive, name):
+    entry = archive.index[name]
+    archive.fileobj.seek(archive.data_offset(entry))
+    return archive.fileobj.read(entry.compress_size)
+
+
+def test_copy_entry_keeps_compressed_data():
+    archive = XPIArchive(open(get_test_file(ADDON_FILENAME), 'rb'))
+    with mock.patch.object(archive.zipfile, 'open') as zip_open:
+        copied = copy_all(archive)
+
+    assert not zip_open.called
+    assert copied.testzip() is None
+    copied_archive = XPIArchive(copied.fp)
+    for name in archive.namelist():
+        assert copied.read(name) == archive.read(name)
+        assert raw_data(copied_archive, name) == raw_data(archive, name)
+
+
+def test_copy_entry_drops_data_descriptors():
+    stream = Unseekable()
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as zout:
+        zout.writestr('content.js', b'x' * 1000)
+    archive = XPIArchive(io.BytesIO(stream.contents.getvalue()))
+    assert archive.index['content.js'].flag_bits & 0x08
+
+    copied = copy_all(archive)
+
+    assert copied.testzip() is None
+    assert not copied.getinfo('content.js').flag_bits & 0x08
+    assert copied.read('content.js') == b'x' * 1000
+
+
+def test_copy_entry_replaces_zip64_extra():
+    archive = XPIArchive(make_archive([('content.js', b'x' * 1000)]))
+    # Some tools add a ZIP64 field to entries whether or not they need
+    # it; only the other fields should be carried over
+    timestamp = struct.pack('<HHB', 0x5455, 1, 0)
+    zip64 = struct.pack('<HHQQ', 0x0001, 16, 1000, 0)
+    archive.index['content.js'].extra = zip64 + timestamp
+
+    copied = copy_all(archive)
+
+    assert copied.getinfo('content.js').extra == timestamp
+    assert copied.testzip() is None
+    assert copied.read('content.js') == b'x' * 1000
+
+
+def test_write_entry_takes_a_timestamp():
+    contents = io.BytesIO()
+    with zipfile.ZipFile(contents, 'w') as zout:
+        write_entry(zout, 'a.js', b'a' * 100,
+                    date_time=(2000, 1, 2, 3, 4, 6))
+    with zipfile.ZipFile(contents) as zin:
+        [info] = zin.infolist()
+        assert info.date_time == (2000, 1, 2, 3, 4, 6)
+        assert zin.read('a.js') == b'a' * 100
@@ -0,0 +1,172 @@
+import asyncio
+import hashlib
+import io
+import zipfile
+from unittest import mock
+
+import pytest
+from aws_lambda import async_handler, sign_xpi
+from tests.test_aws_lambda import (
+    ENV, FakeContext, assert_signed_by_manifest, autograph_response,
+    make_s3_event, make_sized_s3_event, make_xpi, post_keyid_signatures,
+    uploaded)
+
+
+def test_handle_signs_records_concurrently(fake_s3):
+    keys = ['addon-{}@mozilla.org/addon-{}.xpi'.format(n, n)
+            for n in range(3)]
+    for (n, key) in enumerate(keys):
+        fake_s3.Object('mybucket', key).put(
+            Body=make_xpi('addon-{}@mozilla.org'.format(n)))
+    # This one's ID doesn't match its path
+    fake_s3.Object('mybucket', 'wrong@mozilla.org/x.xpi').put(
+        Body=make_xpi('addon-0@mozilla.org'))
+    with mock.patch('requests.Session.post', side_effect=lambda url, json,
+                    timeout: autograph_response(json)) as post:
+        ret = async_handler.handle(
+            make_s3_event(*(keys + ['wrong@mozilla.org/x.xpi'])), None, ENV)
+
+    assert ret[:3] == [uploaded(fake_s3, 'addon-{}.xpi'.format(n))
+                       for n in range(3)]
+    assert ret[3]['error']['type'] == 'S3IdMatchError'
+    assert sum(len(call[1]['json']) for call in post.call_args_list) == 3
+    for n in range(3):
+        signed_xpi = fake_s3.Object('output-bucket',
+                                    'addon-{}.xpi'.format(n)).get()
+        signed_zip = zipfile.ZipFile(io.BytesIO(signed_xpi['Body'].read()))
+        assert signed_zip.read('META-INF/mozilla.rsa') == (
+            'addon-{}@mozilla.org'.format(n).encode('utf-8'))
+
+
+def test_handle_signs_sign_events_from_the_cli(fake_s3):
+    xpi = make_xpi('addon@mozilla.org')
+    fake_s3.Object('mybucket', 'addon.xpi').put(Body=xpi)
+    event = {"source": {"bucket": "mybucket", "key": "addon.xpi"},
+             "checksum": hashlib.sha256(xpi).hexdigest()}
+    with mock.patch('requests.Session.post', side_effect=lambda url, json,
+                    timeout: autograph_response(json)):
+        ret = async_handler.handle(event, None, ENV)
+
+    assert ret == uploaded(fake_s3, 'addon.xpi')
+
+
+def test_handle_signs_with_every_key(fake_s3):
+    keys = ['addon-{}@mozilla.org/addon-{}.xpi'.format(n, n)
+            for n in range(3)]
+    put_xpis(fake_s3, keys)
+    env = dict(ENV, AUTOGRAPH_KEY_ID='extensions-ecdsa,extensions-new')
+    inputs = {}
+    with mock.patch('requests.Session.post',
+                    side_effect=post_keyid_signatures(inputs)):
+        async_handler.handle(make_s3_event(*keys), None, env)
+
+    for n in range(3):
+        signed_xpi = fake_s3.Object('output-bucket',
+                                    'addon-{}.xpi'.format(n)).get()
+        signed_zip = zipfile.ZipFile(io.BytesIO(signed_xpi['Body'].read()))
+        assert_signed_by_manifest(signed_zip)
+        assert signed_zip.read('META-INF/mozilla.sf') in (
+            inputs['extensions-ecdsa'])
+        assert signed_zip.read('META-INF/extensions-new.manifest') in (
+            inputs['extensions-new'])
+        assert signed_zip.read('META-INF/extensions-new.sig') == (
+            b'extensions-new')
+
+
+def put_xpis(fake_s3, keys):
+    for key in keys:
+        (guid, _) = key.split('/')
+        fake_s3.Object('mybucket', key).put(Body=make_xpi(guid))
+
+
+def test_handle_starts_biggest_records_first(fake_s3):
+    sizes = {'a@mozilla.org/1.xpi': 10, 'b@mozilla.org/2.xpi': 3000,
+             'c@mozilla.org/3.xpi': 200}
+    put_xpis(fake_s3, sizes)
+    started = []
+
+    def retrieve_record(env, record, record_metrics):
+        started.append(record['s3']['object']['key'])
+        return retrieve(env, record, record_metrics)
+
+    retrieve = sign_xpi.retrieve_record
+    env = dict(ENV, ASYNC_CONCURRENCY="1")
+    with mock.patch('requests.Session.post', side_effect=lambda url, json,
+                    timeout: autograph_response(json)), \
+            mock.patch('aws_lambda.sign_xpi.retrieve_record',
+                       retrieve_record):
+        ret = async_handler.handle(make_sized_s3_event(sizes),
+                                   FakeContext(60000), env)
+
+    assert started == ['b@mozilla.org/2.xpi', 'c@mozilla.org/3.xpi',
+                       'a@mozilla.org/1.xpi']
+    assert ret == [uploaded(fake_s3, name)
+                   for name in ['1.xpi', '2.xpi', '3.xpi']]
+
+
+def test_handle_leaves_records_it_has_no_time_for(fake_s3):
+    sizes = {'a@mozilla.org/1.xpi': 1000000, 'b@mozilla.org/2.xpi': 3000000,
+             'c@mozilla.org/3.xpi': 2000000}
+    put_xpis(fake_s3, sizes)
+    context = FakeContext(10000)
+
+    def retrieve_record(env, record, record_metrics):
+        # Each record takes up 5s of the time left
+        context.remaining_ms -= 5000
+        return retrieve(env, record, record_metrics)
+
+    retrieve = sign_xpi.retrieve_record
+    # 1MB/s and no margin, so that a record of n MB is estimated at ns
+    env = dict(ENV, ASYNC_CONCURRENCY="1", DEADLINE_MARGIN_MS="0",
+               RECORD_BASE_COST_MS="0", RECORD_BYTES_PER_SECOND="1000000")
+    with mock.patch('requests.Session.post', side_effect=lambda url, json,
+                    timeout: autograph_response(json)), \
+            mock.patch('aws_lambda.sign_xpi.retrieve_record',
+                       retrieve_record), \
+            pytest.raises(sign_xpi.RecordsFailedError) as e:
+        async_handler.handle(make_sized_s3_event(sizes), context, env)
+
+    # b has 10s, c has 5s, and there's none left for a
+    ret = e.value.results
+    assert ret[0]['error']['type'] == 'DeadlineExceededError'
+    assert ret[1:] == [uploaded(fake_s3, '2.xpi'), uploaded(fake_s3, '3.xpi')]
+
+
+def test_handle_raises_errors_for_sign_events(fake_s3):
+    fake_s3.Object('mybucket', 'addon.xpi').put(
+        Body=make_xpi('addon@mozilla.org'))
+    event = {"source": {"bucket": "mybucket", "key": "addon.xpi"},
+             "checksum": "abc"}
+    with pytest.raises(sign_xpi.ChecksumMatchError):
+        async_handler.handle(event, None, ENV)
+
+
+def test_batcher_sends_waiting_inputs_together():
+    env = sign_xpi.Environment(strict=True).load(
+        dict(ENV, AUTOGRAPH_BATCH_SIZE="2")).data
+
+    async def sign_all():
+        pipeline = async_handler.Pipeline(env)
+        try:
+            # Two inputs (for two keys) per XPI
+            return await asyncio.gather(*[
+                pipeline.batcher.sign([{"options": {"id": guid + "1"}},
+                                       {"options": {"id": guid + "2"}}])
+                for guid in ('a', 'b', 'c')
+            ])
+        finally:
+            pipeline.close()
+
+    loop = asyncio.new_event_loop()
+    with mock.patch.object(
+            sign_xpi, 'request_signatures',
+            side_effect=lambda env, inputs: [
+                i["options"]["id"] for i in inputs]) as request_signatures:
+        try:
+            signatures = loop.run_until_complete(sign_all())
+        finally:
+            loop.close()
+
+    assert signatures == [['a1', 'a2'], ['b1', 'b2'], ['c1', 'c2']]
+    assert [len(call[0][1]) for call in
+            request_signatures.call_args_list] == [4, 2]
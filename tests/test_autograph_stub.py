@@ -0,0 +1,64 @@
+import hashlib
+import zipfile
+from unittest import mock
+
+import pytest
+import requests
+from aws_lambda import sign_xpi
+from aws_lambda.archive import XPIArchive
+from benchmarks.autograph_stub import (
+    DEFAULT_CREDENTIALS, StubServer, StubSigner)
+from tests import get_test_file, ADDON_FILENAME
+
+
+@pytest.fixture
+def stub_server():
+    server = StubServer(StubSigner()).start()
+    try:
+        yield server
+    finally:
+        server.stop()
+
+
+def stub_env(server, hawk_secret=DEFAULT_CREDENTIALS['alice']):
+    return sign_xpi.Environment(strict=True).load({
+        "AUTOGRAPH_SERVER_URL": server.url,
+        "AUTOGRAPH_HAWK_ID": "alice",
+        "AUTOGRAPH_HAWK_SECRET": hawk_secret,
+        "AUTOGRAPH_KEY_ID": "extensions-ecdsa",
+        "OUTPUT_BUCKET": "output-bucket",
+    }).data
+
+
+def test_stub_signs_with_hawk_auth(stub_server):
+    archive = XPIArchive(open(get_test_file(ADDON_FILENAME), 'rb'))
+    [signed_xpi] = sign_xpi.sign_xpis(stub_env(stub_server),
+                                      [(archive, 'addon@mozilla.org')])
+
+    signature = zipfile.ZipFile(signed_xpi).read('META-INF/mozilla.rsa')
+    assert signature == hashlib.sha256(
+        archive.signature.encode('utf-8')).digest()
+    assert stub_server.signer.responses == {200: 1}
+
+
+def test_stub_rejects_bad_credentials(stub_server):
+    env = stub_env(stub_server, hawk_secret='wrong')
+    with pytest.raises(requests.HTTPError) as excinfo:
+        sign_xpi.request_signatures(env, [])
+
+    assert excinfo.value.response.status_code == 401
+
+
+def test_stub_turns_away_requests_over_its_concurrency_limit():
+    signer = StubSigner(max_concurrency=0)
+    (status, _) = signer.handle('http://localhost/sign/data', {}, b'[]')
+
+    assert status == 429
+
+
+def test_stub_injects_errors():
+    signer = StubSigner(error_rate=1)
+    with mock.patch.object(signer, 'authenticate', return_value=True):
+        (status, _) = signer.handle('http://localhost/sign/data', {}, b'[]')
+
+    assert status == 503
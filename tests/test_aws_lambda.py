@@ -1,8 +1,25 @@
+import base64
+import hashlib
 import io
+import json
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import zipfile
 from unittest import mock
+import botocore.exceptions
 import pytest
+import requests
+import responses
 import marshmallow.exceptions
-from aws_lambda import sign_xpi
+from aws_lambda import limiter, sign_xpi
+from aws_lambda.archive import XPIArchive
+from sign_xpi_lib import XPIFile
+from tests import get_test_file, ADDON_FILENAME, TEST_DIR
 
 
 def test_get_extension_id_rdf_sanity_check():
@@ -19,6 +36,89 @@ def test_get_extension_id_rdf_sanity_check():
     assert extension_id == 'hypothetical-addon@mozilla.org'
 
 
+INSTALL_RDF_CORPUS = [
+    # Child element, default namespace, unqualified about
+    ("""<?xml version="1.0" encoding="UTF-8"?>
+<RDF xmlns="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+     xmlns:em="http://www.mozilla.org/2004/em-rdf#">
+  <Description about="urn:mozilla:install-manifest">
+    <em:id>hypothetical-addon@mozilla.org</em:id>
+    <em:version>1.0</em:version>
+  </Description>
+</RDF>""", 'hypothetical-addon@mozilla.org'),
+    # Attribute form, prefixed RDF namespace
+    ("""<?xml version="1.0"?>
+<RDF:RDF xmlns:RDF="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+         xmlns:em="http://www.mozilla.org/2004/em-rdf#">
+  <RDF:Description RDF:about="urn:mozilla:install-manifest"
+                   em:id="{8a7f3b4c-1d2e-4f5a-9b6c-7d8e9f0a1b2c}"
+                   em:version="2.0"/>
+</RDF:RDF>""", '{8a7f3b4c-1d2e-4f5a-9b6c-7d8e9f0a1b2c}'),
+    # A targetApplication has an ID of its own, which must be ignored
+    ("""<?xml version="1.0"?>
+<RDF xmlns="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+     xmlns:em="http://www.mozilla.org/2004/em-rdf#">
+  <Description about="urn:mozilla:install-manifest">
+    <em:targetApplication>
+      <Description>
+        <em:id>{ec8030f7-c20a-464f-9b0e-13a3a9e97384}</em:id>
+        <em:minVersion>52.0</em:minVersion>
+      </Description>
+    </em:targetApplication>
+    <em:id>shield-recipe-client@mozilla.org</em:id>
+  </Description>
+</RDF>""", 'shield-recipe-client@mozilla.org'),
+    # The manifest is described in two places
+    ("""<?xml version="1.0"?>
+<RDF xmlns="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+     xmlns:em="http://www.mozilla.org/2004/em-rdf#">
+  <Description about="urn:mozilla:install-manifest" em:version="1.0"/>
+  <Description about="urn:mozilla:install-manifest">
+    <em:id>split@mozilla.org</em:id>
+  </Description>
+</RDF>""", 'split@mozilla.org'),
+]
+
+# Layouts that only rdflib understands
+INSTALL_RDF_EXOTIC_CORPUS = [
+    # The ID is on a node that refers to the manifest
+    ("""<?xml version="1.0"?>
+<RDF xmlns="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+     xmlns:em="http://www.mozilla.org/2004/em-rdf#">
+  <Description about="urn:mozilla:some-addon">
+    <em:id>indirect@mozilla.org</em:id>
+    <em:manifest resource="urn:mozilla:install-manifest"/>
+  </Description>
+</RDF>""", 'indirect@mozilla.org'),
+    # The ID is a typed literal
+    ("""<?xml version="1.0"?>
+<RDF xmlns="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+     xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+     xmlns:em="http://www.mozilla.org/2004/em-rdf#">
+  <Description about="urn:mozilla:install-manifest">
+    <em:id rdf:datatype="http://www.w3.org/2001/XMLSchema#string"
+      >typed@mozilla.org</em:id>
+  </Description>
+</RDF>""", 'typed@mozilla.org'),
+]
+
+
+@pytest.mark.parametrize('install_rdf,expected', INSTALL_RDF_CORPUS)
+def test_get_extension_id_rdf_fast_path_agrees_with_rdflib(install_rdf,
+                                                           expected):
+    contents = install_rdf.encode('utf-8')
+    assert sign_xpi.get_extension_id_rdf_fast(contents) == expected
+    assert sign_xpi.get_extension_id_rdf_graph(contents) == expected
+
+
+@pytest.mark.parametrize('install_rdf,expected', INSTALL_RDF_EXOTIC_CORPUS)
+def test_get_extension_id_rdf_falls_back_to_rdflib(install_rdf, expected):
+    assert sign_xpi.get_extension_id_rdf_fast(
+        install_rdf.encode('utf-8')) is None
+    assert sign_xpi.get_extension_id_rdf(
+        io.StringIO(install_rdf)) == expected
+
+
 def test_parse_s3_event_success():
     raw_s3_event = {
         "Records": [
@@ -69,6 +169,7 @@ def test_parse_s3_event_success():
                     },
                     'object': {
                         'key': 'HappyFace.jpg',
+                        'size': 1024,
                     }
                 }
             }
@@ -187,3 +288,1071 @@ def test_get_extension_id_invokes_json():
     with mock.patch('aws_lambda.sign_xpi.get_extension_id_json',
                     return_value=id_sentinel):
         assert sign_xpi.get_extension_id(zip) == id_sentinel
+
+
+ENV = {
+    "AUTOGRAPH_SERVER_URL": "http://localhost:8000/",
+    "AUTOGRAPH_HAWK_ID": "alice",
+    "AUTOGRAPH_HAWK_SECRET": "secret",
+    "AUTOGRAPH_KEY_ID": "extensions-ecdsa",
+    "OUTPUT_BUCKET": "output-bucket",
+}
+
+
+def make_s3_event(*keys):
+    return {
+        "Records": [
+            {"s3": {"bucket": {"name": "mybucket"}, "object": {"key": key}}}
+            for key in keys
+        ]
+    }
+
+
+def fake_pipeline(prepare_record):
+    """Patch out everything in handle() except for preparing records.
+
+    "Signing" a record produces its key, and "uploading" returns it.
+    """
+    def request_xpi_signatures(env, xpis, record_metrics=None):
+        return [guid for (localfile, guid) in xpis]
+
+    def upload_signed_xpi(env, signature, prepared, record_metrics=None):
+        return signature
+
+    return mock.patch.multiple(
+        'aws_lambda.sign_xpi',
+        prepare_record=mock.Mock(side_effect=prepare_record),
+        request_xpi_signatures=mock.Mock(side_effect=request_xpi_signatures),
+        upload_signed_xpi=mock.Mock(side_effect=upload_signed_xpi))
+
+
+def prepare_record_by_key(env, record, record_metrics=None):
+    key = record['s3']['object']['key']
+    return sign_xpi.PreparedXPI(mock.Mock(), key, key, 'checksum', None)
+
+
+def test_handle_processes_records_concurrently():
+    barrier = threading.Barrier(2, timeout=5)
+
+    def prepare_record(env, record, record_metrics=None):
+        # Deadlocks (and times out) unless both records are in flight
+        barrier.wait()
+        return prepare_record_by_key(env, record)
+
+    env = dict(ENV, MAX_WORKERS="2")
+    with fake_pipeline(prepare_record):
+        ret = sign_xpi.handle(make_s3_event('a/1.xpi', 'b/2.xpi'), None, env)
+
+    assert ret == ['a/1.xpi', 'b/2.xpi']
+
+
+def test_handle_preserves_record_order():
+    def prepare_record(env, record, record_metrics=None):
+        key = record['s3']['object']['key']
+        # Finish the records in the reverse of the order they came in
+        time.sleep(0.05 if key == 'a/1.xpi' else 0)
+        return prepare_record_by_key(env, record)
+
+    with fake_pipeline(prepare_record):
+        ret = sign_xpi.handle(make_s3_event('a/1.xpi', 'b/2.xpi'), None, ENV)
+
+    assert ret == ['a/1.xpi', 'b/2.xpi']
+
+
+def test_handle_reports_failures_per_record():
+    def prepare_record(env, record, record_metrics=None):
+        key = record['s3']['object']['key']
+        if key == 'a/1.xpi':
+            raise sign_xpi.S3IdMatchError('b', 'a')
+        return prepare_record_by_key(env, record)
+
+    # Retrying wouldn't help, so the results are returned
+    with fake_pipeline(prepare_record):
+        ret = sign_xpi.handle(make_s3_event('a/1.xpi', 'b/2.xpi'), None, ENV)
+
+    assert ret == [
+        {'error': {'type': 'S3IdMatchError',
+                   'message': 'XPI ID was b (S3 path starts with a)',
+                   'retryable': False}},
+        'b/2.xpi',
+    ]
+
+
+def test_records_failed_error_survives_pickling():
+    results = [{'error': {'type': 'CircuitOpenError', 'message': 'No',
+                          'retryable': True}},
+               {'error': {'type': 'S3IdMatchError', 'message': 'No',
+                          'retryable': False}},
+               'c/3.xpi']
+    error = pickle.loads(pickle.dumps(sign_xpi.RecordsFailedError(results)))
+
+    assert error.results == results
+    assert str(error) == "1 of 3 records can be retried (CircuitOpenError)"
+
+
+@pytest.mark.parametrize(('error', 'retryable'), [
+    (sign_xpi.DeadlineExceededError(1000, 500), True),
+    (limiter.CircuitOpenError(1), True),
+    (sign_xpi.AutographResponseError(2, 1), True),
+    (requests.ConnectionError(), True),
+    (requests.Timeout(), True),
+    (requests.HTTPError(response=mock.Mock(status_code=503)), True),
+    (requests.HTTPError(response=mock.Mock(status_code=404)), False),
+    (botocore.exceptions.EndpointConnectionError(endpoint_url='x'), True),
+    (botocore.exceptions.ReadTimeoutError(endpoint_url='x'), True),
+    (botocore.exceptions.ClientError(
+        {'Error': {'Code': 'SlowDown'},
+         'ResponseMetadata': {'HTTPStatusCode': 503}}, 'GetObject'), True),
+    (botocore.exceptions.ClientError(
+        {'Error': {'Code': 'NoSuchKey'},
+         'ResponseMetadata': {'HTTPStatusCode': 404}}, 'GetObject'), False),
+    (sign_xpi.S3IdMatchError('a', 'b'), False),
+    (sign_xpi.ChecksumMatchError('x', 'a', 'b'), False),
+    (ValueError("Extension is missing a manifest"), False),
+])
+def test_is_retryable_error(error, retryable):
+    assert sign_xpi.is_retryable_error(error) == retryable
+
+
+def test_handle_signs_records_in_batches():
+    keys = ['{}/x.xpi'.format(i) for i in range(5)]
+    env = dict(ENV, AUTOGRAPH_BATCH_SIZE="2")
+    with fake_pipeline(prepare_record_by_key):
+        ret = sign_xpi.handle(make_s3_event(*keys), None, env)
+        batches = [call[0][1] for call in sign_xpi.request_xpi_signatures.call_args_list]
+
+    assert ret == keys
+    assert sorted(len(batch) for batch in batches) == [1, 2, 2]
+
+
+def test_handle_reports_signing_failures_for_whole_batch():
+    keys = ['{}/x.xpi'.format(i) for i in range(3)]
+    env = dict(ENV, AUTOGRAPH_BATCH_SIZE="3")
+    with fake_pipeline(prepare_record_by_key), \
+            pytest.raises(sign_xpi.RecordsFailedError) as e:
+        sign_xpi.request_xpi_signatures.side_effect = (
+            sign_xpi.AutographResponseError(3, 1))
+        sign_xpi.handle(make_s3_event(*keys), None, env)
+
+    # This can be retried, so Lambda is asked to
+    assert e.value.results == [{'error': {
+        'type': 'AutographResponseError',
+        'message': 'Sent 3 inputs to Autograph (got 1 signatures)',
+        'retryable': True,
+    }}] * 3
+
+
+def test_handle_closes_archives(fake_s3):
+    archive = mock.Mock()
+    with mock.patch.multiple(
+            'aws_lambda.sign_xpi',
+            prepare_record=mock.Mock(return_value=sign_xpi.PreparedXPI(
+                archive, 'x', 'a', 'checksum', None)),
+            request_xpi_signatures=mock.Mock(return_value=[
+                [('META-INF/mozilla.rsa', b'signature')]]),
+            write_signed_archive=mock.DEFAULT):
+        sign_xpi.handle(make_s3_event('a/1.xpi'), None, ENV)
+
+    assert archive.close.called
+
+
+def autograph_response(sign_inputs):
+    """A fake /sign/data response, whose "signatures" name their input."""
+    resp = mock.Mock(status_code=200)
+    resp.json.return_value = [
+        {"ref": str(n), "signature": base64.b64encode(
+            sign_input["options"]["id"].encode('utf-8')).decode('utf-8')}
+        for (n, sign_input) in enumerate(sign_inputs)
+    ]
+    return resp
+
+
+@pytest.fixture
+def unsigned_xpis(tmpdir):
+    def make(count):
+        xpis = []
+        for n in range(count):
+            path = str(tmpdir.join('{}.xpi'.format(n)))
+            shutil.copy(get_test_file(ADDON_FILENAME), path)
+            xpis.append((XPIArchive(open(path, 'rb')),
+                         'addon-{}@mozilla.org'.format(n)))
+        return xpis
+    return make
+
+
+def test_sign_xpis_sends_one_request_per_batch(unsigned_xpis):
+    xpis = unsigned_xpis(5)
+    env = sign_xpi.Environment(strict=True).load(
+        dict(ENV, AUTOGRAPH_BATCH_SIZE="3")).data
+    with mock.patch('requests.Session.post', side_effect=lambda url, json,
+                    timeout: autograph_response(json)) as post:
+        signed_xpis = sign_xpi.sign_xpis(env, xpis)
+
+    assert [len(call[1]['json']) for call in post.call_args_list] == [3, 2]
+    for (signed_xpi, (_, guid)) in zip(signed_xpis, xpis):
+        signature = zipfile.ZipFile(signed_xpi).read('META-INF/mozilla.rsa')
+        assert signature == guid.encode('utf-8')
+
+
+def test_sign_xpis_batches_each_round_of_signing(unsigned_xpis):
+    xpis = unsigned_xpis(5)
+    env = sign_xpi.Environment(strict=True).load(
+        dict(ENV, AUTOGRAPH_BATCH_SIZE="3",
+             AUTOGRAPH_KEY_ID="extensions-ecdsa,b,c")).data
+    inputs = {}
+    with mock.patch('requests.Session.post',
+                    side_effect=post_keyid_signatures(inputs)) as post:
+        signed_xpis = sign_xpi.sign_xpis(env, xpis)
+
+    assert [len(call[1]['json']) for call in post.call_args_list] == [
+        6, 4, 3, 2]
+    for signed_xpi in signed_xpis:
+        signed_zip = zipfile.ZipFile(signed_xpi)
+        assert_signed_by_manifest(signed_zip)
+        assert signed_zip.read('META-INF/c.sig') == b'c'
+
+
+def test_write_signed_xpi_matches_make_signed(tmpdir):
+    xpi_file = XPIFile(get_test_file(ADDON_FILENAME))
+    make_signed_path = str(tmpdir.join('make-signed.xpi'))
+    xpi_file.make_signed(make_signed_path, sigpath='mozilla.rsa',
+                         signed_manifest=xpi_file.signature,
+                         signature=b'signature')
+    # Force this one to disk to check that spilling over works too
+    archive = XPIArchive(open(get_test_file(ADDON_FILENAME), 'rb'))
+    signed_xpi = sign_xpi.write_signed_xpi(
+        archive, [('META-INF/mozilla.rsa', b'signature')], spool_max_size=1)
+
+    expected = zipfile.ZipFile(make_signed_path)
+    actual = zipfile.ZipFile(signed_xpi)
+    assert actual.namelist() == expected.namelist()
+    for name in expected.namelist():
+        assert actual.read(name) == expected.read(name)
+
+
+def test_sign_xpis_rejects_mismatched_response(unsigned_xpis):
+    xpis = unsigned_xpis(2)
+    env = sign_xpi.Environment(strict=True).load(ENV).data
+    with mock.patch('requests.Session.post', side_effect=lambda url, json,
+                    timeout: autograph_response(json[:1])):
+        with pytest.raises(sign_xpi.AutographResponseError):
+            sign_xpi.sign_xpis(env, xpis)
+
+
+def test_parse_signing_keys():
+    assert sign_xpi.parse_signing_keys('a') == [
+        ('a', 'META-INF/mozilla.rsa', None)]
+    assert sign_xpi.parse_signing_keys('a, b, c:new.sig, d:d.bin') == [
+        ('a', 'META-INF/mozilla.rsa', None),
+        ('b', 'META-INF/b.sig', 'META-INF/b.manifest'),
+        ('c', 'META-INF/new.sig', 'META-INF/new.manifest'),
+        ('d', 'META-INF/d.bin', 'META-INF/d.manifest'),
+    ]
+
+
+@pytest.mark.parametrize('key_ids', [
+    '',
+    'a,,b',
+    'a:other.rsa',
+    # Firefox refuses XPIs with more than one of these
+    'a,b:b.rsa',
+    'a,b:b.SF',
+    'a,b:sub/b.sig',
+    'a,b,c:b.sig',
+    # The manifests that the other keys sign go in these
+    'a,b:b.manifest',
+    'a,b,c:b.bin',
+])
+def test_environment_rejects_bad_key_ids(key_ids):
+    with pytest.raises(marshmallow.exceptions.ValidationError):
+        sign_xpi.Environment(strict=True).load(
+            dict(ENV, AUTOGRAPH_KEY_ID=key_ids))
+
+
+def test_environment_rejects_nonpositive_max_workers():
+    with pytest.raises(marshmallow.exceptions.ValidationError):
+        sign_xpi.Environment(strict=True).load(dict(ENV, MAX_WORKERS="0"))
+
+
+def test_autograph_session_is_reused():
+    env = sign_xpi.Environment(strict=True).load(ENV).data
+    session = sign_xpi.get_autograph_session(env)
+    assert sign_xpi.get_autograph_session(env) is session
+    assert session.get_adapter('http://localhost:8000/')._pool_maxsize == (
+        sign_xpi.DEFAULT_AUTOGRAPH_POOL_SIZE)
+
+
+def test_autograph_requests_are_retried():
+    env = sign_xpi.Environment(strict=True).load(
+        dict(ENV, AUTOGRAPH_CONNECT_TIMEOUT="1",
+             AUTOGRAPH_READ_TIMEOUT="2")).data
+    session = mock.Mock()
+    session.post.side_effect = [
+        mock.Mock(status_code=503),
+        requests.ConnectionError(),
+        mock.Mock(status_code=200),
+    ]
+    with mock.patch('time.sleep') as sleep:
+        resp = sign_xpi.post_with_retries(env, session, 'http://x/', [])
+
+    assert resp.status_code == 200
+    assert session.post.call_count == 3
+    assert session.post.call_args[1]['timeout'] == (1.0, 2.0)
+    # Full jitter never waits longer than the exponential backoff
+    assert [call[0][0] <= 0.5 * 2 ** n
+            for (n, call) in enumerate(sleep.call_args_list)] == [True, True]
+
+
+def test_autograph_requests_give_up_after_retries():
+    env = sign_xpi.Environment(strict=True).load(
+        dict(ENV, AUTOGRAPH_RETRIES="1")).data
+    session = mock.Mock()
+    session.post.side_effect = requests.ConnectionError()
+    with mock.patch('time.sleep'):
+        with pytest.raises(requests.ConnectionError):
+            sign_xpi.post_with_retries(env, session, 'http://x/', [])
+
+    assert session.post.call_count == 2
+
+
+def test_autograph_client_errors_are_not_retried():
+    env = sign_xpi.Environment(strict=True).load(ENV).data
+    session = mock.Mock()
+    session.post.return_value = mock.Mock(status_code=401)
+    resp = sign_xpi.post_with_retries(env, session, 'http://x/', [])
+
+    assert resp.status_code == 401
+    assert session.post.call_count == 1
+
+
+def fake_s3_download(contents):
+    """Patch out S3 so that downloads write contents in small chunks."""
+    def download_fileobj(bucket, key, fileobj, Config=None):
+        for start in range(0, len(contents), 3):
+            fileobj.write(contents[start:start + 3])
+
+    s3 = mock.Mock()
+    s3.meta.client.download_fileobj.side_effect = download_fileobj
+    return mock.patch('aws_lambda.sign_xpi.get_s3', return_value=s3)
+
+
+S3_RECORD = {'s3': {'bucket': {'name': 'mybucket'},
+                    'object': {'key': 'addon@mozilla.org/addon.xpi'}}}
+
+
+def test_retrieve_xpi_closes_file_on_failed_download(fake_s3):
+    localfiles = []
+    SpooledFile = sign_xpi.SpooledFile
+
+    def spooled_file(**kwargs):
+        localfiles.append(SpooledFile(**kwargs))
+        return localfiles[-1]
+
+    # The XPI isn't in the bucket
+    with mock.patch('aws_lambda.sign_xpi.SpooledFile', spooled_file), \
+            pytest.raises(botocore.exceptions.ClientError):
+        sign_xpi.retrieve_xpi(S3_RECORD)
+
+    [localfile] = localfiles
+    assert localfile.closed
+
+
+def test_retrieve_xpi_verifies_checksum():
+    contents = b'not really a zip file'
+    with fake_s3_download(contents):
+        (localfile, filename, checksum) = sign_xpi.retrieve_xpi(
+            S3_RECORD, hashlib.sha256(contents).hexdigest())
+
+    assert filename == 'addon.xpi'
+    assert checksum == hashlib.sha256(contents).hexdigest()
+    localfile.seek(0)
+    assert localfile.read() == contents
+
+
+def test_retrieve_xpi_rejects_bad_checksum():
+    contents = b'not really a zip file'
+    with fake_s3_download(contents):
+        with pytest.raises(sign_xpi.ChecksumMatchError) as excinfo:
+            sign_xpi.retrieve_xpi(S3_RECORD, 'abc123')
+
+    assert excinfo.value.url == 's3://mybucket/addon@mozilla.org/addon.xpi'
+    assert excinfo.value.actual_checksum == (
+        hashlib.sha256(contents).hexdigest())
+
+
+@pytest.mark.parametrize('size', [10, 1024 * 1024])
+def test_spooled_file_can_be_read_by_zipfile(size):
+    xpi = make_xpi('addon@mozilla.org')
+    with sign_xpi.SpooledFile(max_size=size) as spooled:
+        spooled.write(xpi)
+        spooled.seek(0)
+        assert spooled.seekable()
+        with zipfile.ZipFile(spooled) as zf:
+            assert zf.read('manifest.json')
+
+
+def test_compute_checksum_reads_in_chunks():
+    contents = io.BytesIO(b'x' * (sign_xpi.CHUNK_SIZE * 2 + 1))
+    with mock.patch.object(contents, 'read', wraps=contents.read) as read:
+        checksum = sign_xpi.compute_checksum(contents)
+
+    assert checksum == hashlib.sha256(contents.getvalue()).hexdigest()
+    assert all(call[0] == (sign_xpi.CHUNK_SIZE,)
+               for call in read.call_args_list)
+
+
+def test_retrieve_xpi_downloads_large_xpis_in_parts(fake_s3):
+    contents = os.urandom(11 * 1024 * 1024)
+    key = S3_RECORD['s3']['object']['key']
+    fake_s3.Object('mybucket', key).put(Body=contents)
+    env = sign_xpi.Environment(strict=True).load(
+        dict(ENV, S3_MULTIPART_THRESHOLD=str(5 * 1024 * 1024),
+             S3_MULTIPART_CHUNKSIZE=str(5 * 1024 * 1024))).data
+    with mock.patch.object(fake_s3.meta.client, 'get_object',
+                           wraps=fake_s3.meta.client.get_object) as get:
+        (localfile, _, _) = sign_xpi.retrieve_xpi(
+            S3_RECORD, hashlib.sha256(contents).hexdigest(),
+            config=sign_xpi.transfer_config(env))
+
+    assert [call[1]['Range'] for call in get.call_args_list] == [
+        'bytes=0-5242879', 'bytes=5242880-10485759',
+        'bytes=10485760-']
+    localfile.seek(0)
+    assert localfile.read() == contents
+
+
+def uploaded(s3, key):
+    """The result of uploading an object that's now in the output bucket."""
+    body = s3.Object(ENV['OUTPUT_BUCKET'], key).get()['Body'].read()
+    return {'uploaded': {'bucket': ENV['OUTPUT_BUCKET'], 'key': key,
+                         'sha256': hashlib.sha256(body).hexdigest(),
+                         'size': len(body)}}
+
+
+def test_upload_signed_xpi_streams_large_xpis_in_parts(fake_s3):
+    # Random bytes don't compress, so the signed XPI is over 10 MiB
+    archive = XPIArchive(io.BytesIO(make_xpi(
+        'addon@mozilla.org', [('data.bin', os.urandom(11 * 1024 * 1024))])))
+    prepared = sign_xpi.PreparedXPI(archive, 'addon.xpi',
+                                    'addon@mozilla.org', 'checksum', None)
+    env = sign_xpi.Environment(strict=True).load(
+        dict(ENV, S3_MULTIPART_THRESHOLD=str(5 * 1024 * 1024),
+             S3_MULTIPART_CHUNKSIZE=str(5 * 1024 * 1024))).data
+    with mock.patch.object(fake_s3.meta.client, 'upload_part',
+                           wraps=fake_s3.meta.client.upload_part) as part:
+        ret = sign_xpi.upload_signed_xpi(
+            env, [('META-INF/mozilla.rsa', b'signature')], prepared)
+
+    assert ret == uploaded(fake_s3, 'addon.xpi')
+    assert part.call_count == 3
+    obj = fake_s3.Object(ENV['OUTPUT_BUCKET'], 'addon.xpi')
+    assert obj.metadata['sha256'] == ret['uploaded']['sha256']
+    assert obj.metadata['size'] == str(ret['uploaded']['size'])
+    signed_zip = zipfile.ZipFile(io.BytesIO(obj.get()['Body'].read()))
+    assert signed_zip.testzip() is None
+    assert signed_zip.read('META-INF/mozilla.rsa') == b'signature'
+
+
+def test_upload_signed_xpi_keeps_xpi_without_metadata(fake_s3, caplog):
+    archive = XPIArchive(io.BytesIO(make_xpi(
+        'addon@mozilla.org', [('data.bin', os.urandom(6 * 1024 * 1024))])))
+    prepared = sign_xpi.PreparedXPI(archive, 'addon.xpi',
+                                    'addon@mozilla.org', 'checksum', None)
+    env = sign_xpi.Environment(strict=True).load(
+        dict(ENV, S3_MULTIPART_THRESHOLD=str(5 * 1024 * 1024),
+             S3_MULTIPART_CHUNKSIZE=str(5 * 1024 * 1024))).data
+    # As when another upload replaced the object before the copy
+    error = botocore.exceptions.ClientError(
+        {'Error': {'Code': 'PreconditionFailed'}}, 'CopyObject')
+    with mock.patch.object(fake_s3.meta.client, 'copy_object',
+                           side_effect=error) as copy_object, \
+            mock.patch.object(fake_s3.meta.client, 'abort_multipart_upload',
+                              wraps=fake_s3.meta.client.abort_multipart_upload
+                              ) as abort:
+        ret = sign_xpi.upload_signed_xpi(
+            env, [('META-INF/mozilla.rsa', b'signature')], prepared)
+
+    assert ret == uploaded(fake_s3, 'addon.xpi')
+    obj = fake_s3.Object(ENV['OUTPUT_BUCKET'], 'addon.xpi')
+    assert copy_object.call_args[1]['CopySourceIfMatch'] == obj.e_tag
+    assert not abort.called
+    assert 'sha256' not in obj.metadata
+    assert "Couldn't add the sha256 and size" in caplog.text
+    # The signed XPI is still found, by its cache key
+    cache_key = sign_xpi.signed_xpi_cache_key(env, 'checksum',
+                                              'addon@mozilla.org')
+    assert sign_xpi.find_signed_xpi(env, 'addon.xpi', cache_key) == {
+        'uploaded': {'bucket': ENV['OUTPUT_BUCKET'], 'key': 'addon.xpi'}}
+
+
+def test_upload_signed_xpi_aborts_failed_uploads(fake_s3):
+    archive = mock.Mock(entries=[])
+    prepared = sign_xpi.PreparedXPI(archive, 'addon.xpi',
+                                    'addon@mozilla.org', 'checksum', None)
+    env = sign_xpi.Environment(strict=True).load(ENV).data
+    with mock.patch('aws_lambda.sign_xpi.write_signed_archive',
+                    side_effect=zipfile.BadZipFile("Truncated")):
+        with pytest.raises(zipfile.BadZipFile):
+            sign_xpi.upload_signed_xpi(
+                env, [('META-INF/mozilla.rsa', b'signature')], prepared)
+
+    assert archive.close.called
+    assert list(fake_s3.Bucket(ENV['OUTPUT_BUCKET']).objects.all()) == []
+
+
+def make_xpi(guid, files=()):
+    """Build a minimal WebExtension XPI with the given ID."""
+    xpi = io.BytesIO()
+    with zipfile.ZipFile(xpi, 'w', zipfile.ZIP_DEFLATED) as zout:
+        zout.writestr('manifest.json', json.dumps({
+            "manifest_version": 2,
+            "name": "Test addon",
+            "version": "1.0",
+            "applications": {"gecko": {"id": guid}},
+        }))
+        for (name, contents) in files:
+            zout.writestr(name, contents)
+    return xpi.getvalue()
+
+
+def test_handle_signs_and_uploads_xpi(fake_s3):
+    key = 'addon@mozilla.org/addon.xpi'
+    fake_s3.Object('mybucket', key).put(Body=make_xpi('addon@mozilla.org'))
+    with mock.patch('requests.Session.post', side_effect=lambda url, json,
+                    timeout: autograph_response(json)):
+        ret = sign_xpi.handle(make_s3_event(key), None, ENV)
+
+    assert ret == [uploaded(fake_s3, 'addon.xpi')]
+    signed_xpi = fake_s3.Object('output-bucket', 'addon.xpi').get()
+    signed_zip = zipfile.ZipFile(io.BytesIO(signed_xpi['Body'].read()))
+    assert signed_zip.namelist()[0] == 'META-INF/mozilla.rsa'
+    assert signed_zip.read('META-INF/mozilla.rsa') == b'addon@mozilla.org'
+
+
+# Modules that are loaded on first use, not when the lambda starts
+LAZY_MODULES = ['boto3', 'botocore', 'requests', 'requests_hawk',
+                'sign_xpi_lib', 'rdflib']
+# Importing the lambda loads 150-260 modules today, depending on the
+# Python version and what's installed. Importing boto3 or requests
+# as well would add another 80-190.
+COLD_START_MODULE_BUDGET = 300
+
+
+def test_cold_start_leaves_heavy_modules_unloaded():
+    # In a fresh interpreter, so that nothing else has imported them.
+    # The modules that were already loaded come first.
+    output = subprocess.run(
+        [sys.executable, '-c',
+         'import sys; print(" ".join(sys.modules)); '
+         'import aws_lambda.sign_xpi; print(" ".join(sys.modules))'],
+        cwd=os.path.dirname(TEST_DIR), stdout=subprocess.PIPE,
+        universal_newlines=True, check=True).stdout.splitlines()
+    modules = set(output[1].split()) - set(output[0].split())
+
+    assert 'aws_lambda.sign_xpi' in modules
+    loaded = [name for name in modules if name.split('.')[0] in LAZY_MODULES]
+    assert loaded == []
+    # Counting modules, rather than timing them, doesn't depend on how
+    # fast the machine is
+    assert len(modules) < COLD_START_MODULE_BUDGET
+
+
+def test_s3_resource_is_created_once_per_pool_size():
+    with mock.patch.dict('aws_lambda.sign_xpi.s3_resources', clear=True), \
+            mock.patch('boto3.resource',
+                       side_effect=lambda *args, **kwargs: mock.Mock()
+                       ) as resource:
+        assert sign_xpi.get_s3(40) is sign_xpi.get_s3(40)
+        assert sign_xpi.get_s3(320) is not sign_xpi.get_s3(40)
+
+    assert [call[1]['config'].max_pool_connections
+            for call in resource.call_args_list] == [40, 320]
+
+
+def test_s3_pool_is_sized_from_the_environment():
+    env = sign_xpi.Environment(strict=True).load(
+        dict(ENV, MAX_WORKERS="8", S3_MAX_CONCURRENCY="4")).data
+    # Enough for the async handler's records too
+    assert sign_xpi.s3_pool_size(env) == 32 * 4
+    env = sign_xpi.Environment(strict=True).load(
+        dict(ENV, MAX_WORKERS="64", ASYNC_CONCURRENCY="16")).data
+    assert sign_xpi.s3_pool_size(env) == 64 * 10
+
+
+def test_handle_reuses_signed_xpis(fake_s3):
+    key = 'addon@mozilla.org/addon.xpi'
+    fake_s3.Object('mybucket', key).put(Body=make_xpi('addon@mozilla.org'))
+    with mock.patch('requests.Session.post', side_effect=lambda url, json,
+                    timeout: autograph_response(json)) as post:
+        first = sign_xpi.handle(make_s3_event(key), None, ENV)
+        second = sign_xpi.handle(make_s3_event(key), None, ENV)
+
+    assert first == second
+    assert post.call_count == 1
+
+
+def test_handle_reads_archive_once(fake_s3):
+    key = 'addon@mozilla.org/addon.xpi'
+    fake_s3.Object('mybucket', key).put(Body=make_xpi('addon@mozilla.org'))
+    with mock.patch('requests.Session.post', side_effect=lambda url, json,
+                    timeout: autograph_response(json)), \
+            mock.patch('zipfile.ZipFile', wraps=zipfile.ZipFile) as ZipFile:
+        sign_xpi.handle(make_s3_event(key), None, ENV)
+
+    readers = [call for call in ZipFile.call_args_list
+               if call[0][1:2] in ((), ('r',))]
+    assert len(readers) == 1
+
+
+def test_handle_resigns_changed_xpis(fake_s3):
+    key = 'addon@mozilla.org/addon.xpi'
+    with mock.patch('requests.Session.post', side_effect=lambda url, json,
+                    timeout: autograph_response(json)) as post:
+        for version in ('1.0', '1.1'):
+            fake_s3.Object('mybucket', key).put(Body=make_xpi(
+                'addon@mozilla.org', [('version.txt', version)]))
+            sign_xpi.handle(make_s3_event(key), None, ENV)
+        # A different signing key makes a different XPI, too
+        sign_xpi.handle(make_s3_event(key), None,
+                        dict(ENV, AUTOGRAPH_KEY_ID='other-key'))
+
+    assert post.call_count == 3
+
+
+def test_handle_can_skip_signed_xpi_lookup(fake_s3):
+    key = 'addon@mozilla.org/addon.xpi'
+    fake_s3.Object('mybucket', key).put(Body=make_xpi('addon@mozilla.org'))
+    env = dict(ENV, REUSE_SIGNED_XPIS='false')
+    with mock.patch('requests.Session.post', side_effect=lambda url, json,
+                    timeout: autograph_response(json)) as post:
+        sign_xpi.handle(make_s3_event(key), None, env)
+        sign_xpi.handle(make_s3_event(key), None, env)
+
+    assert post.call_count == 2
+
+
+def sign_event(source, checksum=None):
+    event = {"source": source}
+    if checksum:
+        event["checksum"] = checksum
+    return event
+
+
+@pytest.fixture
+def fake_http():
+    with responses.RequestsMock() as http:
+        yield http
+
+
+def test_handle_signs_xpi_from_url(fake_s3, fake_http):
+    xpi = make_xpi('addon@mozilla.org')
+    fake_http.add(responses.GET, 'https://builds.example/latest',
+                  body=xpi, headers={
+                      'Content-Disposition': 'attachment; filename="a.xpi"'
+                  })
+    event = sign_event({"url": "https://builds.example/latest"},
+                       hashlib.sha256(xpi).hexdigest())
+    with mock.patch('requests.Session.post', side_effect=lambda url, json,
+                    timeout: autograph_response(json)):
+        ret = sign_xpi.handle(event, None, ENV)
+
+    assert ret == uploaded(fake_s3, 'a.xpi')
+    signed_xpi = fake_s3.Object('output-bucket', 'a.xpi').get()
+    signed_zip = zipfile.ZipFile(io.BytesIO(signed_xpi['Body'].read()))
+    assert signed_zip.read('META-INF/mozilla.rsa') == b'addon@mozilla.org'
+
+
+def test_handle_signs_xpi_from_s3_source(fake_s3):
+    xpi = make_xpi('addon@mozilla.org')
+    # Just as the CLI uploads and sends it
+    fake_s3.Object('mybucket', 'addon.xpi').put(Body=xpi)
+    event = {"source": {"bucket": "mybucket", "key": "addon.xpi"},
+             "checksum": hashlib.sha256(xpi).hexdigest()}
+    with mock.patch('requests.Session.post', side_effect=lambda url, json,
+                    timeout: autograph_response(json)):
+        ret = sign_xpi.handle(event, None, ENV)
+
+    assert ret == uploaded(fake_s3, 'addon.xpi')
+
+
+def test_handle_still_checks_extension_id_of_s3_events(fake_s3):
+    fake_s3.Object('mybucket', 'addon.xpi').put(
+        Body=make_xpi('addon@mozilla.org'))
+    with mock.patch('requests.Session.post', side_effect=lambda url, json,
+                    timeout: autograph_response(json)):
+        [ret] = sign_xpi.handle(make_s3_event('addon.xpi'), None, ENV)
+
+    assert ret['error']['type'] == 'S3IdNotPresentError'
+
+
+def test_handle_raises_errors_for_sign_events(fake_s3, fake_http):
+    fake_http.add(responses.GET, 'https://builds.example/addon.xpi',
+                  body=make_xpi('addon@mozilla.org'))
+    event = sign_event({"url": "https://builds.example/addon.xpi"}, 'abc')
+    with pytest.raises(sign_xpi.ChecksumMatchError):
+        sign_xpi.handle(event, None, ENV)
+
+
+def test_retrieve_url_xpi_takes_filename_from_url(fake_http):
+    fake_http.add(responses.GET, 'https://builds.example/dir/my%20addon.xpi',
+                  body=b'xpi')
+    env = sign_xpi.Environment(strict=True).load(ENV).data
+    (localfile, filename, checksum) = sign_xpi.retrieve_url_xpi(
+        env, 'https://builds.example/dir/my%20addon.xpi')
+
+    assert filename == 'my addon.xpi'
+    assert checksum == hashlib.sha256(b'xpi').hexdigest()
+    localfile.seek(0)
+    assert localfile.read() == b'xpi'
+
+
+def test_retrieve_url_xpi_ignores_directories_in_filename(fake_http):
+    fake_http.add(responses.GET, 'https://builds.example/addon.xpi',
+                  body=b'xpi', headers={
+                      'Content-Disposition': 'attachment; filename=../x.xpi'
+                  })
+    env = sign_xpi.Environment(strict=True).load(ENV).data
+    (_, filename, _) = sign_xpi.retrieve_url_xpi(
+        env, 'https://builds.example/addon.xpi')
+
+    assert filename == 'x.xpi'
+
+
+@pytest.mark.parametrize(('content_disposition', 'filename'), [
+    ('attachment; filename="a.xpi"', 'a.xpi'),
+    ('attachment; filename=a.xpi', 'a.xpi'),
+    ('attachment;', None),
+    ('attachment; size; filename=a.xpi', 'a.xpi'),
+    ('inline; filename=a.xpi', None),
+    ("attachment; filename=a.xpi; filename*=UTF-8''%C3%A9t%C3%A9.xpi",
+     '\u00e9t\u00e9.xpi'),
+    ("attachment; FILENAME*=iso-8859-1'en'%E9t%E9.xpi", '\u00e9t\u00e9.xpi'),
+    # Can't be decoded, so the plain filename is used
+    ("attachment; filename=a.xpi; filename*=UTF-8''%E9.xpi", 'a.xpi'),
+    ("attachment; filename=a.xpi; filename*=nope''b.xpi", 'a.xpi'),
+])
+def test_extract_response_filename(content_disposition, filename):
+    response = mock.Mock(headers={'Content-Disposition': content_disposition})
+    assert sign_xpi.extract_response_filename(response) == filename
+
+
+@pytest.mark.parametrize('content_length', [True, False])
+def test_retrieve_url_xpi_enforces_max_size(fake_http, content_length):
+    # Without a Content-Length, the size is only known while reading
+    fake_http.add(responses.GET, 'https://builds.example/addon.xpi',
+                  body=b'x' * 101,
+                  auto_calculate_content_length=content_length)
+    env = sign_xpi.Environment(strict=True).load(
+        dict(ENV, DOWNLOAD_MAX_SIZE='100')).data
+    with pytest.raises(sign_xpi.XPITooLargeError):
+        sign_xpi.retrieve_url_xpi(env, 'https://builds.example/addon.xpi')
+
+
+def test_handle_reports_metrics_per_record(fake_s3, capsys):
+    key = 'addon@mozilla.org/addon.xpi'
+    xpi = make_xpi('addon@mozilla.org')
+    fake_s3.Object('mybucket', key).put(Body=xpi)
+    env = dict(ENV, DEBUG_METRICS='true')
+    with mock.patch('requests.Session.post', side_effect=lambda url, json,
+                    timeout: autograph_response(json)):
+        [ret] = sign_xpi.handle(make_s3_event(key), None, env)
+
+    assert list(ret['metrics']['timings_ms']) == [
+        'download', 'checksum', 'guid', 'digest', 'autograph', 'write',
+        'upload']
+    signed_xpi = fake_s3.Object('output-bucket', 'addon.xpi').get()
+    assert ret['metrics']['sizes'] == {
+        'input_bytes': len(xpi),
+        'output_bytes': signed_xpi['ContentLength'],
+        'entries': 1,
+    }
+    [line] = capsys.readouterr().out.splitlines()
+    emf = json.loads(line)
+    assert emf['record'] == 'S3 bucket=mybucket key={}'.format(key)
+    assert emf['InputBytes'] == len(xpi)
+    assert emf['UploadTime'] == ret['metrics']['timings_ms']['upload']
+
+
+def test_handle_only_returns_metrics_when_asked(fake_s3):
+    key = 'addon@mozilla.org/addon.xpi'
+    fake_s3.Object('mybucket', key).put(Body=make_xpi('other@mozilla.org'))
+    ret = sign_xpi.handle(make_s3_event(key), None, ENV)
+
+    assert list(ret[0]) == ['error']
+
+
+def make_sqs_event(*bodies):
+    return {
+        "Records": [
+            {"messageId": "message-{}".format(n), "eventSource": "aws:sqs",
+             "body": body if isinstance(body, str) else json.dumps(body)}
+            for (n, body) in enumerate(bodies)
+        ]
+    }
+
+
+def parse_manifest(contents):
+    """The SHA256 digest of each file listed in a manifest.mf."""
+    digests = {}
+    # Long names are continued on lines starting with a space
+    contents = contents.decode('utf-8').replace('\n ', '')
+    for section in contents.split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in section.splitlines())
+        if 'Name' in fields:
+            digests[fields['Name']] = fields['SHA256-Digest']
+    return digests
+
+
+def sha256_digest(contents):
+    return base64.b64encode(hashlib.sha256(contents).digest()).decode('utf-8')
+
+
+def assert_signed_by_manifest(signed_zip):
+    """Check that manifest.mf and mozilla.sf cover everything they should.
+
+    Firefox refuses an XPI with a file that isn't listed in manifest.mf,
+    other than the signature files that mozilla.sf (and so manifest.mf)
+    are checked against.
+    """
+    unlisted = {'META-INF/mozilla.rsa', 'META-INF/mozilla.sf',
+                'META-INF/manifest.mf'}
+    manifest = signed_zip.read('META-INF/manifest.mf')
+    assert parse_manifest(manifest) == {
+        name: sha256_digest(signed_zip.read(name))
+        for name in signed_zip.namelist()
+        if name not in unlisted and not name.endswith('/')
+    }
+    assert ('SHA256-Digest-Manifest: ' + sha256_digest(manifest) in
+            signed_zip.read('META-INF/mozilla.sf').decode('utf-8'))
+
+
+def post_keyid_signatures(inputs):
+    """Fake Autograph's /sign/data, with "signatures" that name their key.
+
+    The decoded inputs are added to a list, by key.
+    """
+    def post(url, json, timeout):
+        resp = mock.Mock(status_code=200)
+        resp.json.return_value = []
+        for sign_input in json:
+            inputs.setdefault(sign_input['keyid'], []).append(
+                base64.b64decode(sign_input['input']))
+            resp.json.return_value.append({"signature": base64.b64encode(
+                sign_input["keyid"].encode('utf-8')).decode('utf-8')})
+        return resp
+    return post
+
+
+def test_handle_signs_with_every_key(fake_s3):
+    key = 'addon@mozilla.org/addon.xpi'
+    # Files from some earlier signing are replaced
+    fake_s3.Object('mybucket', key).put(Body=make_xpi(
+        'addon@mozilla.org', [('META-INF/new.sig', 'stale'),
+                              ('META-INF/new.manifest', 'stale')]))
+    env = dict(ENV, AUTOGRAPH_KEY_ID='extensions-ecdsa,extensions-new:new.sig')
+    inputs = {}
+
+    with mock.patch('requests.Session.post',
+                    side_effect=post_keyid_signatures(inputs)) as post:
+        sign_xpi.handle(make_s3_event(key), None, env)
+
+    # The new key signs first, so that mozilla.rsa covers its files
+    assert [[sign_input['keyid'] for sign_input in call[1]['json']]
+            for call in post.call_args_list] == [['extensions-new'],
+                                                 ['extensions-ecdsa']]
+    signed_xpi = fake_s3.Object('output-bucket', 'addon.xpi').get()
+    signed_zip = zipfile.ZipFile(io.BytesIO(signed_xpi['Body'].read()))
+    assert signed_zip.namelist()[:3] == ['META-INF/mozilla.rsa',
+                                         'META-INF/new.manifest',
+                                         'META-INF/new.sig']
+    assert signed_zip.namelist().count('META-INF/new.sig') == 1
+    assert signed_zip.namelist().count('META-INF/new.manifest') == 1
+    assert signed_zip.read('META-INF/mozilla.rsa') == b'extensions-ecdsa'
+    assert signed_zip.read('META-INF/new.sig') == b'extensions-new'
+    assert_signed_by_manifest(signed_zip)
+    # Each key signed the file that's next to its signature
+    assert inputs == {
+        'extensions-new': [signed_zip.read('META-INF/new.manifest')],
+        'extensions-ecdsa': [signed_zip.read('META-INF/mozilla.sf')],
+    }
+    # which for the new key is manifest.mf, as it is without its files
+    listed = parse_manifest(signed_zip.read('META-INF/manifest.mf'))
+    del listed['META-INF/new.manifest'], listed['META-INF/new.sig']
+    assert parse_manifest(signed_zip.read('META-INF/new.manifest')) == listed
+
+
+def test_handle_signs_with_one_key(fake_s3):
+    key = 'addon@mozilla.org/addon.xpi'
+    fake_s3.Object('mybucket', key).put(Body=make_xpi('addon@mozilla.org'))
+    inputs = {}
+
+    with mock.patch('requests.Session.post',
+                    side_effect=post_keyid_signatures(inputs)) as post:
+        sign_xpi.handle(make_s3_event(key), None, ENV)
+
+    assert len(post.call_args_list) == 1
+    signed_xpi = fake_s3.Object('output-bucket', 'addon.xpi').get()
+    signed_zip = zipfile.ZipFile(io.BytesIO(signed_xpi['Body'].read()))
+    assert_signed_by_manifest(signed_zip)
+    assert inputs == {
+        'extensions-ecdsa': [signed_zip.read('META-INF/mozilla.sf')]}
+
+
+def test_handle_sqs_reports_only_failed_messages():
+    def prepare_record(env, record, record_metrics=None):
+        key = record['s3']['object']['key']
+        if key == 'b/2.xpi':
+            raise sign_xpi.S3IdMatchError('c', 'b')
+        return prepare_record_by_key(env, record)
+
+    event = make_sqs_event(make_s3_event('a/1.xpi'),
+                           make_s3_event('b/2.xpi', 'c/3.xpi'),
+                           make_s3_event('d/4.xpi'),
+                           'not JSON')
+    with fake_pipeline(prepare_record):
+        ret = sign_xpi.handle_sqs(event, None, ENV)
+        signed = [guid for call in sign_xpi.request_xpi_signatures.call_args_list
+                  for (_, guid) in call[0][1]]
+
+    assert ret == {"batchItemFailures": [{"itemIdentifier": "message-1"},
+                                         {"itemIdentifier": "message-3"}]}
+    assert sorted(signed) == ['a/1.xpi', 'c/3.xpi', 'd/4.xpi']
+
+
+def test_handle_sqs_ignores_test_events():
+    event = make_sqs_event({"Service": "Amazon S3",
+                            "Event": "s3:TestEvent"})
+    with fake_pipeline(prepare_record_by_key):
+        ret = sign_xpi.handle_sqs(event, None, ENV)
+
+    assert ret == {"batchItemFailures": []}
+
+
+def test_handle_sqs_reports_messages_that_arent_s3_events():
+    event = make_sqs_event(
+        # As when S3 notifications go through SNS first
+        {"Type": "Notification",
+         "Message": json.dumps(make_s3_event('a/1.xpi'))},
+        'null', '3', {"Records": 3}, {"Event": "s3:ObjectCreated:Put"},
+        make_s3_event('b/2.xpi'))
+    with fake_pipeline(prepare_record_by_key):
+        ret = sign_xpi.handle_sqs(event, None, ENV)
+
+    assert ret == {"batchItemFailures": [
+        {"itemIdentifier": "message-{}".format(n)} for n in range(5)]}
+
+
+class FakeContext(object):
+    def __init__(self, remaining_ms):
+        self.remaining_ms = remaining_ms
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_ms
+
+
+def make_sized_s3_event(sizes):
+    event = make_s3_event(*sorted(sizes))
+    for record in event['Records']:
+        record['s3']['object']['size'] = sizes[record['s3']['object']['key']]
+    return event
+
+
+def test_handle_starts_biggest_records_first():
+    started = []
+
+    def prepare_record(env, record, record_metrics=None):
+        started.append(record['s3']['object']['key'])
+        return prepare_record_by_key(env, record)
+
+    sizes = {'a/1.xpi': 10, 'b/2.xpi': 3000, 'c/3.xpi': 200}
+    env = dict(ENV, MAX_WORKERS="1")
+    with fake_pipeline(prepare_record):
+        ret = sign_xpi.handle(make_sized_s3_event(sizes), FakeContext(60000),
+                              env)
+
+    assert started == ['b/2.xpi', 'c/3.xpi', 'a/1.xpi']
+    assert ret == ['a/1.xpi', 'b/2.xpi', 'c/3.xpi']
+
+
+def test_handle_leaves_records_it_has_no_time_for():
+    context = FakeContext(10000)
+
+    def prepare_record(env, record, record_metrics=None):
+        # Each record takes up 5s of the time left
+        context.remaining_ms -= 5000
+        return prepare_record_by_key(env, record)
+
+    # 1MB/s and no margin, so that a record of n MB is estimated at ns
+    env = dict(ENV, MAX_WORKERS="1", DEADLINE_MARGIN_MS="0",
+               RECORD_BASE_COST_MS="0", RECORD_BYTES_PER_SECOND="1000000")
+    sizes = {'a/1.xpi': 1000000, 'b/2.xpi': 3000000, 'c/3.xpi': 2000000}
+    with fake_pipeline(prepare_record), \
+            pytest.raises(sign_xpi.RecordsFailedError) as e:
+        sign_xpi.handle(make_sized_s3_event(sizes), context, env)
+
+    # b has 10s, c has 5s, and there's none left for a. Raising gets
+    # Lambda to send the event again.
+    ret = e.value.results
+    assert ret[1:] == ['b/2.xpi', 'c/3.xpi']
+    assert ret[0]['error']['type'] == 'DeadlineExceededError'
+
+
+def test_handle_sqs_redelivers_records_it_has_no_time_for():
+    event = make_sqs_event(make_s3_event('a/1.xpi'), make_s3_event('b/2.xpi'))
+    env = dict(ENV, DEADLINE_MARGIN_MS="1000", RECORD_BASE_COST_MS="500")
+    with fake_pipeline(prepare_record_by_key):
+        ret = sign_xpi.handle_sqs(event, FakeContext(1200), env)
+
+    assert ret == {"batchItemFailures": [{"itemIdentifier": "message-0"},
+                                         {"itemIdentifier": "message-1"}]}
+
+
+@pytest.fixture
+def fresh_limiters():
+    with mock.patch.dict('aws_lambda.sign_xpi.autograph_limiters', clear=True):
+        yield
+
+
+def test_autograph_overload_is_retried(fresh_limiters):
+    env = sign_xpi.Environment(strict=True).load(ENV).data
+    session = mock.Mock()
+    session.post.side_effect = [
+        mock.Mock(status_code=429),
+        mock.Mock(status_code=200),
+    ]
+    with mock.patch('time.sleep'):
+        resp = sign_xpi.post_with_retries(env, session, 'http://x/', [])
+
+    assert resp.status_code == 200
+    limiter_state = sign_xpi.get_autograph_limiter(env).state()
+    assert limiter_state['limit'] < sign_xpi.DEFAULT_AUTOGRAPH_POOL_SIZE / 2
+
+
+@pytest.mark.parametrize('error', [
+    requests.ConnectionError(),
+    requests.exceptions.ChunkedEncodingError(),
+    ValueError(),
+])
+def test_autograph_limiter_slots_are_released_after_errors(fresh_limiters,
+                                                           error):
+    env = sign_xpi.Environment(strict=True).load(
+        dict(ENV, AUTOGRAPH_RETRIES="0")).data
+    session = mock.Mock()
+    session.post.side_effect = error
+    with pytest.raises(type(error)):
+        sign_xpi.post_with_retries(env, session, 'http://x/', [])
+
+    assert sign_xpi.get_autograph_limiter(env).state()['in_flight'] == 0
+
+
+def test_autograph_requests_fail_fast_while_circuit_is_open(fresh_limiters):
+    env = sign_xpi.Environment(strict=True).load(
+        dict(ENV, AUTOGRAPH_CIRCUIT_THRESHOLD="2",
+             AUTOGRAPH_RETRIES="5")).data
+    session = mock.Mock()
+    session.post.return_value = mock.Mock(status_code=503)
+    with mock.patch('time.sleep'):
+        with pytest.raises(limiter.CircuitOpenError):
+            sign_xpi.post_with_retries(env, session, 'http://x/', [])
+
+    assert session.post.call_count == 2
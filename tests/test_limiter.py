@@ -0,0 +1,90 @@
+import threading
+
+import pytest
+from aws_lambda import limiter
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_limiter(max_limit=10, clock=None):
+    return limiter.AdaptiveLimiter(max_limit, latency_target=1.0,
+                                   failure_threshold=3, cooldown=30,
+                                   clock=clock or FakeClock())
+
+
+def test_limit_grows_while_requests_are_fast():
+    adaptive = make_limiter()
+    for _ in range(50):
+        adaptive.acquire()
+        adaptive.release(0.1, overloaded=False)
+
+    assert adaptive.state() == {"limit": 10, "in_flight": 0,
+                                "circuit": limiter.CLOSED}
+
+
+def test_limit_shrinks_when_requests_are_slow_or_turned_away():
+    adaptive = make_limiter()
+    adaptive.acquire()
+    adaptive.release(2.0, overloaded=False)
+    assert adaptive.limit == pytest.approx(5 * limiter.SLOW_DECREASE)
+
+    adaptive.acquire()
+    adaptive.release(0.1, overloaded=True)
+    assert adaptive.limit == pytest.approx(
+        5 * limiter.SLOW_DECREASE * limiter.OVERLOAD_DECREASE)
+
+
+def test_acquire_waits_for_a_slot():
+    adaptive = make_limiter(max_limit=2)
+    adaptive.acquire()
+    acquired = threading.Event()
+
+    def acquire():
+        adaptive.acquire()
+        acquired.set()
+
+    thread = threading.Thread(target=acquire)
+    thread.start()
+    assert not acquired.wait(0.1)
+    adaptive.release(0.1, overloaded=False)
+    assert acquired.wait(5)
+    thread.join()
+
+
+def test_circuit_opens_after_consecutive_failures():
+    clock = FakeClock()
+    adaptive = make_limiter(clock=clock)
+    for _ in range(3):
+        adaptive.acquire()
+        adaptive.release(0.1, overloaded=True)
+
+    with pytest.raises(limiter.CircuitOpenError) as excinfo:
+        adaptive.acquire()
+    assert excinfo.value.retry_after == 30
+
+    # After the cooldown, one request is let through to try Autograph
+    clock.now = 30
+    adaptive.acquire()
+    assert adaptive.state()["circuit"] == limiter.HALF_OPEN
+    adaptive.release(0.1, overloaded=False)
+    assert adaptive.state()["circuit"] == limiter.CLOSED
+
+
+def test_failed_trial_reopens_circuit():
+    clock = FakeClock()
+    adaptive = make_limiter(clock=clock)
+    for _ in range(3):
+        adaptive.acquire()
+        adaptive.release(0.1, overloaded=True)
+    clock.now = 30
+    adaptive.acquire()
+    adaptive.release(0.1, overloaded=True)
+
+    with pytest.raises(limiter.CircuitOpenError):
+        adaptive.acquire()
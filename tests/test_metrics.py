@@ -0,0 +1,35 @@
+from aws_lambda import metrics
+
+
+def test_to_emf_declares_recorded_metrics():
+    record_metrics = metrics.RecordMetrics()
+    record_metrics.add_time('upload', 0.5)
+    record_metrics.add_time('download', 0.25)
+    record_metrics.add_time('download', 0.25)
+    record_metrics.set_size('entries', 3)
+    record_metrics.properties['record'] = 'x'
+
+    emf = record_metrics.to_emf(timestamp=1.5)
+
+    assert emf['record'] == 'x'
+    assert emf['DownloadTime'] == 500
+    assert emf['UploadTime'] == 500
+    assert emf['Entries'] == 3
+    assert emf['_aws']['Timestamp'] == 1500
+    [directive] = emf['_aws']['CloudWatchMetrics']
+    assert directive['Namespace'] == metrics.NAMESPACE
+    assert directive['Metrics'] == [
+        {'Name': 'DownloadTime', 'Unit': 'Milliseconds'},
+        {'Name': 'UploadTime', 'Unit': 'Milliseconds'},
+        {'Name': 'Entries', 'Unit': 'Count'},
+    ]
+
+
+def test_as_dict_orders_stages():
+    record_metrics = metrics.RecordMetrics()
+    with record_metrics.time('write'):
+        pass
+    with record_metrics.time('guid'):
+        pass
+
+    assert list(record_metrics.as_dict()['timings_ms']) == ['guid', 'write']
@@ -0,0 +1,157 @@
+import concurrent.futures
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+from unittest import mock
+
+import requests
+from aws_lambda import sign_xpi, worker
+from tests.test_aws_lambda import make_s3_event
+
+
+def write_event(directory, name, event):
+    with open(os.path.join(directory, name), 'w') as f:
+        json.dump(event, f)
+
+
+def read_result(*path):
+    with open(os.path.join(*path)) as f:
+        return json.load(f)
+
+
+def fake_handle(event, context, env):
+    key = event['Records'][0]['s3']['object']['key']
+    if key.startswith('bad'):
+        raise sign_xpi.RecordsFailedError([{"error": {
+            "type": "CircuitOpenError", "message": key, "retryable": True}}])
+    return [{"uploaded": {"key": key}}]
+
+
+def test_worker_handles_spooled_events(tmpdir):
+    spool = str(tmpdir)
+    write_event(spool, 'a.json', make_s3_event('a/1.xpi'))
+    write_event(spool, 'b.json', make_s3_event('bad.xpi'))
+    with open(os.path.join(spool, 'c.json'), 'w') as f:
+        f.write('not JSON')
+    with concurrent.futures.ThreadPoolExecutor(2) as executor, \
+            mock.patch('aws_lambda.sign_xpi.handle', fake_handle):
+        spool_worker = worker.Worker(worker.SpoolSource(spool), {}, executor,
+                                     max_in_flight=2, poll_interval=0.01)
+        spool_worker.run(exit_when_idle=True)
+
+    assert read_result(spool, 'done', 'a.json') == [
+        {"uploaded": {"key": "a/1.xpi"}}]
+    failed = read_result(spool, 'failed', 'b.json')
+    assert failed['error']['type'] == 'RecordsFailedError'
+    assert failed['results'][0]['error']['type'] == 'CircuitOpenError'
+    assert 'error' in read_result(spool, 'failed', 'c.json')
+    assert sorted(os.listdir(spool)) == ['done', 'failed']
+    assert spool_worker.status()['events'] == {
+        'received': 2, 'handled': 1, 'failed': 1}
+
+
+def test_worker_finishes_events_in_progress_when_stopped(tmpdir):
+    spool = str(tmpdir)
+    write_event(spool, 'a.json', make_s3_event('a/1.xpi'))
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_handle(event, context, env):
+        started.set()
+        release.wait(5)
+        return fake_handle(event, context, env)
+
+    with concurrent.futures.ThreadPoolExecutor(1) as executor, \
+            mock.patch('aws_lambda.sign_xpi.handle', slow_handle):
+        spool_worker = worker.Worker(worker.SpoolSource(spool), {}, executor,
+                                     max_in_flight=1, poll_interval=0.01)
+        thread = threading.Thread(target=spool_worker.run)
+        thread.start()
+        assert started.wait(5)
+        spool_worker.stop()
+        # Still waiting for the event in progress
+        thread.join(0.1)
+        assert thread.is_alive()
+        release.set()
+        thread.join(5)
+
+    assert not thread.is_alive()
+    assert os.listdir(os.path.join(spool, 'done')) == ['a.json']
+
+
+def test_sqs_source_deletes_only_handled_messages():
+    client = mock.Mock()
+    client.receive_message.return_value = {"Messages": [
+        {"MessageId": "m1", "ReceiptHandle": "r1", "Body": "{}"},
+        {"MessageId": "m2", "ReceiptHandle": "r2", "Body": "{}"},
+    ]}
+    source = worker.SQSSource('https://queue', client)
+    [(event, token)] = source.receive(1)
+    source.complete(token, {"batchItemFailures": [{"itemIdentifier": "m2"}]})
+
+    assert [record['messageId'] for record in event['Records']] == [
+        'm1', 'm2']
+    client.delete_message_batch.assert_called_once_with(
+        QueueUrl='https://queue', Entries=[{"Id": "0", "ReceiptHandle": "r1"}])
+
+
+def test_spool_source_requeues_events_claimed_by_dead_workers(tmpdir):
+    spool = str(tmpdir)
+    dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+    dead.wait()
+    host = socket.gethostname()
+    claims = {
+        # From a worker that didn't record who claimed it
+        'a.json.processing': 'a/1.xpi',
+        'b.json.{}@{}.processing'.format(dead.pid, host): 'b/2.xpi',
+        # Still running, or on another host, so left alone
+        'c.json.{}@{}.processing'.format(os.getppid(), host): 'c/3.xpi',
+        'd.json.{}@elsewhere.processing'.format(dead.pid): 'd/4.xpi',
+    }
+    for (name, key) in claims.items():
+        write_event(spool, name, make_s3_event(key))
+
+    with concurrent.futures.ThreadPoolExecutor(2) as executor, \
+            mock.patch('aws_lambda.sign_xpi.handle', fake_handle):
+        spool_worker = worker.Worker(worker.SpoolSource(spool), {}, executor,
+                                     max_in_flight=2, poll_interval=0.01)
+        spool_worker.run(exit_when_idle=True)
+
+    assert sorted(os.listdir(os.path.join(spool, 'done'))) == [
+        'a.json', 'b.json']
+    assert sorted(os.listdir(spool)) == sorted(
+        ['done', 'failed'] + list(claims)[2:])
+    assert spool_worker.status()['source'] == {"requeued": 2}
+
+
+def test_status_server_reports_health(tmpdir):
+    spool_worker = worker.Worker(worker.SpoolSource(str(tmpdir)), {},
+                                 mock.Mock(), max_in_flight=1)
+    server = worker.StatusServer(spool_worker, ('127.0.0.1', 0))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://{}:{}'.format(*server.server_address)
+    try:
+        assert requests.get(url + '/health').json() == {"status": "ok"}
+        assert requests.get(url + '/metrics').json()['in_flight'] == 0
+        spool_worker.stop()
+        assert requests.get(url + '/health').status_code == 503
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def ignores_shutdown_signals():
+    return all(signal.getsignal(signum) == signal.SIG_IGN
+               for signum in worker.SHUTDOWN_SIGNALS)
+
+
+def test_pool_processes_ignore_shutdown_signals():
+    before = signal.getsignal(signal.SIGTERM)
+    with worker.make_pool(2) as pool:
+        assert pool.submit(ignores_shutdown_signals).result(timeout=10)
+
+    assert signal.getsignal(signal.SIGTERM) == before